@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Lõi thống kê theo nhóm dạng cột (columnar) cho AggregateWithFilter:
+- Đọc 1 lượt chỉ các cột cần (nhóm + tổng hợp) vào list -> mã hoá khoá nhóm thành số nguyên
+  theo thứ tự xuất hiện đầu tiên (giữ nguyên thứ tự dòng kết quả như cách duyệt dict cũ).
+- SUM/AVG/COUNT dùng np.bincount (cộng tuần tự theo thứ tự đối tượng -> kết quả float trùng khớp
+  cộng dồn từng đối tượng), MIN/MAX số dùng reduceat trên mảng đã sắp theo nhóm.
+- MIN/MAX trường không phải số (String, Date...) và COUNT_DISTINCT so sánh trên chính giá trị gốc.
+Tổng hợp song song: mỗi phân đoạn tạo trạng thái gộp được (group_partial), merge_chunks gộp theo khoá
+(sum/count cộng, min/max so sánh, count_distinct hợp tập), finalize_partial ra giá trị cuối.
+Phân vị (MEDIAN, Pxx): chính xác trên mảng array('d') (8 byte/giá trị) bằng chọn phần tử (partition),
+hoặc xấp xỉ bằng QuantileSketch (KLL) với bộ nhớ giới hạn theo sai số hạng cho trước.
+Không import QGIS -> kiểm thử được ngoài QGIS.
+"""
+import math
+import random
+from array import array
+
+import numpy as np
+
+
+def factorize(keys):
+    """Khoá nhóm (tuple) -> (codes int64, danh sách khoá theo thứ tự xuất hiện đầu tiên)."""
+    index = {}
+    codes = np.fromiter((index.setdefault(k, len(index)) for k in keys), dtype=np.int64, count=len(keys))
+    return codes, list(index)
+
+
+def regroup(codes, keys, positions):
+    """
+    Gom nhóm mịn (codes, keys) về tập con vị trí cột positions (ROLLUP / GROUPING SETS) mà không duyệt lại dòng:
+    chỉ mã hoá lại các khoá nhóm mịn, thứ tự nhóm thô vẫn theo lần xuất hiện đầu tiên trong dữ liệu.
+    """
+    sub_codes, sub_keys = factorize([tuple(k[p] for p in positions) for k in keys])
+    return sub_codes[codes], sub_keys
+
+
+def rollup_sets(n):
+    """ROLLUP(c0..cn-1) -> [(0..n-1), (0..n-2), ..., (0,), ()]."""
+    return [tuple(range(m)) for m in range(n, -1, -1)]
+
+
+def float_column(values):
+    """
+    Cột giá trị -> (mảng float64, mặt nạ hợp lệ).
+    Hợp lệ = khác None và float() được (giống quy tắc bỏ qua giá trị của SUM/AVG cũ).
+    """
+    n = len(values)
+    try:
+        if any(v is None for v in values):
+            raise TypeError
+        return np.array(values, dtype=np.float64), np.ones(n, dtype=bool)
+    except (TypeError, ValueError):
+        pass
+    vals = np.zeros(n, dtype=np.float64)
+    ok = np.zeros(n, dtype=bool)
+    for i, v in enumerate(values):
+        if v is None:
+            continue
+        try:
+            vals[i] = float(v)
+            ok[i] = True
+        except Exception:
+            pass
+    return vals, ok
+
+
+def _reduce_sorted(ufunc, codes, vals, n_groups):
+    """ufunc.reduceat theo nhóm; trả (giá trị từng nhóm, nhóm có dữ liệu)."""
+    out = np.zeros(n_groups, dtype=np.float64)
+    has = np.zeros(n_groups, dtype=bool)
+    if codes.size:
+        order = np.argsort(codes, kind="stable")
+        sc = codes[order]
+        starts = np.flatnonzero(np.r_[True, sc[1:] != sc[:-1]])
+        out[sc[starts]] = ufunc.reduceat(vals[order], starts)
+        has[sc[starts]] = True
+    return out, has
+
+
+def _extreme_objects(func, codes, values, n_groups):
+    """MIN/MAX trên giá trị gốc (chuỗi, ngày...), so sánh đúng như vòng lặp cũ."""
+    best = [None] * n_groups
+    less = func == "min"
+    for g, v in zip(codes.tolist(), values):
+        if v is None:
+            continue
+        b = best[g]
+        if b is None or (v < b if less else v > b):
+            best[g] = v
+    return best
+
+
+def group_aggregate(func, codes, n_groups, values=None, numeric=True):
+    """
+    Một phép tổng hợp trên cột values (None = COUNT(*)) -> list kết quả Python theo nhóm.
+    numeric: cột kiểu số (MIN/MAX tính vector hoá, kết quả float).
+    """
+    if func == "count":
+        if values is None:
+            return np.bincount(codes, minlength=n_groups).tolist()
+        keep = np.fromiter((v is not None for v in values), dtype=bool, count=len(values))
+        return np.bincount(codes[keep], minlength=n_groups).tolist()
+    if func == "count_distinct":
+        pairs = {(g, v) for g, v in zip(codes.tolist(), values) if v is not None}
+        return np.bincount(np.fromiter((g for g, _ in pairs), dtype=np.int64, count=len(pairs)),
+                           minlength=n_groups).tolist()
+    if func in ("sum", "avg"):
+        vals, ok = float_column(values)
+        gc = codes[ok]
+        sums = np.bincount(gc, weights=vals[ok], minlength=n_groups).tolist()
+        if func == "sum":
+            return sums
+        counts = np.bincount(gc, minlength=n_groups).tolist()
+        return [s / c if c > 0 else None for s, c in zip(sums, counts)]
+    if func in ("min", "max"):
+        if not numeric:
+            return _extreme_objects(func, codes, values, n_groups)
+        vals, ok = float_column(values)
+        ok &= ~np.isnan(vals)
+        out, has = _reduce_sorted(np.minimum if func == "min" else np.maximum, codes[ok], vals[ok], n_groups)
+        return [v if h else None for v, h in zip(out.tolist(), has.tolist())]
+    raise ValueError(func)
+
+
+# ---------------- Trạng thái gộp được (tổng hợp song song) ----------------
+def first_positions(codes, n_groups, order):
+    """Thứ tự (vd FID) nhỏ nhất của mỗi nhóm -> dùng sắp nhóm khi gộp các phân đoạn."""
+    first = np.full(n_groups, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, codes, np.asarray(order, dtype=np.int64))
+    return first
+
+
+def group_partial(func, codes, n_groups, values=None, numeric=True):
+    """Trạng thái gộp được của 1 phép tổng hợp theo nhóm trên 1 phân đoạn."""
+    if func in ("sum", "avg"):
+        vals, ok = float_column(values)
+        gc = codes[ok]
+        return {"sum": np.bincount(gc, weights=vals[ok], minlength=n_groups),
+                "count": np.bincount(gc, minlength=n_groups)}
+    if func == "count":
+        return {"count": np.asarray(group_aggregate("count", codes, n_groups, values), dtype=np.int64)}
+    if func in ("min", "max"):
+        return {"value": group_aggregate(func, codes, n_groups, values, numeric)}
+    if func == "count_distinct":
+        sets = [set() for _ in range(n_groups)]
+        for g, v in zip(codes.tolist(), values):
+            if v is not None:
+                sets[g].add(v)
+        return {"set": sets}
+    raise ValueError(func)
+
+
+def _merge_states(func, states, gmaps, n_groups):
+    """Gộp trạng thái các phân đoạn; gmaps[i][g] = nhóm chung của nhóm g thuộc phân đoạn i."""
+    if func in ("sum", "avg", "count"):
+        out = {}
+        for name in states[0]:
+            acc = np.zeros(n_groups, dtype=states[0][name].dtype)
+            for st, gm in zip(states, gmaps):
+                np.add.at(acc, gm, st[name])
+            out[name] = acc
+        return out
+    if func in ("min", "max"):
+        best = [None] * n_groups
+        less = func == "min"
+        for st, gm in zip(states, gmaps):
+            for g, v in zip(gm.tolist(), st["value"]):
+                if v is not None and (best[g] is None or (v < best[g] if less else v > best[g])):
+                    best[g] = v
+        return {"value": best}
+    if func == "count_distinct":
+        sets = [set() for _ in range(n_groups)]
+        for st, gm in zip(states, gmaps):
+            for g, part in zip(gm.tolist(), st["set"]):
+                sets[g] |= part
+        return {"set": sets}
+    raise ValueError(func)
+
+
+def merge_chunks(chunks, funcs):
+    """
+    chunks: [(keys, first, {acc_key: trạng thái})] theo phân đoạn; funcs: {acc_key: tên hàm}.
+    -> (keys, first, {acc_key: trạng thái}) gộp theo khoá, nhóm sắp theo first (FID nhỏ nhất) tăng dần.
+    Gọi với 1 phân đoạn có khoá đã rút gọn (ROLLUP) = gom nhóm mịn lên cấp thô.
+    """
+    index, firsts, gmaps = {}, [], []
+    for keys, first, _ in chunks:
+        gm = np.empty(len(keys), dtype=np.int64)
+        for i, (k, f) in enumerate(zip(keys, first.tolist())):
+            g = index.get(k)
+            if g is None:
+                g = index[k] = len(firsts)
+                firsts.append(f)
+            elif f < firsts[g]:
+                firsts[g] = f
+            gm[i] = g
+        gmaps.append(gm)
+    n = len(firsts)
+    firsts = np.asarray(firsts, dtype=np.int64)
+    order = np.argsort(firsts, kind="stable")
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    gmaps = [rank[gm] for gm in gmaps]
+    keys = [None] * n
+    for k, g in index.items():
+        keys[rank[g]] = k
+    states = {ak: _merge_states(func, [c[2][ak] for c in chunks], gmaps, n) for ak, func in funcs.items()}
+    return keys, firsts[order], states
+
+
+def finalize_partial(func, state):
+    """Trạng thái đã gộp -> list kết quả Python theo nhóm (cùng quy ước với group_aggregate)."""
+    if func == "sum":
+        return state["sum"].tolist()
+    if func == "avg":
+        return [s / c if c > 0 else None for s, c in zip(state["sum"].tolist(), state["count"].tolist())]
+    if func == "count":
+        return state["count"].tolist()
+    if func in ("min", "max"):
+        return state["value"]
+    if func == "count_distinct":
+        return [len(st) for st in state["set"]]
+    raise ValueError(func)
+
+
+# ---------------- Phân vị ----------------
+def quantile(values, q):
+    """
+    Phân vị q (0..1) chính xác, nội suy tuyến tính giữa 2 hạng kề nhau (q=0.5, số phần tử chẵn
+    -> trung bình 2 phần tử giữa). values: array('d'), được sắp lại tại chỗ (partition, không sort cả mảng).
+    """
+    n = len(values)
+    if n == 0:
+        return None
+    arr = np.frombuffer(values, dtype=np.float64) if isinstance(values, array) else np.asarray(values, dtype=np.float64)
+    pos = q * (n - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, n - 1)
+    frac = pos - lo
+    arr.partition((lo, hi) if hi != lo else lo)
+    a, b = float(arr[lo]), float(arr[hi])
+    if frac == 0.0:
+        return a
+    if frac == 0.5:
+        return (a + b) / 2.0
+    return a + (b - a) * frac
+
+
+class QuantileSketch:
+    """
+    KLL sketch: phân vị xấp xỉ với sai số hạng ~eps, bộ nhớ ~3·k số thực (k ≈ 2/eps) bất kể số giá trị.
+    Mỗi tầng h giữ mẫu có trọng số 2^h; tầng đầy -> sắp, giữ ngẫu nhiên 1 trong 2 phần tử lên tầng trên.
+    Gộp được (merge) -> dùng cho tổng hợp song song theo phân đoạn.
+    """
+    __slots__ = ("k", "n", "levels", "_rng", "_items", "_caps", "_cap")
+    _C = 2.0 / 3.0
+    _MIN_CAP = 8
+
+    def __init__(self, eps=0.01, seed=None):
+        self.k = max(self._MIN_CAP, int(math.ceil(2.0 / max(eps, 1e-6))))
+        self.n = 0
+        self.levels = []
+        self._rng = random.Random(seed)
+        self._items = 0
+        self._grow()
+
+    def _grow(self):
+        """Thêm 1 tầng; sức chứa tầng h = k·c^(độ sâu) (tối thiểu _MIN_CAP)."""
+        self.levels.append(array("d"))
+        top = len(self.levels) - 1
+        self._caps = [max(self._MIN_CAP, int(math.ceil(self.k * self._C ** (top - h)))) for h in range(top + 1)]
+        self._cap = sum(self._caps)
+
+    def _compress(self):
+        """Nén lười: chỉ khi tổng số mẫu vượt tổng sức chứa, nén tầng thấp nhất đang đầy."""
+        while self._items >= self._cap:
+            h = next(h for h, lvl in enumerate(self.levels) if len(lvl) >= self._caps[h])
+            if h + 1 == len(self.levels):
+                self._grow()
+            buf = sorted(self.levels[h])
+            keep = array("d", buf[-1:]) if len(buf) % 2 else array("d")
+            if keep:
+                buf.pop()
+            up = buf[self._rng.getrandbits(1)::2]
+            self.levels[h + 1].extend(up)
+            self.levels[h] = keep
+            self._items -= len(buf) - len(up)
+
+    def add(self, x):
+        self.levels[0].append(x)
+        self.n += 1
+        self._items += 1
+        if self._items >= self._cap:
+            self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self._grow()
+        for h, lvl in enumerate(other.levels):
+            self.levels[h].extend(lvl)
+        self.n += other.n
+        self._items += other._items
+        self._compress()
+        return self
+
+    def __len__(self):
+        return self.n
+
+    def quantile(self, q):
+        if self.n == 0:
+            return None
+        items = sorted((v, 1 << h) for h, lvl in enumerate(self.levels) for v in lvl)
+        target = q * sum(w for _, w in items)
+        acc = 0
+        for v, w in items:
+            acc += w
+            if acc >= target:
+                return v
+        return items[-1][0]
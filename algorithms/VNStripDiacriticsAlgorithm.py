@@ -19,6 +19,8 @@ from qgis.core import (
 )
 import re
 
+from ..request_utils import attribute_request
+
 # ===== Bảng mã =====
 _Unicode = [
 u'â',u'Â',u'ă',u'Ă',u'đ',u'Đ',u'ê',u'Ê',u'ô',u'Ô',u'ơ',u'Ơ',u'ư',u'Ư',u'á',u'Á',u'à',u'À',u'ả',u'Ả',u'ã',u'Ã',u'ạ',u'Ạ',
@@ -329,7 +331,8 @@ class VNStripDiacriticsAlgorithm(QgsProcessingAlgorithm):
                     new_fields_added[fname] = new_name
                 vlayer.updateFields()
 
-                for i, feat in enumerate(vlayer.getFeatures()):
+                request = attribute_request(vlayer.fields(), list(new_fields_added))
+                for i, feat in enumerate(vlayer.getFeatures(request)):
                     updates = {}
                     for src_name, dst_name in new_fields_added.items():
                         val = feat[src_name]
@@ -348,7 +351,8 @@ class VNStripDiacriticsAlgorithm(QgsProcessingAlgorithm):
                 # FIELD_INPLACE
                 vlayer.startEditing()
                 idx_map = [vlayer.fields().indexFromName(n) for n in target_fields]
-                for i, feat in enumerate(vlayer.getFeatures()):
+                request = attribute_request(vlayer.fields(), target_fields)
+                for i, feat in enumerate(vlayer.getFeatures(request)):
                     updates = {}
                     for idx, name in zip(idx_map, target_fields):
                         val = feat[name]
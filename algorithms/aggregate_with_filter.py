@@ -4,12 +4,20 @@ from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm,
     QgsProcessingParameterFeatureSource, QgsProcessingParameterField,
     QgsProcessingParameterString, QgsProcessingParameterFeatureSink,
-    QgsProcessingException,
+    QgsProcessingParameterEnum, QgsProcessingParameterNumber, QgsProcessingException,
     QgsFields, QgsField, QgsFeature, QgsCoordinateReferenceSystem,
-    QgsFeatureRequest, QgsExpression, QgsWkbTypes
+    QgsWkbTypes
 )
 import re
 
+from ..aggregate_utils import (
+    factorize, group_aggregate, regroup, rollup_sets,
+    first_positions, group_partial, merge_chunks, finalize_partial
+)
+from ..request_utils import (
+    attribute_request, provider_filtered_layer, clonable_layer, parallel_scan, auto_workers
+)
+
 def _tr(s):
     return QCoreApplication.translate("AggregateWithFilter", s)
 
@@ -18,7 +26,13 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
     GROUP_FIELDS = "GROUP_FIELDS"
     AGG_LIST = "AGG_LIST"
     FILTER_EXPR = "FILTER_EXPR"
+    GROUPING_MODE = "GROUPING_MODE"
+    GROUPING_SETS = "GROUPING_SETS"
+    WORKERS = "WORKERS"
     OUTPUT = "OUTPUT"
+
+    MODE_GROUP_BY, MODE_ROLLUP, MODE_SETS = 0, 1, 2
+    LEVEL_FIELD, SET_FIELD = "cap_nhom", "nhom"
     def tr(self, text):
         return QCoreApplication.translate('AggregateWithFilterUI', text)
     def name(self):
@@ -39,7 +53,16 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
             "   - Cú pháp: func(field) [AS alias], phân tách bằng dấu phẩy/ chấm phẩy\n"
             "   - Hỗ trợ: SUM, AVG, MIN, MAX, COUNT, COUNT_DISTINCT\n"
             "   - Ví dụ:  sum(dtich) as dtich_sum, sum(mgo) as mgo_sum, count(*) as n\n"
-            "• Điều kiện lọc dùng biểu thức QGIS (ví dụ: maldlr > 0 AND maldlr < 65)\n\n"
+            "• Điều kiện lọc dùng biểu thức QGIS (ví dụ: maldlr > 0 AND maldlr < 65)\n"
+            "• Nhiều cấp trong 1 lượt đọc dữ liệu:\n"
+            "   - ROLLUP: trường nhóm tinh, huyen, xa -> các cấp (tinh,huyen,xa), (tinh,huyen), (tinh), tổng chung\n"
+            "   - GROUPING SETS: tự khai báo, vd  tinh; tinh,huyen; ()   ('()' = tổng chung)\n"
+            "   - Như SQL, ở ROLLUP/GROUPING SETS tổng chung luôn có 1 dòng kể cả khi bộ lọc loại hết đối tượng\n"
+            "     (COUNT = 0, còn lại NULL); GROUP BY thường khi đó không ra dòng nào.\n"
+            "   - Kết quả là 1 bảng dài, thêm cột 'cap_nhom' (số trường nhóm của cấp) và 'nhom' (tên các trường);\n"
+            "     trường nhóm không thuộc cấp để NULL.\n"
+            "• Số luồng > 1 (0 = tự động): chia lớp theo đoạn FID, mỗi luồng đọc 1 bản sao lớp rồi gộp kết quả\n"
+            "   (GPKG/SHP/PostGIS...; lớp đang sửa chưa lưu hoặc chỉ đối tượng chọn -> chạy 1 luồng).\n\n"
             "Kết quả là bảng (no geometry). Các cột kết quả số giữ đúng precision theo trường nguồn."
         )
 
@@ -65,6 +88,20 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
             _tr("Điều kiện lọc (Biểu thức QGIS, để trống nếu không lọc)"),
             defaultValue="", optional=True
         ))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.GROUPING_MODE, _tr("Cấp tổng hợp"),
+            options=[_tr("GROUP BY thường"), _tr("ROLLUP theo thứ tự trường nhóm"), _tr("GROUPING SETS (tự khai báo)")],
+            defaultValue=self.MODE_GROUP_BY
+        ))
+        self.addParameter(QgsProcessingParameterString(
+            self.GROUPING_SETS,
+            _tr("GROUPING SETS (vd: tinh; tinh,huyen; ())"),
+            defaultValue="", optional=True
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.WORKERS, _tr("Số luồng đọc song song (0 = tự động, 1 = tuần tự)"),
+            type=QgsProcessingParameterNumber.Integer, minValue=0, maxValue=64, defaultValue=1
+        ))
         self.addParameter(QgsProcessingParameterFeatureSink(
             self.OUTPUT, _tr("Bảng kết quả"),
             type=QgsProcessing.TypeVector
@@ -104,6 +141,26 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
             aggs.append({"func": func, "field": field, "alias": alias})
         return aggs
 
+    def _parse_grouping_sets(self, text, group_field_names):
+        """'tinh; tinh,huyen; ()' -> [(vị trí trong group_field_names), ...]."""
+        lower = [n.lower() for n in group_field_names]
+        sets = []
+        for part in re.split(r";", text or ""):
+            part = part.strip()
+            if not part:
+                continue
+            names = [n.strip() for n in part.strip("()").split(",") if n.strip()]
+            pos = []
+            for n in names:
+                if n.lower() not in lower:
+                    raise QgsProcessingException(
+                        _tr("GROUPING SETS: trường '{}' phải nằm trong danh sách trường nhóm").format(n))
+                pos.append(lower.index(n.lower()))
+            sets.append(tuple(sorted(set(pos))))
+        if not sets:
+            raise QgsProcessingException(_tr("Chưa khai báo GROUPING SETS."))
+        return sets
+
     def processAlgorithm(self, parameters, context, feedback):
         src = self.parameterAsSource(parameters, self.INPUT, context)
         if src is None:
@@ -117,6 +174,16 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
         agg_list_str = self.parameterAsString(parameters, self.AGG_LIST, context)
         agg_specs = self._parse_agg_list(agg_list_str)
 
+        # Các cấp nhóm (vị trí trong danh sách trường nhóm); GROUP BY thường = 1 cấp đủ trường
+        mode = self.parameterAsEnum(parameters, self.GROUPING_MODE, context)
+        if mode == self.MODE_ROLLUP:
+            grouping_sets = rollup_sets(len(group_field_names))
+        elif mode == self.MODE_SETS:
+            grouping_sets = self._parse_grouping_sets(
+                self.parameterAsString(parameters, self.GROUPING_SETS, context), group_field_names)
+        else:
+            grouping_sets = [tuple(range(len(group_field_names)))]
+
         # Kiểm tra fields tồn tại, gom meta length/precision
         src_fields = src.fields()
 
@@ -141,6 +208,7 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
             if not (func == "count" and fld == "*"):
                 idx = _field_index(fld)
                 fdef = src_fields[idx]
+                spec["_idx"] = idx
                 spec["_src_type"] = fdef.type()
                 # lấy length/precision nếu có (tuỳ phiên bản)
                 try:
@@ -158,75 +226,104 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
                 # MIN/MAX: cho phép mọi kiểu; nếu số sẽ xuất double với precision nguồn,
                 # nếu không số sẽ giữ kiểu nguyên gốc.
 
-        # Biểu thức lọc
+        # Biểu thức lọc + chỉ lấy các cột cần (nhóm, tổng hợp, cột biểu thức dùng), bỏ hình học
         filter_expr = (self.parameterAsString(parameters, self.FILTER_EXPR, context) or "").strip()
-        request = QgsFeatureRequest(QgsExpression(filter_expr)) if filter_expr else QgsFeatureRequest()
-
-        # Chuẩn bị cấu trúc tích luỹ
-        groups = {}
-
-        def _init_acc(spec):
-            f = spec["func"]
-            if f in ("sum", "avg"):
-                return {"sum": 0.0, "count": 0}
-            if f in ("min", "max"):
-                return {"value": None}
-            if f == "count":
-                return {"count": 0}
-            if f == "count_distinct":
-                return {"set": set()}
-            return {}
-
-        def _update_acc(acc, spec, value):
-            f = spec["func"]
-            if f == "sum":
-                if value is not None:
-                    try:
-                        acc["sum"] += float(value)
-                        acc["count"] += 1
-                    except Exception:
-                        pass
-            elif f == "avg":
-                if value is not None:
-                    try:
-                        acc["sum"] += float(value)
-                        acc["count"] += 1
-                    except Exception:
-                        pass
-            elif f == "min":
-                # giữ chính value (để MIN của String, Date... hoạt động)
-                if value is not None and (acc["value"] is None or value < acc["value"]):
-                    acc["value"] = value
-            elif f == "max":
-                if value is not None and (acc["value"] is None or value > acc["value"]):
-                    acc["value"] = value
-            elif f == "count":
-                if spec["field"] == "*":
-                    acc["count"] += 1
-                else:
-                    if value is not None:
-                        acc["count"] += 1
-            elif f == "count_distinct":
-                if value is not None:
-                    acc["set"].add(value)
-
-        total = src.featureCount() or 1
-        for i, feat in enumerate(src.getFeatures(request), start=1):
-            if i % 1000 == 0:
-                feedback.setProgress(int(100.0 * i / total))
-
-            key = tuple(feat.attributes()[idx] for idx in group_idx) if group_idx else ()
-            if key not in groups:
-                groups[key] = {}
-                for spec in agg_specs:
-                    groups[key][(spec["func"], spec["field"])] = _init_acc(spec)
-
-            for spec in agg_specs:
-                if spec["func"] == "count" and spec["field"] == "*":
-                    val = None
+        # Phần điều kiện dịch được sang SQL -> subset string trên provider (GPKG/SHP/PostGIS...)
+        pushed, filter_expr = provider_filtered_layer(
+            self.parameterAsVectorLayer(parameters, self.INPUT, context), filter_expr,
+            parameters.get(self.INPUT), feedback)
+        if pushed is not None:
+            src = pushed
+        col_idx = list(dict.fromkeys(group_idx + [spec["_idx"] for spec in agg_specs if "_idx" in spec]))
+        request = attribute_request(src_fields, [src_fields[idx].name() for idx in col_idx], filter_expr)
+
+        # Đọc các cột cần vào list (không tra tên trường / dict theo từng đối tượng)
+        def _read_columns(features, total=None, fids=None):
+            columns = {idx: [] for idx in col_idx}
+            appends = [(idx, columns[idx].append) for idx in col_idx]
+            n_rows = 0
+            for i, feat in enumerate(features, start=1):
+                if i % 1000 == 0:
+                    if feedback.isCanceled():
+                        break
+                    if total:
+                        feedback.setProgress(int(90.0 * i / total))
+                attrs = feat.attributes()
+                for idx, append in appends:
+                    append(attrs[idx])
+                if fids is not None:
+                    fids.append(feat.id())
+                n_rows = i
+            if group_idx:
+                keys = list(zip(*(columns[idx] for idx in group_idx)))
+            else:
+                keys = [()] * n_rows
+            return columns, keys
+
+        agg_keys = {(spec["func"], spec["field"]): spec for spec in agg_specs}
+        funcs = {ak: spec["func"] for ak, spec in agg_keys.items()}
+
+        def _column(spec, columns):
+            return columns[spec["_idx"]] if "_idx" in spec else None
+
+        def _numeric(spec):
+            return _is_numeric_qvariant(spec.get("_src_type"))
+
+        n_group_fields = len(group_field_names)
+        full_set = tuple(range(n_group_fields))
+        workers = auto_workers(self.parameterAsInt(parameters, self.WORKERS, context))
+        par_layer = None
+        if workers > 1:
+            par_layer = clonable_layer(
+                src if pushed is not None else self.parameterAsVectorLayer(parameters, self.INPUT, context),
+                parameters.get(self.INPUT))
+            if par_layer is None:
+                feedback.pushInfo(_tr("Nguồn không đọc song song được (provider/lớp đang sửa/chỉ đối tượng chọn) — chạy 1 luồng."))
+
+        levels = []  # [(vị trí trường nhóm của cấp, khoá nhóm, {(func, field): kết quả})]
+        if par_layer is None:
+            # Mã hoá khoá nhóm (thứ tự xuất hiện đầu tiên) rồi tổng hợp vector hoá theo từng cột;
+            # mỗi cấp ROLLUP gom lại từ nhóm mịn nhất (không đọc lại dữ liệu)
+            columns, keys = _read_columns(src.getFeatures(request), total=src.featureCount() or 1)
+            codes, keys = factorize(keys)
+            for positions in grouping_sets:
+                if positions == full_set:
+                    level_codes, level_keys = codes, keys
                 else:
-                    val = feat[spec["field"]]
-                _update_acc(groups[key][(spec["func"], spec["field"])], spec, val)
+                    level_codes, level_keys = regroup(codes, keys, positions)
+                levels.append((positions, level_keys, {
+                    ak: group_aggregate(spec["func"], level_codes, len(level_keys),
+                                        _column(spec, columns), numeric=_numeric(spec))
+                    for ak, spec in agg_keys.items()}))
+        else:
+            # Mỗi luồng: 1 đoạn FID -> trạng thái gộp được theo nhóm; gộp lại, nhóm sắp theo FID nhỏ nhất
+            def _scan_chunk(features):
+                fids = []
+                columns, keys = _read_columns(features, fids=fids)
+                codes, keys = factorize(keys)
+                return keys, first_positions(codes, len(keys), fids), {
+                    ak: group_partial(spec["func"], codes, len(keys), _column(spec, columns), numeric=_numeric(spec))
+                    for ak, spec in agg_keys.items()}
+
+            chunks = parallel_scan(par_layer, [src_fields[idx].name() for idx in col_idx], filter_expr,
+                                   workers, _scan_chunk, feedback)
+            if chunks:
+                keys, first, states = merge_chunks(chunks, funcs)
+                for positions in grouping_sets:
+                    if positions == full_set:
+                        level_keys, level_states = keys, states
+                    else:
+                        level_keys, _, level_states = merge_chunks(
+                            [([tuple(k[p] for p in positions) for k in keys], first, states)], funcs)
+                    levels.append((positions, level_keys,
+                                   {ak: finalize_partial(funcs[ak], level_states[ak]) for ak in funcs}))
+
+        # ROLLUP/GROUPING SETS không còn đối tượng nào sau lọc: như SQL, tập () vẫn ra 1 dòng tổng chung
+        # (COUNT = 0, hàm khác NULL); GROUP BY thường không ra dòng nào, bị huỷ thì không ghi dòng giả
+        if (mode != self.MODE_GROUP_BY and not feedback.isCanceled()
+                and not any(level_keys for _, level_keys, _ in levels)):
+            empty = {ak: [0 if func in ("count", "count_distinct") else None] for ak, func in funcs.items()}
+            levels = [(positions, [()] if not positions else [], empty) for positions in grouping_sets]
 
         # ====== Xây schema output: precision theo field nguồn ======
         out_fields = QgsFields()
@@ -282,6 +379,13 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
 
             agg_out_defs.append((spec, out_fields.indexFromName(name)))
 
+        multi_level = mode != self.MODE_GROUP_BY
+        if multi_level:
+            for name, vtype in ((self.LEVEL_FIELD, QVariant.Int), (self.SET_FIELD, QVariant.String)):
+                if out_fields.indexFromName(name) >= 0:
+                    raise QgsProcessingException(_tr("Trùng tên cột '{}' với cột cấp nhóm").format(name))
+                out_fields.append(QgsField(name, vtype, len=254 if vtype == QVariant.String else 0))
+
         # Tạo sink (bảng, NoGeometry)
         sink, sink_id = self.parameterAsSink(
             parameters, self.OUTPUT, context,
@@ -291,34 +395,23 @@ class AggregateWithFilter(QgsProcessingAlgorithm):
         if sink is None:
             raise QgsProcessingException(_tr("Không tạo được bảng đầu ra"))
 
-        # Tính giá trị cuối cùng theo accumulator
-        def _final_value(spec, acc):
-            f = spec["func"]
-            if f == "sum":
-                return acc["sum"]
-            if f == "avg":
-                return (acc["sum"] / acc["count"]) if acc["count"] > 0 else None
-            if f in ("min", "max"):
-                return acc["value"]
-            if f == "count":
-                return acc["count"]
-            if f == "count_distinct":
-                return len(acc["set"])
-            return None
-
         # Ghi kết quả
-        for key, accs in groups.items():
-            out_feat = QgsFeature(out_fields)
-            attrs = []
-            # nhóm
-            if key:
-                attrs.extend(list(key))
-            # tổng hợp
-            for spec, out_idx in agg_out_defs:
-                val = _final_value(spec, accs[(spec["func"], spec["field"])])
-                attrs.append(val)
-
-            out_feat.setAttributes(attrs)
-            sink.addFeature(out_feat)
+        for positions, level_keys, results in levels:
+            agg_cols = [results[(spec["func"], spec["field"])] for spec, _ in agg_out_defs]
+            set_label = ",".join(group_field_names[p] for p in positions) or "()"
+            for gi, key in enumerate(level_keys):
+                out_feat = QgsFeature(out_fields)
+                if multi_level:
+                    attrs = [None] * n_group_fields
+                    for p, v in zip(positions, key):
+                        attrs[p] = v
+                else:
+                    attrs = list(key)
+                attrs.extend(col[gi] for col in agg_cols)
+                if multi_level:
+                    attrs.extend((len(positions), set_label))
+                out_feat.setAttributes(attrs)
+                sink.addFeature(out_feat)
+        feedback.setProgress(100)
 
         return {self.OUTPUT: sink_id}
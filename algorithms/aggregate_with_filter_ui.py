@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
+from array import array
+
 from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm,
     QgsProcessingParameterFeatureSource, QgsProcessingParameterField,
     QgsProcessingParameterString, QgsProcessingParameterFeatureSink,
     QgsProcessingParameterBoolean, QgsProcessingParameterEnum,
+    QgsProcessingParameterNumber,
     QgsProcessingException,
     QgsFields, QgsField, QgsFeature, QgsCoordinateReferenceSystem,
-    QgsFeatureRequest, QgsExpression, QgsWkbTypes
+    QgsWkbTypes
 )
 
+from ..aggregate_utils import QuantileSketch, quantile
+from ..request_utils import attribute_request, auto_workers, clonable_layer, parallel_scan
+
 def _tr(s):
     return QCoreApplication.translate("AggregateWithFilterUI", s)
 
@@ -21,12 +27,21 @@ AGG_FUNCS = [
     "SUM", "AVG", "MIN", "MAX",
     "STDDEV", "VARIANCE", "MEDIAN",
     "COUNT", "COUNT_DISTINCT",
+    "P10", "P25", "P75", "P90",
 ]
 
+# Hàm phân vị -> q
+QUANTILES = {"median": 0.5, "p10": 0.1, "p25": 0.25, "p75": 0.75, "p90": 0.9}
+
+QUANTILE_EXACT, QUANTILE_SKETCH = 0, 1
+
 class AggregateWithFilterUI(QgsProcessingAlgorithm):
     INPUT = "INPUT"
     GROUP_FIELDS = "GROUP_FIELDS"
     FILTER_EXPR = "FILTER_EXPR"
+    QUANTILE_MODE = "QUANTILE_MODE"
+    QUANTILE_EPS = "QUANTILE_EPS"
+    WORKERS = "WORKERS"
     OUTPUT = "OUTPUT"
     def tr(self, text):
         return QCoreApplication.translate('AggregateWithFilterUI', text)
@@ -49,7 +64,12 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
             "• Với mỗi dòng: Bật, chọn HÀM, chọn TRƯỜNG, đặt ALIAS\n"
             "  - COUNT có thể để trống trường để thực hiện COUNT(*)\n"
             "• Điều kiện lọc là biểu thức QGIS (ví dụ: maldlr > 0 AND maldlr < 65)\n"
-            "• Với các phép số (SUM/AVG/MIN/MAX/STDDEV/VARIANCE/MEDIAN), số thập phân của cột kết quả = precision của trường nguồn.\n"
+            "• Với các phép số (SUM/AVG/MIN/MAX/STDDEV/VARIANCE/MEDIAN/Pxx), số thập phân của cột kết quả = precision của trường nguồn.\n"
+            "• MEDIAN, P10/P25/P75/P90 (nội suy tuyến tính):\n"
+            "  - Chính xác: lưu giá trị dạng mảng số thực gọn (8 byte/giá trị).\n"
+            "  - Xấp xỉ (sketch KLL): bộ nhớ cố định mỗi nhóm, sai số hạng ≈ 'Sai số phân vị' (vd 0.01 = ±1% hạng).\n"
+            "• Số luồng > 1 (0 = tự động): chia lớp theo đoạn FID, mỗi luồng đọc 1 bản sao lớp, kết quả từng luồng\n"
+            "  được gộp (SUM/COUNT cộng, MIN/MAX so sánh, COUNT_DISTINCT hợp tập, STDDEV/VARIANCE gộp Welford).\n"
             "Kết quả là bảng (NoGeometry). Tương thích QGIS 3.16 trở lên."
         )
     def createInstance(self): return AggregateWithFilterUI()
@@ -68,6 +88,21 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
             defaultValue="", optional=True
         ))
 
+        self.addParameter(QgsProcessingParameterEnum(
+            self.QUANTILE_MODE, _tr("Cách tính MEDIAN / phân vị"),
+            options=[_tr("Chính xác"), _tr("Xấp xỉ (sketch, bộ nhớ giới hạn)")],
+            defaultValue=QUANTILE_EXACT
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.QUANTILE_EPS, _tr("Sai số phân vị khi xấp xỉ (theo hạng, 0.01 = 1%)"),
+            type=QgsProcessingParameterNumber.Double,
+            minValue=0.0005, maxValue=0.2, defaultValue=0.01
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.WORKERS, _tr("Số luồng đọc song song (0 = tự động, 1 = tuần tự)"),
+            type=QgsProcessingParameterNumber.Integer, minValue=0, maxValue=64, defaultValue=1
+        ))
+
         # Các slot tổng hợp
         for i in range(1, MAX_SLOTS + 1):
             self.addParameter(QgsProcessingParameterBoolean(
@@ -124,7 +159,7 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
                 field_val = field_name
 
                 # Các hàm số yêu cầu trường số
-                needs_numeric = func in ("sum", "avg", "min", "max", "stddev", "variance", "median")
+                needs_numeric = func in ("sum", "avg", "min", "max", "stddev", "variance") or func in QUANTILES
                 if needs_numeric and vtype not in (QVariant.Int, QVariant.Double):
                     raise QgsProcessingException(_tr(f"Dòng [{i}] – hàm {func.upper()} yêu cầu trường số: {field_name}"))
 
@@ -156,10 +191,22 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
 
         # Filter
         filter_expr = (self.parameterAsString(parameters, self.FILTER_EXPR, context) or "").strip()
-        request = QgsFeatureRequest(QgsExpression(filter_expr)) if filter_expr else QgsFeatureRequest()
+        need_names = group_field_names + [spec["field"] for spec in agg_specs if spec["field"] != "*"]
+        request = attribute_request(src_fields, need_names, filter_expr)
+
+        # Phân vị: chính xác (array('d')) hoặc sketch KLL
+        q_sketch = self.parameterAsEnum(parameters, self.QUANTILE_MODE, context) == QUANTILE_SKETCH
+        q_eps = self.parameterAsDouble(parameters, self.QUANTILE_EPS, context)
 
-        # Tích luỹ theo nhóm
-        groups = {}
+        # Tích luỹ theo nhóm; MEDIAN/Pxx cùng trường dùng chung 1 bộ giá trị
+        def _acc_key(spec):
+            if spec["func"] in QUANTILES:
+                return ("quantile", spec["field"])
+            return (spec["func"], spec["field"])
+
+        acc_specs = {}
+        for spec in agg_specs:
+            acc_specs.setdefault(_acc_key(spec), spec)
 
         # Khởi tạo accumulator theo hàm
         def _init_acc(spec):
@@ -174,8 +221,10 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
                 return {"set": set()}
             if f in ("stddev", "variance"):
                 return {"n": 0, "mean": 0.0, "M2": 0.0}
-            if f == "median":
-                return {"values": []}  # cần danh sách để tính trung vị
+            if f in QUANTILES:
+                if q_sketch:
+                    return {"sketch": QuantileSketch(q_eps)}
+                return {"values": array("d")}
             return {}
 
         def _update_welford(acc, x):
@@ -229,30 +278,99 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
                         _update_welford(acc, x)
                     except Exception:
                         pass
-            elif f == "median":
+            elif f in QUANTILES:
                 if value is not None:
                     try:
                         x = float(value)
-                        acc["values"].append(x)
                     except Exception:
-                        pass
+                        return
+                    if q_sketch:
+                        acc["sketch"].add(x)
+                    else:
+                        acc["values"].append(x)
 
-        total = src.featureCount() or 1
-        for i, feat in enumerate(src.getFeatures(request), start=1):
-            if i % 1000 == 0:
-                feedback.setProgress(int(100.0 * i / total))
-            key = tuple(feat.attributes()[idx] for idx in group_idx) if group_idx else ()
-            if key not in groups:
-                groups[key] = {}
-                for spec in agg_specs:
-                    groups[key][(spec["func"], spec["field"])] = _init_acc(spec)
-
-            for spec in agg_specs:
-                if spec["func"] == "count" and spec["field"] == "*":
-                    val = None
+        def _merge_acc(acc, other, spec):
+            # Gộp accumulator của 2 phân đoạn
+            f = spec["func"]
+            if f in ("sum", "avg"):
+                acc["sum"] += other["sum"]
+                acc["count"] += other["count"]
+            elif f in ("min", "max"):
+                v = other["value"]
+                if v is not None and (acc["value"] is None or (v < acc["value"] if f == "min" else v > acc["value"])):
+                    acc["value"] = v
+            elif f == "count":
+                acc["count"] += other["count"]
+            elif f == "count_distinct":
+                acc["set"] |= other["set"]
+            elif f in ("stddev", "variance"):
+                # Welford song song (Chan và cs.)
+                na, nb = acc["n"], other["n"]
+                if nb:
+                    n = na + nb
+                    delta = other["mean"] - acc["mean"]
+                    acc["mean"] += delta * nb / n
+                    acc["M2"] += other["M2"] + delta * delta * na * nb / n
+                    acc["n"] = n
+            elif f in QUANTILES:
+                if q_sketch:
+                    acc["sketch"].merge(other["sketch"])
                 else:
-                    val = feat[spec["field"]]
-                _update_acc(groups[key][(spec["func"], spec["field"])], spec, val)
+                    acc["values"].extend(other["values"])
+
+        def _scan(features, total=None, firsts=None):
+            groups = {}
+            for i, feat in enumerate(features, start=1):
+                if i % 1000 == 0:
+                    if feedback.isCanceled():
+                        break
+                    if total:
+                        feedback.setProgress(int(100.0 * i / total))
+                key = tuple(feat.attributes()[idx] for idx in group_idx) if group_idx else ()
+                if key not in groups:
+                    groups[key] = {}
+                    for acc_key, spec in acc_specs.items():
+                        groups[key][acc_key] = _init_acc(spec)
+                    if firsts is not None:
+                        firsts[key] = feat.id()
+                elif firsts is not None and feat.id() < firsts[key]:
+                    firsts[key] = feat.id()
+
+                for acc_key, spec in acc_specs.items():
+                    if spec["func"] == "count" and spec["field"] == "*":
+                        val = None
+                    else:
+                        val = feat[spec["field"]]
+                    _update_acc(groups[key][acc_key], spec, val)
+            return groups
+
+        workers = auto_workers(self.parameterAsInt(parameters, self.WORKERS, context))
+        par_layer = None
+        if workers > 1:
+            par_layer = clonable_layer(
+                self.parameterAsVectorLayer(parameters, self.INPUT, context), parameters.get(self.INPUT))
+            if par_layer is None:
+                feedback.pushInfo(_tr("Nguồn không đọc song song được (provider/lớp đang sửa/chỉ đối tượng chọn) — chạy 1 luồng."))
+
+        if par_layer is None:
+            groups = _scan(src.getFeatures(request), total=src.featureCount() or 1)
+        else:
+            # Mỗi luồng 1 đoạn FID -> accumulator riêng; gộp lại, nhóm sắp theo FID nhỏ nhất
+            def _scan_chunk(features):
+                firsts = {}
+                return _scan(features, firsts=firsts), firsts
+
+            groups, firsts = {}, {}
+            for part, part_firsts in parallel_scan(par_layer, need_names, filter_expr, workers, _scan_chunk, feedback):
+                for key, accs in part.items():
+                    if key not in groups:
+                        groups[key] = accs
+                        firsts[key] = part_firsts[key]
+                        continue
+                    for acc_key, spec in acc_specs.items():
+                        _merge_acc(groups[key][acc_key], accs[acc_key], spec)
+                    firsts[key] = min(firsts[key], part_firsts[key])
+            groups = {key: groups[key] for key in sorted(groups, key=firsts.__getitem__)}
 
         # ==== Xây schema output: cột nhóm + cột tổng hợp (precision khớp field nguồn) ====
         out_fields = QgsFields()
@@ -314,17 +432,11 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
                     return None
                 var_sample = acc["M2"] / (n - 1)  # phương sai mẫu
                 return (var_sample ** 0.5) if f == "stddev" else var_sample
-            if f == "median":
-                vals = acc["values"]
-                if not vals:
-                    return None
-                vals.sort()
-                m = len(vals)
-                mid = m // 2
-                if m % 2 == 1:
-                    return vals[mid]
-                else:
-                    return (vals[mid - 1] + vals[mid]) / 2.0
+            if f in QUANTILES:
+                # chọn phần tử (partition) thay vì sắp xếp cả danh sách
+                if q_sketch:
+                    return acc["sketch"].quantile(QUANTILES[f])
+                return quantile(acc["values"], QUANTILES[f])
             return None
 
         for key, accs in groups.items():
@@ -335,7 +447,7 @@ class AggregateWithFilterUI(QgsProcessingAlgorithm):
                 attrs.extend(list(key))
             # tổng hợp
             for spec, col_idx in agg_out_defs:
-                val = _final_value(spec, accs[(spec["func"], spec["field"])])
+                val = _final_value(spec, accs[_acc_key(spec)])
                 attrs.append(val)
             out_feat.setAttributes(attrs)
             sink.addFeature(out_feat)
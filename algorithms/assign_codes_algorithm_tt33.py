@@ -7,6 +7,8 @@ from qgis.core import (
     QgsVectorLayer, QgsFields, QgsField, QgsFeature, QgsCoordinateReferenceSystem
 )
 
+from ..request_utils import attribute_request
+
 def _tr(text):
     return QCoreApplication.translate("AssignCodesAlgorithm33", text)
 
@@ -190,7 +192,7 @@ class AssignCodesAlgorithm33(QgsProcessingAlgorithm):
 
             changes = {}
             total = src.featureCount() or 1
-            for i, f in enumerate(in_layer.getFeatures(), start=1):
+            for i, f in enumerate(in_layer.getFeatures(attribute_request(in_layer.fields(), [fld_ldlr, fld_maldlr, fld_nggocr])), start=1):
                 if i % 500 == 0:
                     feedback.setProgress(int(100.0 * i / total))
 
@@ -7,6 +7,8 @@ from qgis.core import (
     QgsVectorLayer, QgsFields, QgsField, QgsFeature, QgsCoordinateReferenceSystem
 )
 
+from ..request_utils import attribute_request
+
 def _tr(text):
     return QCoreApplication.translate("AssignFromMaldlrAlgorithm33", text)
 
@@ -169,7 +171,7 @@ class AssignFromMaldlrAlgorithm33(QgsProcessingAlgorithm):
             BATCH_SIZE = 5000  # tối ưu RAM: đẩy định kỳ theo lô
             total = src.featureCount() or 1
 
-            for i, f in enumerate(in_layer.getFeatures(), start=1):
+            for i, f in enumerate(in_layer.getFeatures(attribute_request(in_layer.fields(), [fld_maldlr, fld_ldlr, fld_nggocr])), start=1):
                 if i % 500 == 0:
                     feedback.setProgress(int(100.0 * i / total))
 
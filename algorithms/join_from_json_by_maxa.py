@@ -9,6 +9,8 @@ from qgis.core import (
     QgsVectorLayer, QgsFields, QgsField, QgsFeature, QgsCoordinateReferenceSystem
 )
 
+from ..request_utils import attribute_request
+
 def _tr(s):
     return QCoreApplication.translate("JoinFromJsonByMaxa", s)
 
@@ -240,7 +242,9 @@ class JoinFromJsonByMaxa(QgsProcessingAlgorithm):
             total = src.featureCount()
             done = 0
 
-            for f in in_layer.getFeatures():
+            request = attribute_request(
+                fields, [fld_maxa, fld_matinhmoi, fld_tinhmoi, fld_maxamoi, fld_xamoi])
+            for f in in_layer.getFeatures(request):
                 done += 1
                 if done % 500 == 0:
                     feedback.setProgress(int(100.0 * done / max(1, total)))
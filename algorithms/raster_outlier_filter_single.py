@@ -4,12 +4,13 @@ from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm,
     QgsProcessingParameterRasterLayer, QgsProcessingParameterRasterDestination,
     QgsProcessingParameterNumber, QgsProcessingParameterEnum,
-    QgsProcessingParameterBoolean, QgsProcessingException
+    QgsProcessingParameterBoolean, QgsProcessingParameterFileDestination, QgsProcessingOutputNumber,
+    QgsProcessingException
 )
-import numpy as np
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from osgeo import gdal
 
+from ..outlier_utils import run_filter
+
 def _tr(s):
     return QCoreApplication.translate("RasterOutlierFilterSingle", s)
 
@@ -19,20 +20,44 @@ class RasterOutlierFilterSingle(QgsProcessingAlgorithm):
     METHOD = "METHOD"
     THRESHOLD = "THRESHOLD"
     WINDOW = "WINDOW"
+    MAX_ITERATIONS = "MAX_ITERATIONS"
     MARK_ONLY = "MARK_ONLY"
     USE_BAND_NODATA = "USE_BAND_NODATA"
     TILE_SIZE = "TILE_SIZE"
+    TILE_MODE = "TILE_MODE"
     COMPRESSION = "COMPRESSION"
     BIGTIFF = "BIGTIFF"
     OUTPUT_DTYPE = "OUTPUT_DTYPE"
+    OUTPUT_FORMAT = "OUTPUT_FORMAT"
+    BUILD_OVERVIEWS = "BUILD_OVERVIEWS"
+    REPORT = "REPORT"
+    OUTLIER_COUNT = "OUTLIER_COUNT"
+    VALID_COUNT = "VALID_COUNT"
+    NODATA_COUNT = "NODATA_COUNT"
+    EXECUTOR = "EXECUTOR"
+    MAX_TILES = "MAX_TILES"
 
     METHODS = [
         _tr("Mean"),     # 0
         _tr("Median"),     # 1
         _tr("Nearest Neighbor")    # 2
     ]
+    FORMAT_OPTS = [
+        _tr("GeoTIFF (tiled)"),
+        _tr("COG (Cloud Optimized GeoTIFF)"),
+        _tr("VRT ghép các tile GeoTIFF")
+    ]
     COMPRESSION_OPTS = ["LZW", "DEFLATE", "NONE", "PACKBITS"]
     BIGTIFF_OPTS = ["AUTO", "YES", "NO"]
+    TILE_MODE_OPTS = [
+        _tr("Tự động (bội số block nguồn, ~TILE_SIZE)"),
+        _tr("Cố định (TILE_SIZE × TILE_SIZE)")
+    ]
+    EXECUTOR_OPTS = [
+        _tr("Tự động"),
+        _tr("Đa luồng (threads)"),
+        _tr("Đa tiến trình (processes, shared memory)")
+    ]
 
     # Output dtype options
     DTYPE_OPTS = [
@@ -65,14 +90,27 @@ class RasterOutlierFilterSingle(QgsProcessingAlgorithm):
             "    - Pixel hợp lệ gần Mean nhất: Thay thế outlier bằng pixel hợp lệ gần nhất theo giá trị trung bình.\n"
             "• THRESHOLD (Ngưỡng sigma): Hệ số k; pixel được coi là outlier nếu lệch quá k lần độ lệch chuẩn.\n"
             "• WINDOW: Kích thước cửa sổ lọc (số lẻ ≥ 3), ví dụ 3 = cửa sổ 3x3, 5 = 5x5.\n"
+            "• MAX_ITERATIONS: Lặp phát hiện/thay thế ngay trong bộ nhớ của tile (viền đọc rộng thêm theo số vòng) "
+            "tới khi không còn pixel đổi — xử lý cụm spike (DEM SRTM/NASADEM vùng karst) mà không phải chạy lại cả file.\n"
             "• MARK_ONLY: Nếu chọn True → chỉ tạo raster mặt nạ (0 = bình thường, 1 = outlier), kiểu Byte.\n"
             "• USE_BAND_NODATA: Có tôn trọng giá trị NoData gốc của band hay không.\n"
             "• TILE_SIZE: Kích thước block xử lý (px). Raster lớn sẽ được chia thành nhiều tile, mặc định 2048.\n"
+            "• TILE_MODE: Tự động → tile là bội số block nội bộ của file nguồn (~TILE_SIZE), duyệt tile kề nhau "
+            "và đặt GDAL_CACHEMAX đủ giữ block viền; Cố định → TILE_SIZE × TILE_SIZE.\n"
             "• COMPRESSION: Kiểu nén GeoTIFF đầu ra (LZW, DEFLATE, NONE, PACKBITS).\n"
             "• BIGTIFF: Tùy chọn BigTIFF (AUTO, YES, NO) – cần thiết khi file > 4 GB.\n"
             "• OUTPUT_DTYPE: Kiểu dữ liệu đầu ra:\n"
             "    - Giữ nguyên theo band vào (mặc định), hoặc ép về Byte, UInt16, Int16, UInt32, Int32, Float32, Float64.\n"
-            "    - Nếu MARK_ONLY bật, luôn xuất Byte.\n\n"
+            "    - Nếu MARK_ONLY bật, luôn xuất Byte.\n"
+            "• OUTPUT_FORMAT: GeoTIFF tiled / COG / VRT ghép các file tile (thư mục <tên>_tiles). Nén dùng "
+            "NUM_THREADS=ALL_CPUS; BUILD_OVERVIEWS (mặc định tắt) dựng pyramid đa luồng ngay sau khi ghi → mở nhanh qua mạng, "
+            "không cần chạy gdaladdo.\n"
+            "• REPORT: File JSON/CSV thống kê theo tile & band (hợp lệ, NoData, outlier) và histogram |z| "
+            "để chọn THRESHOLD chỉ từ 1 lượt chạy; tổng số pixel cũng trả về làm output.\n"
+            "• EXECUTOR: Tự động / đa luồng / đa tiến trình. Đa tiến trình tránh GIL (median, np.where…): "
+            "mỗi tiến trình tự mở dataset, kết quả tile trả về qua shared memory (Python ≥ 3.8).\n"
+            "• MAX_TILES: Số tile tối đa giữ trong bộ nhớ cùng lúc (0 = 2×số worker); tile xong được "
+            "một luồng ghi riêng ghi ngay (write-behind), bộ nhớ không phụ thuộc kích thước raster.\n\n"
             "✅ Thuật toán chạy theo tile + đa luồng → xử lý nhanh và ổn định cho raster lớn.\n"
             "✅ Đảm bảo tôn trọng NoData; hỗ trợ BigTIFF và các kiểu nén GeoTIFF chuẩn."
         )
@@ -98,6 +136,10 @@ class RasterOutlierFilterSingle(QgsProcessingAlgorithm):
             self.WINDOW, _tr("Kích thước cửa sổ (lẻ ≥ 3)"),
             type=QgsProcessingParameterNumber.Integer, defaultValue=3, minValue=3
         ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.MAX_ITERATIONS, _tr("Số vòng lặp tối đa (dừng sớm khi không còn pixel đổi)"),
+            type=QgsProcessingParameterNumber.Integer, defaultValue=1, minValue=1, maxValue=20
+        ))
         self.addParameter(QgsProcessingParameterBoolean(
             self.MARK_ONLY, _tr("Chỉ tạo mặt nạ (0/1)"), defaultValue=False
         ))
@@ -108,6 +150,10 @@ class RasterOutlierFilterSingle(QgsProcessingAlgorithm):
             self.TILE_SIZE, _tr("Kích thước TILE (px)"),
             type=QgsProcessingParameterNumber.Integer, defaultValue=2048, minValue=512
         ))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.TILE_MODE, _tr("Chia tile"),
+            options=self.TILE_MODE_OPTS, defaultValue=0  # Auto
+        ))
         self.addParameter(QgsProcessingParameterEnum(
             self.COMPRESSION, _tr("Nén GeoTIFF"),
             options=self.COMPRESSION_OPTS, defaultValue=0  # LZW
@@ -120,142 +166,28 @@ class RasterOutlierFilterSingle(QgsProcessingAlgorithm):
             self.OUTPUT_DTYPE, _tr("Kiểu dữ liệu đầu ra"),
             options=self.DTYPE_OPTS, defaultValue=0  # Keep input
         ))
-
-    # ---------- dtype helpers ----------
-    @staticmethod
-    def _dtype_range(gdal_type):
-        if gdal_type == gdal.GDT_Byte:   return (0, 255, True)
-        if gdal_type == gdal.GDT_UInt16: return (0, 65535, True)
-        if gdal_type == gdal.GDT_Int16:  return (-32768, 32767, True)
-        if gdal_type == gdal.GDT_UInt32: return (0, 4294967295, True)
-        if gdal_type == gdal.GDT_Int32:  return (-2147483648, 2147483647, True)
-        if gdal_type == gdal.GDT_Float32:return (np.finfo(np.float32).min, np.finfo(np.float32).max, False)
-        if gdal_type == gdal.GDT_Float64:return (np.finfo(np.float64).min, np.finfo(np.float64).max, False)
-        return (np.finfo(np.float32).min, np.finfo(np.float32).max, False)
-
-    # ---------- local filters ----------
-    @staticmethod
-    def _mean_std_excluding_center(arr_f32, win):
-        # import nội bộ để tránh load SciPy khi không dùng method này
-        from scipy.ndimage import uniform_filter
-        valid = np.isfinite(arr_f32).astype(np.float32)
-        safe  = np.where(np.isfinite(arr_f32), arr_f32, 0.0).astype(np.float32)
-
-        sum_win = uniform_filter(safe,  size=win, mode="nearest") * (win * win)
-        cnt_win = uniform_filter(valid, size=win, mode="nearest") * (win * win)
-
-        center_val   = np.where(np.isfinite(arr_f32), arr_f32, 0.0)
-        center_count = np.isfinite(arr_f32).astype(np.float32)
-
-        sum_nb = sum_win - center_val
-        cnt_nb = np.maximum(cnt_win - center_count, 0.0)
-
-        with np.errstate(divide="ignore", invalid="ignore"):
-            mean_nb = np.where(cnt_nb > 0, sum_nb / cnt_nb, np.nan).astype(np.float32)
-
-        sum2_win = uniform_filter(safe * safe, size=win, mode="nearest") * (win * win)
-        sum2_nb  = sum2_win - (center_val * center_val)
-
-        with np.errstate(divide="ignore", invalid="ignore"):
-            ex2 = np.where(cnt_nb > 0, sum2_nb / cnt_nb, np.nan)
-            var = ex2 - (mean_nb.astype(np.float64) ** 2)
-        var = np.where(cnt_nb > 0, np.maximum(var, 0.0), np.nan)
-        std_nb = np.sqrt(var, dtype=np.float64).astype(np.float32)
-        return mean_nb, std_nb
-
-    @staticmethod
-    def _median_tile(arr_f32, win):
-        from scipy.ndimage import median_filter
-        valid = np.isfinite(arr_f32)
-        filled = np.where(valid, arr_f32, 0.0).astype(np.float32)
-        med = median_filter(filled, size=win, mode="nearest")
-        return med.astype(np.float32)
-
-    @staticmethod
-    def _nearest_replace(arr_f32, mask_out):
-        from scipy.ndimage import distance_transform_edt
-        invalid = np.isnan(arr_f32)
-        temp_invalid = invalid | mask_out
-        _, inds = distance_transform_edt(temp_invalid, return_indices=True)
-        repl = arr_f32[tuple(inds)]
-        out = arr_f32.copy()
-        out[mask_out] = repl[mask_out]
-        return out
-
-    # ---------- worker ----------
-    def _process_tile(self, src_path, band_index, xoff, yoff, xsize, ysize, pad, method, thr, win, nodata, mark_only):
-        rxoff = max(0, xoff - pad)
-        ryoff = max(0, yoff - pad)
-
-        ds_local = gdal.Open(src_path, gdal.GA_ReadOnly)
-        if ds_local is None:
-            raise RuntimeError("GDAL Open failed in worker")
-        try:
-            band = ds_local.GetRasterBand(band_index)
-            rxend = min(band.XSize, xoff + xsize + pad)
-            ryend = min(band.YSize, yoff + ysize + pad)
-            rxs = rxend - rxoff
-            rys = ryend - ryoff
-
-            # đọc mảng (1 lần retry nếu lỗi IO)
-            for attempt in range(2):
-                try:
-                    arr = band.ReadAsArray(rxoff, ryoff, rxs, rys)
-                    if arr is None:
-                        raise RuntimeError("ReadAsArray returned None")
-                    arr = arr.astype(np.float32, copy=False)
-                    break
-                except Exception:
-                    if attempt == 0:
-                        continue
-                    raise
-
-            if nodata is not None:
-                arr[arr == nodata] = np.nan
-
-            if method == 0:  # mean
-                mean_nb, std_nb = self._mean_std_excluding_center(arr, win)
-                center = arr
-                std_ok = np.isfinite(std_nb) & (std_nb > 0)
-                mask_out = np.isfinite(center) & std_ok & (np.abs(center - mean_nb) > thr * std_nb)
-                if mark_only:
-                    filt = mask_out.astype(np.uint8)
-                else:
-                    filt = arr.copy()
-                    filt[mask_out] = mean_nb[mask_out]
-
-            elif method == 1:  # median
-                med = self._median_tile(arr, win)
-                mean_nb, std_nb = self._mean_std_excluding_center(arr, win)
-                center = arr
-                std_ok = np.isfinite(std_nb) & (std_nb > 0)
-                mask_out = np.isfinite(center) & std_ok & (np.abs(center - mean_nb) > thr * std_nb)
-                if mark_only:
-                    filt = mask_out.astype(np.uint8)
-                else:
-                    filt = arr.copy()
-                    filt[mask_out] = med[mask_out]
-
-            else:  # nearest
-                mean_nb, std_nb = self._mean_std_excluding_center(arr, win)
-                center = arr
-                std_ok = np.isfinite(std_nb) & (std_nb > 0)
-                mask_out = np.isfinite(center) & std_ok & (np.abs(center - mean_nb) > thr * std_nb)
-                if mark_only:
-                    filt = mask_out.astype(np.uint8)
-                else:
-                    filt = self._nearest_replace(arr, mask_out)
-
-            # cắt pad về kích thước tile gốc
-            top = pad if ryoff < yoff else 0
-            left = pad if rxoff < xoff else 0
-            bottom = filt.shape[0] - pad if (ryoff + filt.shape[0]) > (yoff + ysize) else filt.shape[0]
-            right  = filt.shape[1] - pad if (rxoff + filt.shape[1]) > (xoff + xsize) else filt.shape[1]
-            out_tile = filt[top:bottom, left:right]
-            return (xoff, yoff, out_tile)
-
-        finally:
-            ds_local = None
+        self.addParameter(QgsProcessingParameterEnum(
+            self.OUTPUT_FORMAT, _tr("Định dạng đầu ra"),
+            options=self.FORMAT_OPTS, defaultValue=0  # GTiff
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.BUILD_OVERVIEWS, _tr("Dựng overview (pyramid) ngay sau khi ghi"), defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.EXECUTOR, _tr("Chế độ song song"),
+            options=self.EXECUTOR_OPTS, defaultValue=0  # Auto
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.MAX_TILES, _tr("Số tile tối đa giữ trong bộ nhớ (0 = 2×số worker)"),
+            type=QgsProcessingParameterNumber.Integer, defaultValue=0, minValue=0
+        ))
+        self.addParameter(QgsProcessingParameterFileDestination(
+            self.REPORT, _tr("Báo cáo outlier (JSON/CSV)"),
+            fileFilter="JSON (*.json);;CSV (*.csv)", optional=True, createByDefault=False
+        ))
+        self.addOutput(QgsProcessingOutputNumber(self.OUTLIER_COUNT, _tr("Số pixel outlier")))
+        self.addOutput(QgsProcessingOutputNumber(self.VALID_COUNT, _tr("Số pixel hợp lệ")))
+        self.addOutput(QgsProcessingOutputNumber(self.NODATA_COUNT, _tr("Số pixel NoData")))
 
     def processAlgorithm(self, parameters, context, feedback):
         gdal.UseExceptions()
@@ -275,111 +207,43 @@ class RasterOutlierFilterSingle(QgsProcessingAlgorithm):
             # Cho phép chạy trên band 1, nhưng cảnh báo người dùng
             feedback.pushInfo(_tr("Cảnh báo: Raster nhiều band, thuật toán sẽ xử lý band 1."))
 
-        band_index = 1  # đơn band → band 1
+        band_indices = [1]  # đơn band → band 1
         method = self.parameterAsEnum(parameters, self.METHOD, context)
         thr = self.parameterAsDouble(parameters, self.THRESHOLD, context)
         win = self.parameterAsInt(parameters, self.WINDOW, context)
         if win % 2 == 0: win += 1
-        pad = win // 2
+        max_iter = self.parameterAsInt(parameters, self.MAX_ITERATIONS, context)
+        report_path = self.parameterAsFileOutput(parameters, self.REPORT, context)
 
         mark_only = self.parameterAsBool(parameters, self.MARK_ONLY, context)
         use_nodata = self.parameterAsBool(parameters, self.USE_BAND_NODATA, context)
         tile_size = self.parameterAsInt(parameters, self.TILE_SIZE, context)
+        tile_mode = self.parameterAsEnum(parameters, self.TILE_MODE, context)
         comp = self.COMPRESSION_OPTS[self.parameterAsEnum(parameters, self.COMPRESSION, context)]
         bigtiff = self.BIGTIFF_OPTS[self.parameterAsEnum(parameters, self.BIGTIFF, context)]
         out_path = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
         out_dtype_idx = self.parameterAsEnum(parameters, self.OUTPUT_DTYPE, context)
+        out_fmt = self.parameterAsEnum(parameters, self.OUTPUT_FORMAT, context)
+        build_ovr = self.parameterAsBool(parameters, self.BUILD_OVERVIEWS, context)
+        exec_mode = self.parameterAsEnum(parameters, self.EXECUTOR, context)
+        max_tiles = self.parameterAsInt(parameters, self.MAX_TILES, context)
 
-        # Auto workers
-        import multiprocessing
-        workers = max(1, multiprocessing.cpu_count() - 1)
+        # Kiểu dữ liệu đầu ra (None = theo band vào)
+        out_gdt = None if out_dtype_idx == 0 else self.DTYPE_MAP[self.DTYPE_OPTS[out_dtype_idx]]
 
-        band0 = ds.GetRasterBand(band_index)
-        nodata = band0.GetNoDataValue() if use_nodata else None
-
-        # chọn dtype đầu ra
-        if mark_only:
-            out_gdt = gdal.GDT_Byte
-        else:
-            if out_dtype_idx == 0:  # theo band vào
-                out_gdt = band0.DataType
-            else:
-                sel = self.DTYPE_OPTS[out_dtype_idx]
-                out_gdt = self.DTYPE_MAP[sel]
-        out_min, out_max, out_is_int = self._dtype_range(out_gdt)
-
-        driver = gdal.GetDriverByName("GTiff")
-        creation_opts = ["TILED=YES", "INTERLEAVE=BAND", f"BIGTIFF={bigtiff}"]
-        if comp != "NONE":
-            creation_opts.append("COMPRESS=" + comp)
-
-        out_ds = driver.Create(out_path, ds.RasterXSize, ds.RasterYSize, 1, out_gdt, options=creation_opts)
-        if out_ds is None:
-            raise QgsProcessingException("Không tạo được file đầu ra")
-        out_ds.SetGeoTransform(ds.GetGeoTransform())
-        out_ds.SetProjection(ds.GetProjection())
-
-        out_band = out_ds.GetRasterBand(1)
-        nodata_write = None
-        if nodata is not None and not mark_only:
-            if out_is_int and (nodata < out_min or nodata > out_max):
-                out_band.SetNoDataValue(out_min)
-                nodata_write = out_min
-            else:
-                out_band.SetNoDataValue(nodata)
-                nodata_write = nodata
-
-        width, height = ds.RasterXSize, ds.RasterYSize
-        tiles = [(x, y, min(tile_size, width - x), min(tile_size, height - y))
-                 for y in range(0, height, tile_size)
-                 for x in range(0, width, tile_size)]
-
-        total_jobs = len(tiles)
-        done_jobs = 0
-
-        results = []
-        with ThreadPoolExecutor(max_workers=workers) as ex:
-            futs = [
-                ex.submit(self._process_tile, src_path, band_index, x, y, w, h, pad, method, thr, win, nodata, mark_only)
-                for (x, y, w, h) in tiles
-            ]
-            for fut in as_completed(futs):
-                xoff, yoff, out_tile = fut.result()
-                results.append((xoff, yoff, out_tile))
-                done_jobs += 1
-                feedback.setProgress(int(100.0 * done_jobs / max(1, total_jobs)))
-
-        # ghi tuần tự (và ép kiểu theo lựa chọn)
-        for xoff, yoff, out_tile in results:
-            if mark_only:
-                out_arr = np.where(np.isfinite(out_tile), out_tile, 0).astype(np.uint8, copy=False)
-            else:
-                out_arr = out_tile
-                if nodata_write is not None:
-                    out_arr = np.where(np.isfinite(out_arr), out_arr, nodata_write)
-                if out_is_int:
-                    out_arr = np.rint(out_arr)
-                    out_arr = np.clip(out_arr, out_min, out_max)
-                    if out_gdt == gdal.GDT_Byte:
-                        out_arr = out_arr.astype(np.uint8, copy=False)
-                    elif out_gdt == gdal.GDT_UInt16:
-                        out_arr = out_arr.astype(np.uint16, copy=False)
-                    elif out_gdt == gdal.GDT_Int16:
-                        out_arr = out_arr.astype(np.int16, copy=False)
-                    elif out_gdt == gdal.GDT_UInt32:
-                        out_arr = out_arr.astype(np.uint32, copy=False)
-                    else:
-                        out_arr = out_arr.astype(np.int32, copy=False)
-                else:
-                    if out_gdt == gdal.GDT_Float32:
-                        out_arr = out_arr.astype(np.float32, copy=False)
-                    else:
-                        out_arr = out_arr.astype(np.float64, copy=False)
-
-            out_band.WriteArray(out_arr, xoff, yoff)
-
-        out_band.FlushCache()
-        out_ds.FlushCache()
-        out_ds = None
+        try:
+            out_path, totals, reported = run_filter(
+                ds, src_path, band_indices, out_path, method, self.METHODS[method], thr, win, max_iter, mark_only,
+                use_nodata, out_gdt, tile_size, tile_mode, comp, bigtiff, out_fmt, self.FORMAT_OPTS[out_fmt],
+                build_ovr, exec_mode, max_tiles, 1, report_path, feedback, _tr)
+        except RuntimeError as e:
+            raise QgsProcessingException(str(e))
         ds = None
-        return {self.OUTPUT: out_path}
+
+        results = {self.OUTPUT: out_path}
+        if reported:
+            results[self.REPORT] = report_path
+        results[self.OUTLIER_COUNT] = totals["outliers"]
+        results[self.VALID_COUNT] = totals["valid"]
+        results[self.NODATA_COUNT] = totals["nodata"]
+        return results
@@ -14,6 +14,8 @@ from qgis.core import (
 import os
 import re
 
+from ..request_utils import provider_filtered_layer
+
 def _tr(s):
     return QCoreApplication.translate("SplitByFieldConditionAlgorithm", s)
 
@@ -249,6 +251,14 @@ class SplitByFieldConditionAlgorithm(QgsProcessingAlgorithm):
             if expr.hasParserError():
                 raise QgsProcessingException(_tr(f"Biểu thức không hợp lệ: {expr.parserErrorString()}"))
 
+        # Phần điều kiện dịch được sang SQL lọc ngay tại provider; chỉ phần còn lại evaluate trong Python
+        read_layer = in_layer
+        pushed, residual = provider_filtered_layer(
+            in_layer, filter_expr_str.strip(), parameters.get(self.INPUT), feedback)
+        if pushed is not None:
+            read_layer = pushed
+            expr = QgsExpression(residual) if residual else None
+
         ctx = QgsExpressionContext()
         ctx.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(in_layer))
 
@@ -267,8 +277,9 @@ class SplitByFieldConditionAlgorithm(QgsProcessingAlgorithm):
         gpkg_file_path = single_gpkg_path if group_to_single_gpkg else None
         first_layer = True  # để quyết định overwrite file hay chỉ overwrite layer
 
-        total = src.featureCount() or 1
-        for k, f in enumerate(in_layer.getFeatures(), start=1):
+        total = read_layer.featureCount() if pushed is not None else src.featureCount()
+        total = total if total and total > 0 else 1
+        for k, f in enumerate(read_layer.getFeatures(), start=1):
             if k % 1000 == 0:
                 feedback.setProgress(int(100.0 * k / total))
 
@@ -9,16 +9,16 @@ from qgis.PyQt.QtGui import QColor
 from qgis.core import (
     QgsProject, QgsVectorLayer, QgsWkbTypes, QgsField, QgsFeature,
     QgsGeometry, QgsCoordinateTransform, QgsPointXY, QgsPointLocator,
-    QgsTolerance, QgsProcessing, QgsFeatureRequest, QgsRectangle,
-    QgsSpatialIndex, QgsCoordinateReferenceSystem
+    QgsTolerance, QgsFeatureRequest, QgsRectangle,
+    QgsSpatialIndex, QgsCoordinateReferenceSystem, QgsProcessingException
 )
 from qgis.gui import QgsMapTool, QgsRubberBand, QgsVertexMarker
-import processing
 import math
-import heapq
 
+import numpy as np
 
-ALG_ID = 'forestry_tool:split_polygons_inplace_by_lines'
+from .split_inplace_algorithm import split_polygons_inplace
+from ..trace_graph import TraceGraph
 
 
 # ---------- Helpers chung ----------
@@ -95,6 +95,9 @@ class SplitConfigWidget(QtWidgets.QWidget):
         self.chkTrace.setChecked(True)
         outer.addWidget(self.chkTrace)
 
+        self.chkTraceBidir = QtWidgets.QCheckBox("Tìm đường 2 chiều (lớp biên rất lớn)")
+        outer.addWidget(self.chkTraceBidir)
+
         self.lblStatus = QtWidgets.QLabel("<i>Chưa bắt đầu vẽ</i>")
         outer.addWidget(self.lblStatus)
 
@@ -142,7 +145,8 @@ class SplitConfigWidget(QtWidgets.QWidget):
             area_units_mode=self.cmbAreaUnit.currentIndex(),  # 0=project,1=m2,2=ha
             snapping=self.chkSnap.isChecked(),
             snap_px=self.spinSnapPx.value(),
-            tracing=self.chkTrace.isChecked()
+            tracing=self.chkTrace.isChecked(),
+            trace_bidirectional=self.chkTraceBidir.isChecked()
         )
 
     def setStatus(self, text, good=False):
@@ -196,9 +200,19 @@ class DrawLineTool(QgsMapTool):
     Tracing động theo **canonical trace layer**:
     - Dù snap vào polygon gốc, boundary tạm hay line, đều quy về một *canonical* layer dạng line.
       Vì vậy 2 điểm cùng biên polygon luôn dùng chung lớp → đường sẽ ép theo biên.
-    - Thứ tự tìm đường: substring (cùng feature) → QgsTracer (nếu có) → Dijkstra trên đồ thị biên (fallback).
+    - Thứ tự tìm đường: substring (cùng feature) → QgsTracer (nếu có) → A* trên đồ thị biên (fallback;
+      CSR + KD-tree, tuỳ chọn A* 2 chiều).
     - Có ghost, Backspace, ESC, và marker tím tại điểm snap.
+    - QgsPointLocator được cache theo lớp (dựng nền, không chặn canvas) và tự theo dõi sửa đổi của lớp;
+      chỉ dựng lại khi đổi CRS, ra ngoài vùng đã index, hoặc biên phản chiếu (sửa qua provider) đổi.
+      Locator cũ đang dựng index nền được chờ xong rồi mới giải phóng. Lớp rất lớn chỉ index vùng canvas đang xem.
+    - Biên polygon là lớp memory "phản chiếu" (1 đường biên / polygon, trường src_fid), không dissolve cả lớp.
+      Tín hiệu sửa lớp nguồn chỉ ghi nhận fid; lần snap kế tiếp cập nhật biên, đồ thị, spatial index
+      cho đúng các đối tượng đó -> cắt liên tiếp vẫn nhanh và đúng.
     """
+    # lớp có nhiều hơn ngần này đối tượng -> locator chỉ index vùng canvas (nới rộng)
+    LOCATOR_FULL_MAX = 200000
+    LOCATOR_EXTENT_SCALE = 2.0
     def __init__(self, iface, on_finish, opts, target_polygon_layer):
         super().__init__(iface.mapCanvas())
         self.iface = iface
@@ -208,6 +222,7 @@ class DrawLineTool(QgsMapTool):
         self.enable_snapping = bool(opts.get('snapping', True))
         self.snap_px = int(opts.get('snap_px', 12))
         self.enable_tracing = bool(opts.get('tracing', True))
+        self.trace_bidirectional = bool(opts.get('trace_bidirectional', False))
         self.selected_only = bool(opts.get('selected_only', False))
 
         self.target_polygon_layer = target_polygon_layer
@@ -239,15 +254,18 @@ class DrawLineTool(QgsMapTool):
         self.snap_layers = []
         self.trace_layers = []
         self.boundary_layer = None
-        self.boundary_unified = None
         self.other_poly_boundaries = []
         self._temp_layers = []
 
         # cache
-        self._layer_unified_cache = {}   # {layer.id(): unified_line_layer}
+        self._layer_unified_cache = {}   # {polygon.id(): dict(layer=biên phản chiếu, src, lines={src_fid: fid}, selected_only)}
         self._trace_source_cache = {}    # {layer.id(): trace_line_layer}
         self._spatial_index_cache = {}   # {trace_layer.id(): QgsSpatialIndex}
-        self._graph_cache = {}           # graph cache cho fallback đồ thị
+        self._index_boxes = {}           # {trace_layer.id(): {fid: bbox}} để xoá khỏi spatial index
+        self._graph_cache = {}           # graph cache cho fallback đồ thị (sửa theo đối tượng, không dựng lại)
+        self._pending = {}               # {layer.id(): set(fid) | None (dựng lại cả lớp)} chờ cập nhật
+        self._locator_cache = {}         # {layer.id(): (QgsPointLocator, extent|None)}
+        self._watched = {}               # {layer.id(): [(signal, slot)...]}
 
         # ánh xạ mọi layer → canonical trace layer (line)
         self._canonical_map = {}         # {any_layer_id: canonical_line_layer}
@@ -266,6 +284,7 @@ class DrawLineTool(QgsMapTool):
         self.enable_snapping = bool(self.opts.get('snapping', True))
         self.snap_px = int(self.opts.get('snap_px', 12))
         self.enable_tracing = bool(self.opts.get('tracing', True))
+        self.trace_bidirectional = bool(self.opts.get('trace_bidirectional', False))
         self.selected_only = bool(self.opts.get('selected_only', False))
 
         # reset trạng thái vẽ để tránh trộn CRS/đồ thị cũ
@@ -279,8 +298,8 @@ class DrawLineTool(QgsMapTool):
         self._cleanup_temps()
         self._canonical_map.clear()
         self._layer_unified_cache.clear()
-        self._spatial_index_cache.clear()
-        self._graph_cache.clear()
+        self._clear_trace_caches()
+        self._clear_locators()
         self._prepare_snap_and_trace_layers()
         self._setup_canvas_snapping()
         if self.enable_tracing:
@@ -294,11 +313,18 @@ class DrawLineTool(QgsMapTool):
             pass
         self._temp_layers = []
 
+    def _clear_trace_caches(self):
+        self._spatial_index_cache.clear()
+        self._index_boxes.clear()
+        self._graph_cache.clear()
+        self._pending.clear()
+
     # lifecycle
     def activate(self):
         super().activate()
         self.canvas().setCursor(Qt.CrossCursor)
         self._reset_state()
+        self.canvas().destinationCrsChanged.connect(self._on_canvas_crs_changed)
 
         self._prepare_snap_and_trace_layers()
         self._setup_canvas_snapping()
@@ -318,9 +344,13 @@ class DrawLineTool(QgsMapTool):
         self.other_poly_boundaries = []
         self._layer_unified_cache.clear()
         self._trace_source_cache.clear()
-        self._spatial_index_cache.clear()
-        self._graph_cache.clear()
+        self._clear_trace_caches()
+        self._clear_locators()
         self._canonical_map.clear()
+        try:
+            self.canvas().destinationCrsChanged.disconnect(self._on_canvas_crs_changed)
+        except Exception:
+            pass
 
     def _reset_state(self):
         self.points.clear()
@@ -338,50 +368,38 @@ class DrawLineTool(QgsMapTool):
         self.snap_layers = []
         self.trace_layers = []
         self.boundary_layer = None
-        self.boundary_unified = None
         self.other_poly_boundaries = []
         self._canonical_map.clear()
 
         root = QgsProject.instance().layerTreeRoot()
 
-        # target polygon: boundary & unify -> canonical
+        # target polygon: biên phản chiếu -> canonical
         if isinstance(self.target_polygon_layer, QgsVectorLayer) and self.target_polygon_layer.isValid():
             self.snap_layers.append(self.target_polygon_layer)
-            self.boundary_layer = self._build_boundary_lines(self.target_polygon_layer, self.selected_only)
-            self.boundary_unified = self._unify_lines(self.boundary_layer) if self.boundary_layer else None
-
-            for lyr in (self.boundary_unified, self.boundary_layer):
-                if lyr and lyr.isValid() and lyr.featureCount() > 0:
-                    QgsProject.instance().addMapLayer(lyr, False)  # add ẩn
-                    self._temp_layers.append(lyr)
-
-            canonical = self.boundary_unified or self.boundary_layer
-            if canonical:
-                # map polygon gốc + boundary liên quan -> canonical
-                self._canonical_map[self.target_polygon_layer.id()] = canonical
-                if self.boundary_layer:
-                    self._canonical_map[self.boundary_layer.id()] = canonical
-                if self.boundary_unified:
-                    self._canonical_map[self.boundary_unified.id()] = canonical
-
-                self.trace_layers.append(canonical)
-                self.snap_layers.append(canonical)
-
-        # line đang hiển thị -> canonical = unified(line) or line
+            self.boundary_layer = self._boundary_for(self.target_polygon_layer, self.selected_only)
+            if self.boundary_layer:
+                # map polygon gốc + biên -> canonical
+                self._canonical_map[self.target_polygon_layer.id()] = self.boundary_layer
+                self._canonical_map[self.boundary_layer.id()] = self.boundary_layer
+                self.trace_layers.append(self.boundary_layer)
+                self.snap_layers.append(self.boundary_layer)
+
+        # line đang hiển thị -> canonical = chính lớp line
         for lyr in QgsProject.instance().mapLayers().values():
             if isinstance(lyr, QgsVectorLayer) and lyr.isValid() and lyr.geometryType() == QgsWkbTypes.LineGeometry:
+                if lyr.id() in self._canonical_map:
+                    continue  # biên phản chiếu đã thêm ở trên
                 node = root.findLayer(lyr.id())
                 vis = node.isVisible() if node else True
                 if not vis:
                     continue
-                uni = self._get_unified_for_layer(lyr) or lyr
-                self._canonical_map[lyr.id()] = uni
-                self._canonical_map[uni.id()] = uni
-                self.snap_layers.append(uni)
-                if uni not in self.trace_layers:
-                    self.trace_layers.append(uni)
-
-        # boundary cho các polygon khác đang bật -> canonical
+                self._canonical_map[lyr.id()] = lyr
+                self._watch_layer(lyr)
+                self.snap_layers.append(lyr)
+                if lyr not in self.trace_layers:
+                    self.trace_layers.append(lyr)
+
+        # biên cho các polygon khác đang bật -> canonical
         for lyr in QgsProject.instance().mapLayers().values():
             if lyr is self.target_polygon_layer:
                 continue
@@ -390,90 +408,81 @@ class DrawLineTool(QgsMapTool):
                 vis = node.isVisible() if node else True
                 if not vis:
                     continue
-                bnd = self._build_boundary_lines(lyr, selected_only=False)
-                uni = self._unify_lines(bnd) if bnd else None
-                canonical = uni or bnd
-                for l2 in (uni, bnd):
-                    if l2 and l2.isValid() and l2.featureCount() > 0:
-                        QgsProject.instance().addMapLayer(l2, False)
-                        self._temp_layers.append(l2)
-                if canonical:
-                    self._canonical_map[lyr.id()] = canonical
-                    if bnd:
-                        self._canonical_map[bnd.id()] = canonical
-                    if uni:
-                        self._canonical_map[uni.id()] = canonical
-                    self.other_poly_boundaries.append(canonical)
-                    self.snap_layers.append(canonical)
-                    if canonical not in self.trace_layers:
-                        self.trace_layers.append(canonical)
-
-    def _build_boundary_lines(self, poly_layer, selected_only=False):
+                bnd = self._boundary_for(lyr, selected_only=False)
+                if bnd:
+                    self._canonical_map[lyr.id()] = bnd
+                    self._canonical_map[bnd.id()] = bnd
+                    self.other_poly_boundaries.append(bnd)
+                    self.snap_layers.append(bnd)
+                    if bnd not in self.trace_layers:
+                        self.trace_layers.append(bnd)
+
+    def _boundary_for(self, poly_layer, selected_only=False):
+        """Lớp biên phản chiếu (memory, 1 đường biên / polygon) của poly_layer; cache theo layer id."""
         try:
-            input_layer = poly_layer
-            if selected_only and poly_layer.selectedFeatureCount() > 0:
-                crs = poly_layer.crs().authid()
-                geom_str = 'MultiPolygon' if QgsWkbTypes.isMultiType(poly_layer.wkbType()) else 'Polygon'
-                mem = QgsVectorLayer(f"{geom_str}?crs={crs}", "tmp_poly_selected", "memory")
-                pr = mem.dataProvider()
-                pr.addAttributes([_mk_field("id", QVariant.LongLong)])
-                mem.updateFields()
-                feats = []
-                for f in poly_layer.getSelectedFeatures():
-                    nf = QgsFeature(mem.fields()); nf.setGeometry(f.geometry()); nf["id"] = f.id(); feats.append(nf)
-                if feats:
-                    pr.addFeatures(feats); mem.updateExtents(); input_layer = mem
-
-            res = processing.run('native:polygonstolines',
-                                 {'INPUT': input_layer, 'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT},
-                                 is_child_algorithm=True)
-            out_obj = res.get('OUTPUT')
-            out = out_obj if isinstance(out_obj, QgsVectorLayer) else QgsVectorLayer(out_obj, 'tmp_boundary', 'ogr')
-            if not out or not out.isValid() or out.geometryType() != QgsWkbTypes.LineGeometry:
-                return None
-            return out
+            selected_only = bool(selected_only and poly_layer.selectedFeatureCount() > 0)
+            pid = poly_layer.id()
+            ent = self._layer_unified_cache.get(pid)
+            if ent and ent['selected_only'] == selected_only and ent['layer'].isValid():
+                return ent['layer']
+
+            crs = poly_layer.crs().authid()
+            mem = QgsVectorLayer(f"MultiLineString?crs={crs}", f"{poly_layer.name()}_boundary", "memory")
+            mem.setCrs(poly_layer.crs())  # CRS tuỳ biến không có authid
+            mem.dataProvider().addAttributes([_mk_field("src_fid", QVariant.LongLong)])
+            mem.updateFields()
+            ent = dict(layer=mem, src=poly_layer, lines={}, selected_only=selected_only)
+            self._sync_boundary(ent)
+
+            self._layer_unified_cache[pid] = ent
+            QgsProject.instance().addMapLayer(mem, False)  # add ẩn
+            self._temp_layers.append(mem)
+            self._watch_layer(poly_layer)
+            return mem
         except Exception:
             return None
 
-    def _unify_lines(self, line_layer):
-        if not line_layer or not line_layer.isValid():
-            return None
-        try:
-            res1 = processing.run(
-                'native:dissolve',
-                {'INPUT': line_layer, 'FIELD': [], 'SEPARATE_DISJOINT': False,
-                 'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT},
-                is_child_algorithm=True)
-            dis = res1.get('OUTPUT')
-            dis = dis if isinstance(dis, QgsVectorLayer) else QgsVectorLayer(dis, 'tmp_dis', 'ogr')
-            if not dis or not dis.isValid():
-                return None
-            res2 = processing.run(
-                'native:linestomerge',
-                {'INPUT': dis, 'FIELD': [], 'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT},
-                is_child_algorithm=True)
-            mg = res2.get('OUTPUT')
-            mg = mg if isinstance(mg, QgsVectorLayer) else QgsVectorLayer(mg, 'tmp_merge', 'ogr')
-            if not mg or not mg.isValid():
-                return None
-            return mg
-        except Exception:
-            return None
+    def _sync_boundary(self, ent, fids=None):
+        """
+        Đồng bộ biên phản chiếu với polygon nguồn cho các fid đã đổi (None = toàn bộ lớp):
+        xoá đường biên cũ của các fid đó, thêm biên mới của những polygon còn tồn tại.
+        Trả (fid đường đã xoá, feature đường đã thêm) để cập nhật đồ thị / spatial index.
+        """
+        mem, src, lines = ent['layer'], ent['src'], ent['lines']
+        pr = mem.dataProvider()
+        removed = [lines.pop(f) for f in fids if f in lines] if fids is not None else []
+        if removed:
+            pr.deleteFeatures(removed)
+
+        request = QgsFeatureRequest().setNoAttributes()
+        keep = None
+        if fids is not None:
+            request.setFilterFids(list(fids))
+        if ent['selected_only']:
+            keep = set(src.selectedFeatureIds())
+        feats = []
+        for f in src.getFeatures(request):
+            if keep is not None and f.id() not in keep:
+                continue
+            g = f.geometry()
+            if not g or g.isEmpty():
+                continue
+            try:
+                b = QgsGeometry(g.constGet().boundary())
+            except Exception:
+                continue
+            if b.isEmpty():
+                continue
+            b.convertToMultiType()
+            nf = QgsFeature(mem.fields()); nf.setGeometry(b); nf["src_fid"] = f.id(); feats.append(nf)
 
-    def _get_unified_for_layer(self, lyr: QgsVectorLayer):
-        if not lyr or not lyr.isValid():
-            return None
-        lid = lyr.id()
-        if lid in self._layer_unified_cache:
-            un = self._layer_unified_cache[lid]
-            if un and un.isValid():
-                return un
-        un = self._unify_lines(lyr)
-        if un:
-            self._layer_unified_cache[lid] = un
-            self._temp_layers.append(un)
-            QgsProject.instance().addMapLayer(un, False)
-        return un
+        added = []
+        if feats:
+            ok, added = pr.addFeatures(feats)
+            for nf in added:
+                lines[int(nf["src_fid"])] = nf.id()
+        mem.updateExtents()
+        return removed, added
 
     def _trace_layer_for_snap_layer(self, lyr: QgsVectorLayer):
         """Trả canonical trace layer cho bất kỳ layer nào được snap vào."""
@@ -482,29 +491,23 @@ class DrawLineTool(QgsMapTool):
         if lyr.id() in self._canonical_map:
             return self._canonical_map[lyr.id()]
 
-        # nếu là line: canonical = unified(line) or line
+        # nếu là line: canonical = chính lớp đó
         if lyr.geometryType() == QgsWkbTypes.LineGeometry:
-            uni = self._get_unified_for_layer(lyr) or lyr
-            self._canonical_map[lyr.id()] = uni
-            self._canonical_map[uni.id()] = uni
-            if uni not in self.trace_layers:
-                self.trace_layers.append(uni)
-            return uni
-
-        # nếu là polygon: tạo boundary & unified rồi map
+            self._canonical_map[lyr.id()] = lyr
+            self._watch_layer(lyr)
+            if lyr not in self.trace_layers:
+                self.trace_layers.append(lyr)
+            return lyr
+
+        # nếu là polygon: tạo biên phản chiếu rồi map
         if lyr.geometryType() == QgsWkbTypes.PolygonGeometry:
-            bnd = self._build_boundary_lines(lyr, selected_only=False)
-            uni = self._unify_lines(bnd) if bnd else None
-            canonical = uni or bnd
-            if canonical:
-                self._canonical_map[lyr.id()] = canonical
-                if bnd: self._canonical_map[bnd.id()] = canonical
-                if uni: self._canonical_map[uni.id()] = canonical
-                QgsProject.instance().addMapLayer(canonical, False)
-                self._temp_layers.append(canonical)
-                if canonical not in self.trace_layers:
-                    self.trace_layers.append(canonical)
-                return canonical
+            bnd = self._boundary_for(lyr, selected_only=False)
+            if bnd:
+                self._canonical_map[lyr.id()] = bnd
+                self._canonical_map[bnd.id()] = bnd
+                if bnd not in self.trace_layers:
+                    self.trace_layers.append(bnd)
+                return bnd
 
         return None
 
@@ -516,12 +519,96 @@ class DrawLineTool(QgsMapTool):
         if idx:
             return idx
         try:
-            idx = QgsSpatialIndex(line_layer.getFeatures())
+            idx, boxes = QgsSpatialIndex(), {}
+            for f in line_layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+                if f.hasGeometry():
+                    idx.addFeature(f)
+                    boxes[f.id()] = f.geometry().boundingBox()
             self._spatial_index_cache[lid] = idx
+            self._index_boxes[lid] = boxes
             return idx
         except Exception:
             return None
 
+    # ---------- cập nhật tăng dần theo tín hiệu sửa lớp ----------
+    def _on_feature_changed(self, lid, fid):
+        # locator tự cập nhật qua tín hiệu của lớp -> giữ nguyên
+        pend = self._pending.setdefault(lid, set())
+        if pend is not None:
+            pend.add(int(fid))
+
+    def _on_layer_reset(self, lid):
+        self._release_locator(lid)
+        self._pending[lid] = None
+
+    def _on_canvas_crs_changed(self):
+        # đồ thị lưu toạ độ theo CRS map
+        self._graph_cache.clear()
+
+    def _flush_pending(self):
+        """Áp các thay đổi đã ghi nhận vào biên phản chiếu, đồ thị và spatial index (chỉ fid bị đổi)."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        mirrored = False
+        for lid, fids in pending.items():
+            try:
+                ent = self._layer_unified_cache.get(lid)
+                if ent is not None:
+                    # polygon nguồn -> cập nhật biên phản chiếu rồi các cache của lớp biên
+                    if fids is None:
+                        ent['layer'].setCrs(ent['src'].crs())
+                        fids = set(ent['lines']) | set(ent['src'].allFeatureIds())
+                        self._drop_line_caches(ent['layer'].id())
+                    removed, added = self._sync_boundary(ent, fids)
+                    self._release_locator(ent['layer'].id())  # sửa qua provider không báo cho locator
+                    self._apply_line_changes(ent['layer'], removed, added)
+                    mirrored = True
+                    continue
+                lyr = self._canonical_map.get(lid)
+                if lyr is None or lyr.id() != lid:
+                    continue  # chỉ là lớp snap (locator tự cập nhật)
+                if fids is None:
+                    self._drop_line_caches(lid)
+                    continue
+                added = list(lyr.getFeatures(QgsFeatureRequest().setFilterFids(list(fids)).setNoAttributes()))
+                self._apply_line_changes(lyr, fids, added)
+            except RuntimeError:
+                pass  # lớp đã bị xoá khỏi project
+        # QgsTracer không thấy sửa đổi qua provider của lớp memory -> dựng lại (đồ thị dựng lười)
+        if mirrored and self.enable_tracing and self.tracer is not None:
+            self._init_tracer()
+
+    def _drop_line_caches(self, lid):
+        self._release_locator(lid)
+        self._spatial_index_cache.pop(lid, None)
+        self._index_boxes.pop(lid, None)
+        self._graph_cache.pop(lid, None)
+
+    def _apply_line_changes(self, line_layer, removed, added):
+        """Bỏ rồi thêm lại đúng các đối tượng đã đổi trong đồ thị / spatial index của 1 lớp line."""
+        lid = line_layer.id()
+        graph = self._graph_cache.get(lid)
+        if graph is not None:
+            to_map = QgsCoordinateTransform(line_layer.crs(), self.canvas().mapSettings().destinationCrs(),
+                                            QgsProject.instance())
+            # cạnh cũ đánh dấu bỏ, cạnh mới vào overlay của đồ thị -> không dựng lại CSR
+            graph.update(removed, {f.id(): self._map_polylines(f.geometry(), to_map) for f in added})
+
+        idx = self._spatial_index_cache.get(lid)
+        boxes = self._index_boxes.get(lid)
+        if idx is not None and boxes is not None:
+            for fid in removed:
+                bb = boxes.pop(fid, None)
+                if bb is not None:
+                    old = QgsFeature(fid)
+                    old.setGeometry(QgsGeometry.fromRect(bb))
+                    idx.deleteFeature(old)
+            for f in added:
+                if f.hasGeometry():
+                    idx.addFeature(f)
+                    boxes[f.id()] = f.geometry().boundingBox()
+
     def _setup_canvas_snapping(self):
         # Đọc cấu hình snapping của Project/QGIS; plugin không ghi đè
         self._using_canvas_snapping = self.enable_snapping
@@ -575,6 +662,100 @@ class DrawLineTool(QgsMapTool):
             self.tracer = None
             self._have_qgstracer = False
 
+    # ---------- locator cache ----------
+    def _watch_layer(self, lyr: QgsVectorLayer):
+        """Nối tín hiệu sửa đổi của lớp (1 lần / lớp) để vô hiệu cache tương ứng."""
+        lid = lyr.id()
+        if lid in self._watched:
+            return
+
+        def _feature(fid, *_args, lid=lid):
+            self._on_feature_changed(lid, fid)
+
+        def _reset(*_args, lid=lid):
+            self._on_layer_reset(lid)
+
+        conns = []
+        for name, slot in (('featureAdded', _feature), ('featureDeleted', _feature),
+                           ('geometryChanged', _feature), ('crsChanged', _reset)):
+            sig = getattr(lyr, name, None)
+            if sig is None:
+                continue
+            try:
+                sig.connect(slot)
+                conns.append((sig, slot))
+            except Exception:
+                pass
+        self._watched[lid] = conns
+
+    def _clear_locators(self):
+        for conns in self._watched.values():
+            for sig, slot in conns:
+                try:
+                    sig.disconnect(slot)
+                except Exception:
+                    pass  # lớp đã bị xoá
+        self._watched.clear()
+        for loc, _ext in self._locator_cache.values():
+            self._finish_indexing(loc)
+        self._locator_cache.clear()
+
+    def _release_locator(self, lid):
+        """Bỏ locator của lớp khỏi cache (lần snap sau dựng lại)."""
+        ent = self._locator_cache.pop(lid, None)
+        if ent is not None:
+            self._finish_indexing(ent[0])
+
+    @staticmethod
+    def _finish_indexing(loc):
+        # index nền còn chạy mà Python giải phóng locator -> task truy cập đối tượng C++ đã xoá
+        try:
+            if loc.isIndexing():
+                loc.waitForIndexingFinished()
+        except (AttributeError, RuntimeError):
+            pass  # QGIS cũ: index dựng đồng bộ / đối tượng đã bị xoá
+
+    def _locator_extent(self, lyr: QgsVectorLayer):
+        """None = index cả lớp; lớp quá lớn -> vùng canvas (nới rộng) trong CRS của lớp."""
+        try:
+            if lyr.featureCount() <= self.LOCATOR_FULL_MAX:
+                return None
+            ms = self.canvas().mapSettings()
+            to_layer = QgsCoordinateTransform(ms.destinationCrs(), lyr.crs(), QgsProject.instance())
+            ext = QgsRectangle(to_layer.transformBoundingBox(ms.extent()))
+            ext.scale(self.LOCATOR_EXTENT_SCALE)
+            return ext
+        except Exception:
+            return None
+
+    def _locator_for(self, lyr: QgsVectorLayer, pt_layer: QgsPointXY = None):
+        """QgsPointLocator cache theo lớp; dựng index nền (relaxed) để lần di chuột đầu không bị chặn."""
+        lid = lyr.id()
+        ent = self._locator_cache.get(lid)
+        if ent:
+            loc, ext = ent
+            # locator giới hạn vùng: điểm ra ngoài vùng đã index -> dựng lại theo canvas hiện tại
+            if ext is None or pt_layer is None or ext.contains(pt_layer):
+                return loc
+            self._finish_indexing(loc)
+        ext = self._locator_extent(lyr)
+        loc = QgsPointLocator(lyr, lyr.crs(), QgsProject.instance().transformContext(), ext)
+        try:
+            loc.init(-1, True)
+        except TypeError:
+            pass  # QGIS cũ: index dựng khi truy vấn đầu tiên
+        self._locator_cache[lid] = (loc, ext)
+        self._watch_layer(lyr)
+        return loc
+
+    @staticmethod
+    def _locator_match(loc, kind, pt_layer, tol):
+        fn = loc.nearestVertex if kind == 'vertex' else loc.nearestEdge
+        try:
+            return fn(pt_layer, tol, None, True)  # relaxed: index đang dựng -> match rỗng, không chờ
+        except TypeError:
+            return fn(pt_layer, tol)
+
     # ---------- helpers snap ----------
     def _snap_with_locator(self, map_point_xy: QgsPointXY, lyr: QgsVectorLayer):
         try:
@@ -583,9 +764,9 @@ class DrawLineTool(QgsMapTool):
             to_layer = QgsCoordinateTransform(ms.destinationCrs(), lyr.crs(), QgsProject.instance())
             pt_layer = to_layer.transform(map_point_xy)
 
-            locator = QgsPointLocator(lyr, lyr.extent(), lyr.crs(), QgsProject.instance().transformContext())
-            mv = locator.nearestVertex(pt_layer, tol_map)
-            me = locator.nearestEdge(pt_layer, tol_map)
+            locator = self._locator_for(lyr, pt_layer)
+            mv = self._locator_match(locator, 'vertex', pt_layer, tol_map)
+            me = self._locator_match(locator, 'edge', pt_layer, tol_map)
 
             best = None
             if mv.isValid():
@@ -647,8 +828,9 @@ class DrawLineTool(QgsMapTool):
         return QgsPointXY(map_point_xy), False, None, None
 
     def _snap_to_map(self, map_point_xy: QgsPointXY, prefer_trace=False):
+        self._flush_pending()
         if prefer_trace:
-            pref = [l for l in [self.boundary_unified, self.boundary_layer] if l]
+            pref = [self.boundary_layer] if self.boundary_layer else []
             pt, ok, lyr, fid = self._snap_to_layers(map_point_xy, pref or self.trace_layers)
             if ok:
                 return pt, True, lyr, fid
@@ -739,9 +921,9 @@ class DrawLineTool(QgsMapTool):
             to_layer = QgsCoordinateTransform(ms.destinationCrs(), layer.crs(), QgsProject.instance())
             p = to_layer.transform(pt_map)
             tol = QgsTolerance.toleranceInMapUnits(self.snap_px * 4, layer, ms)
-            loc = QgsPointLocator(layer, layer.extent(), layer.crs(), QgsProject.instance().transformContext())
-            mv = loc.nearestVertex(p, tol)
-            me = loc.nearestEdge(p, tol)
+            loc = self._locator_for(layer, p)
+            mv = self._locator_match(loc, 'vertex', p, tol)
+            me = self._locator_match(loc, 'edge', p, tol)
             best = None
             if mv.isValid():
                 best = mv.distance()
@@ -764,6 +946,7 @@ class DrawLineTool(QgsMapTool):
 
     # ---------- ĐỒ THỊ (GRAPH) ----------
     def _graph_for_layer(self, layer: QgsVectorLayer):
+        """TraceGraph (CSR + KD-tree, toạ độ CRS map) của lớp line; cache theo layer id."""
         if not layer or not layer.isValid():
             return None
         lid = layer.id()
@@ -773,119 +956,30 @@ class DrawLineTool(QgsMapTool):
 
         ms = self.canvas().mapSettings()
         to_map = QgsCoordinateTransform(layer.crs(), ms.destinationCrs(), QgsProject.instance())
-
-        nodes, key2id, adj = [], {}, {}
-
-        def key_of(pt):
-            return (round(pt.x(), 8), round(pt.y(), 8))
-
-        def add_node(pt):
-            k = key_of(pt)
-            idx = key2id.get(k)
-            if idx is None:
-                idx = len(nodes)
-                nodes.append(pt)
-                key2id[k] = idx
-                adj[idx] = []
-            return idx
-
-        def add_edge(i, j):
-            if i == j:
-                return
-            pi = nodes[i]; pj = nodes[j]
-            w = math.hypot(pj.x() - pi.x(), pj.y() - pi.y())
-            adj[i].append((j, w)); adj[j].append((i, w))
-
-        for f in layer.getFeatures():
-            gtry = f.geometry()
-            if not gtry or gtry.isEmpty():
-                continue
-            try:
-                poly = gtry.asPolyline()
-                if poly and len(poly) >= 2:
-                    pts = [to_map.transform(QgsPointXY(p)) for p in poly]
-                    last = None
-                    for p in pts:
-                        pid = add_node(p)
-                        if last is not None:
-                            add_edge(last, pid)
-                        last = pid
-                    continue
-                mpl = gtry.asMultiPolyline()
-                if mpl and len(mpl) > 0:
-                    for one in mpl:
-                        if len(one) < 2:
-                            continue
-                        pts = [to_map.transform(QgsPointXY(p)) for p in one]
-                        last = None
-                        for p in pts:
-                            pid = add_node(p)
-                            if last is not None:
-                                add_edge(last, pid)
-                            last = pid
-            except Exception:
-                continue
-
-        graph = dict(nodes=nodes, key2id=key2id, adj=adj)
+        parts = {f.id(): self._map_polylines(f.geometry(), to_map)
+                 for f in layer.getFeatures(QgsFeatureRequest().setNoAttributes())}
+        graph = TraceGraph.from_parts(parts)
         self._graph_cache[lid] = graph
         return graph
 
-    def _nearest_node_on_graph(self, layer: QgsVectorLayer, graph, pt_map: QgsPointXY):
-        if not graph or not layer or not layer.isValid():
-            return None
-        ms = self.canvas().mapSettings()
-        to_layer = QgsCoordinateTransform(ms.destinationCrs(), layer.crs(), QgsProject.instance())
-        p_layer = to_layer.transform(pt_map)
+    @staticmethod
+    def _map_polylines(geom, to_map):
+        """Các phần của 1 đường dưới dạng mảng NumPy (k, 2) toạ độ theo CRS map."""
+        if not geom or geom.isEmpty():
+            return []
         try:
-            locator = QgsPointLocator(layer, layer.extent(), layer.crs(), QgsProject.instance().transformContext())
-            mv = locator.nearestVertex(p_layer, QgsTolerance.toleranceInMapUnits(self.snap_px * 2, layer, ms))
-            if not mv.isValid():
-                return None
-            to_map = QgsCoordinateTransform(layer.crs(), ms.destinationCrs(), QgsProject.instance())
-            p_map = to_map.transform(mv.point())
-            k = (round(p_map.x(), 8), round(p_map.y(), 8))
-            nid = graph['key2id'].get(k)
-            if nid is not None:
-                return nid
-            best = None
-            bx = p_map.x(); by = p_map.y()
-            for i, q in enumerate(graph['nodes']):
-                d2 = (q.x() - bx) ** 2 + (q.y() - by) ** 2
-                if best is None or d2 < best[0]:
-                    best = (d2, i)
-            return best[1] if best else None
+            gm = QgsGeometry(geom)
+            gm.transform(to_map)
+            parts = gm.asMultiPolyline() if gm.isMultipart() else [gm.asPolyline()]
         except Exception:
-            return None
+            return []
+        return [np.array([(p.x(), p.y()) for p in one], dtype=np.float64) for one in parts if len(one) >= 2]
 
-    def _dijkstra(self, adj, start, goal):
-        if start is None or goal is None:
+    def _nearest_node_on_graph(self, graph, pt_map: QgsPointXY):
+        if not graph:
             return None
-        INF = 10**30
-        dist, prev = {}, {}
-        pq = []
-        dist[start] = 0.0
-        heapq.heappush(pq, (0.0, start))
-        while pq:
-            d, u = heapq.heappop(pq)
-            if u == goal:
-                break
-            if d > dist.get(u, INF):
-                continue
-            for v, w in adj.get(u, []):
-                nd = d + w
-                if nd < dist.get(v, INF):
-                    dist[v] = nd
-                    prev[v] = u
-                    heapq.heappush(pq, (nd, v))
-        if goal not in dist:
-            return None
-        path = [goal]
-        cur = goal
-        while cur != start:
-            cur = prev[cur]
-            path.append(cur)
-        path.reverse()
-        return path
+        tol = self.canvas().mapSettings().mapUnitsPerPixel() * self.snap_px * 2
+        return graph.nearest(pt_map.x(), pt_map.y(), tol)
 
     # ---------- substring/trace ----------
     def _subline_on_layer_any_feature(self, layer: QgsVectorLayer, p1_map: QgsPointXY, p2_map: QgsPointXY):
@@ -976,14 +1070,14 @@ class DrawLineTool(QgsMapTool):
         g = self._graph_for_layer(layer)
         if not g:
             return None
-        n1 = self._nearest_node_on_graph(layer, g, p1_map)
-        n2 = self._nearest_node_on_graph(layer, g, p2_map)
+        n1 = self._nearest_node_on_graph(g, p1_map)
+        n2 = self._nearest_node_on_graph(g, p2_map)
         if n1 is None or n2 is None:
             return None
-        path_nodes = self._dijkstra(g['adj'], n1, n2)
+        path_nodes = g.shortest_path(n1, n2, bidirectional=self.trace_bidirectional)
         if not path_nodes:
             return None
-        pts = [g['nodes'][i] for i in path_nodes]
+        pts = [QgsPointXY(x, y) for x, y in g.xy[path_nodes].tolist()]
         if pts and (pts[0].x() != p1_map.x() or pts[0].y() != p1_map.y()):
             pts = [p1_map] + pts
         if pts and (pts[-1].x() != p2_map.x() or pts[-1].y() != p2_map.y()):
@@ -1199,28 +1293,28 @@ class SplitDrawController:
             except Exception:
                 pass
 
-        # tạo line memory
-        line_lyr = QgsVectorLayer(f'LineString?crs={dst_crs.authid()}', 'split_draw_line_tmp', 'memory')
-        pr = line_lyr.dataProvider()
-        pr.addAttributes([_mk_field('id', QVariant.Int)])
-        line_lyr.updateFields()
-        f = QgsFeature(line_lyr.fields()); f.setGeometry(geom); f['id'] = 1
-        pr.addFeature(f); line_lyr.updateExtents()
-
-        params = {
-            'INPUT': lyr,
-            'LINES': line_lyr,
-            'SELECTED_ONLY': self.conf['opts'].get('selected_only', False),
-            'PRESERVE': self.conf['opts'].get('preserve', False),
-            'VALUE_FIELD': self.conf['value_field'],
-            'RECALC_AREA': self.conf['opts'].get('recalc_area', False),
-            'AREA_FIELD': self.conf['area_field'],
-            'AREA_UNITS_MODE': self.conf['opts'].get('area_units_mode', 0),
-        }
-
-        processing.run(ALG_ID, params)
+        # tách trực tiếp trên hình học (không lớp tạm, không qua Processing)
+        opts = self.conf['opts']
+        preserve = opts.get('preserve', False) and bool(self.conf['value_field'])
+        try:
+            n_split, n_parts = split_polygons_inplace(
+                lyr, [geom],
+                selected_only=opts.get('selected_only', False),
+                preserve=preserve,
+                value_field=self.conf['value_field'],
+                recalc_area=opts.get('recalc_area', False),
+                area_field=self.conf['area_field'],
+                area_units_mode=opts.get('area_units_mode', 0),
+            )
+        except QgsProcessingException as e:
+            self.iface.messageBar().pushWarning("Chia tách", str(e))
+            return
         # giữ tool để tiếp tục vẽ tiếp
-        self.ui.setStatus(f"Đã tách xong trên lớp: <b>{lyr.name()}</b>. Bạn có thể tiếp tục vẽ.", good=True)
+        if n_split:
+            self.ui.setStatus(f"Đã tách {n_split} đối tượng ({n_parts} phần) trên lớp: <b>{lyr.name()}</b>. "
+                              f"Bạn có thể tiếp tục vẽ.", good=True)
+        else:
+            self.ui.setStatus(f"Đường cắt không tách được đối tượng nào trên lớp: <b>{lyr.name()}</b>.", good=False)
 
 # ---- Compatibility shim for old imports ----
 # Some older code may still import MinimalSplitConfig.
@@ -2,15 +2,198 @@
 # QGIS 3.16+ compatible
 # File: Forestry_tool/algorithms/split_inplace_algorithm.py
 
-from qgis.PyQt.QtCore import QCoreApplication, QVariant
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm, QgsProcessingException,
     QgsProcessingParameterVectorLayer, QgsProcessingParameterBoolean, QgsProcessingParameterField,
     QgsProcessingParameterEnum,
-    QgsVectorLayer, QgsFeature, QgsField, QgsFields,
-    QgsDistanceArea, QgsProject, QgsWkbTypes, QgsProcessingUtils, QgsUnitTypes
+    QgsVectorLayer, QgsFeature, QgsFeatureRequest, QgsGeometry, QgsCoordinateTransform,
+    QgsDistanceArea, QgsProject, QgsWkbTypes, QgsUnitTypes
 )
 
+
+def _tr(text):
+    return QCoreApplication.translate('SplitPolygonsInPlaceAlgorithm', text)
+
+
+# ===== Tách trực tiếp trên QgsGeometry (không lớp tạm, không native:splitwithlines) =====
+def _polyline_parts(line):
+    """Các dãy điểm của 1 đường (LineString / MultiLineString)."""
+    if line.isMultipart():
+        return [pts for pts in line.asMultiPolyline() if len(pts) >= 2]
+    pts = line.asPolyline()
+    return [pts] if len(pts) >= 2 else []
+
+
+def split_geometry(geom, cut_lines):
+    """Cắt 1 polygon lần lượt bằng các đường (QgsGeometry); trả list phần (1 phần = không bị cắt)."""
+    parts = [QgsGeometry(geom)]
+    for line in cut_lines:
+        for pts in _polyline_parts(line):
+            nxt = []
+            for g in parts:
+                res, new_geoms, _topo = g.splitGeometry(pts, False)
+                nxt.append(g)
+                if res == QgsGeometry.Success:
+                    nxt.extend(new_geoms)
+            parts = nxt
+    return parts
+
+
+def _target_features(lyr, cut_lines, selected_only):
+    """
+    {fid: feature} các polygon bị đường cắt tác động.
+    - Chỉ đối tượng chọn: 1 lượt setFilterFids.
+    - Ngược lại: mỗi đường cắt -> setFilterRect theo bbox (provider dùng chỉ mục không gian),
+      rồi kiểm tra intersects bằng hình học đường đã chuẩn bị sẵn (prepared GEOS).
+    """
+    if selected_only:
+        request = QgsFeatureRequest().setFilterFids(lyr.selectedFeatureIds())
+        return {f.id(): f for f in lyr.getFeatures(request) if f.hasGeometry()}
+    targets = {}
+    for lg in cut_lines:
+        if lg is None or lg.isEmpty():
+            continue
+        engine = QgsGeometry.createGeometryEngine(lg.constGet())
+        engine.prepareGeometry()
+        for f in lyr.getFeatures(QgsFeatureRequest().setFilterRect(lg.boundingBox())):
+            if f.id() in targets or not f.hasGeometry():
+                continue
+            if engine.intersects(f.geometry().constGet()):
+                targets[f.id()] = f
+    return targets
+
+
+def _area_factor(area_units_mode):
+    """Hệ số m² -> đơn vị ghi ra (0 = theo Project, 1 = m², 2 = ha)."""
+    if area_units_mode == 0:
+        if hasattr(QgsProject.instance(), 'areaUnits'):
+            target_unit = QgsProject.instance().areaUnits()
+        else:
+            target_unit = QgsUnitTypes.AreaSquareMeters
+    elif area_units_mode == 1:
+        target_unit = QgsUnitTypes.AreaSquareMeters
+    else:
+        target_unit = QgsUnitTypes.AreaHectares
+    try:
+        return QgsUnitTypes.fromUnitToUnitFactor(QgsUnitTypes.AreaSquareMeters, target_unit)
+    except Exception:
+        return 1.0 if target_unit == QgsUnitTypes.AreaSquareMeters else 1.0 / 10000.0
+
+
+def split_polygons_inplace(lyr, cut_lines, selected_only=False, preserve=False, value_field='',
+                           recalc_area=False, area_field='', area_units_mode=0, feedback=None):
+    """
+    Tách in-place các polygon của lyr bằng các đường cut_lines (QgsGeometry, cùng CRS với lyr).
+    Mỗi polygon bị cắt thành ≥2 phần: xoá bản gốc, thêm các phần (giữ thuộc tính; tuỳ chọn phân phối
+    trường số theo diện tích và ghi lại diện tích). Trả (số đối tượng bị tách, số phần thêm mới).
+    Dùng chung cho thuật toán Processing và công cụ vẽ (SplitDrawController).
+    """
+    def _info(msg):
+        if feedback:
+            feedback.pushInfo(msg)
+
+    # 1) Đối tượng bị tác động (giữ luôn feature đã đọc -> không duyệt lại cả lớp)
+    targets = _target_features(lyr, cut_lines, selected_only)
+    if not targets:
+        _info(_tr('Không có đối tượng nào bị đường cắt tác động.'))
+        return 0, 0
+
+    # 2) Cắt trực tiếp trên hình học
+    is_multi = QgsWkbTypes.isMultiType(lyr.wkbType())
+    parts_by_orig = {}
+    for fid, f in targets.items():
+        parts = split_geometry(f.geometry(), cut_lines)
+        if len(parts) >= 2:
+            if is_multi:
+                for g in parts:
+                    g.convertToMultiType()
+            parts_by_orig[fid] = parts
+
+    if not parts_by_orig:
+        _info(_tr('Đường cắt không tạo ra phần tách (≥2) nào.'))
+        return 0, 0
+
+    # 3) Thiết lập đo diện tích + đơn vị ghi ra
+    d = QgsDistanceArea()
+    d.setSourceCrs(lyr.crs(), QgsProject.instance().transformContext())
+    # dùng ellipsoid của project nếu có
+    try:
+        ell = QgsProject.instance().ellipsoid()
+        if ell:
+            d.setEllipsoid(ell)
+    except Exception:
+        pass
+    factor_m2_to_target = _area_factor(area_units_mode)
+
+    # 4) Chỉ số trường trên lớp gốc
+    idx_area = lyr.fields().indexFromName(area_field) if (recalc_area and area_field) else -1
+    idx_value = lyr.fields().indexFromName(value_field) if (preserve and value_field) else -1
+    if preserve and idx_value < 0:
+        if feedback:
+            feedback.reportError(_tr("Không tìm thấy trường bảo toàn dữ liệu trên lớp đầu vào — bỏ qua Preserve."))
+        preserve = False
+
+    # 5) Sửa in-place
+    started_edit = False
+    if not lyr.isEditable():
+        if not lyr.startEditing():
+            raise QgsProcessingException(_tr('Không thể mở chế độ chỉnh sửa cho lớp INPUT.'))
+        started_edit = True
+
+    del_ids = list(parts_by_orig)
+    lyr.deleteFeatures(del_ids)
+
+    new_feats = []
+    for oid, plist in parts_by_orig.items():
+        base_attrs = targets[oid].attributes()
+        areas_m2 = [d.measureArea(g) for g in plist]
+        # Tổng diện tích m² để chia tỉ lệ
+        total_area_m2 = sum(areas_m2)
+
+        v0 = None
+        if preserve and idx_value >= 0:
+            try:
+                v0 = float(base_attrs[idx_value])
+            except Exception:
+                v0 = None
+
+        acc_value = 0.0
+        for i, (g, a_m2) in enumerate(zip(plist, areas_m2)):
+            nf = QgsFeature(lyr.fields())
+            nf.setGeometry(g)
+            nf.setAttributes(list(base_attrs))
+
+            # Ghi diện tích theo đơn vị đã chọn
+            if idx_area >= 0:
+                nf.setAttribute(idx_area, a_m2 * factor_m2_to_target)
+
+            # Phân phối giá trị theo tỉ lệ diện tích (đảm bảo tổng = v0)
+            if preserve and idx_value >= 0 and v0 is not None:
+                if i < len(plist) - 1 and total_area_m2 > 0:
+                    v_part = v0 * (a_m2 / total_area_m2)
+                    acc_value += v_part
+                else:
+                    v_part = v0 - acc_value
+                nf.setAttribute(idx_value, v_part)
+
+            new_feats.append(nf)
+
+    if new_feats:
+        lyr.addFeatures(new_feats)
+    lyr.updateExtents()
+
+    if started_edit:
+        if not lyr.commitChanges():
+            lyr.rollBack()
+            raise QgsProcessingException(_tr('Commit thay đổi thất bại cho lớp INPUT.'))
+    else:
+        lyr.triggerRepaint()
+
+    _info(_tr(f'Đã tách {len(del_ids)} đối tượng; thêm {len(new_feats)} phần.'))
+    return len(del_ids), len(new_feats)
+
+
 class SplitPolygonsInPlaceAlgorithm(QgsProcessingAlgorithm):
     # ----- IDs & Labels -----
     ALG_NAME = 'split_polygons_inplace_by_lines'
@@ -105,8 +288,6 @@ class SplitPolygonsInPlaceAlgorithm(QgsProcessingAlgorithm):
 
     # ===== Core =====
     def processAlgorithm(self, parameters, context, feedback):
-        import processing  # import nội bộ
-
         lyr: QgsVectorLayer = self.parameterAsVectorLayer(parameters, self.P_INPUT, context)
         lines: QgsVectorLayer = self.parameterAsVectorLayer(parameters, self.P_LINES, context)
         selected_only = self.parameterAsBool(parameters, self.P_SELECTED_ONLY, context)
@@ -127,206 +308,25 @@ class SplitPolygonsInPlaceAlgorithm(QgsProcessingAlgorithm):
             feedback.reportError(self.tr("Bật 'Bảo toàn dữ liệu' nhưng chưa chọn trường số — bỏ qua Preserve."))
             preserve = False
 
-        # 0) ÉP LỚP LINES VỀ CRS CỦA INPUT (rất quan trọng!)
+        # 0) ĐƯA ĐƯỜNG CẮT VỀ CRS CỦA INPUT (rất quan trọng!) — biến đổi trực tiếp hình học, không lớp tạm
+        xform = None
         if lines.crs() != lyr.crs():
             feedback.pushInfo(self.tr(f"[CRS] Reproject LINES → {lyr.crs().authid()}"))
-            try:
-                reproj = processing.run(
-                    'native:reprojectlayer',
-                    {'INPUT': lines, 'TARGET_CRS': lyr.crs(), 'OPERATION': '', 'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT},
-                    is_child_algorithm=True, context=context, feedback=feedback
-                )
-                out_obj = reproj.get('OUTPUT')
-                if isinstance(out_obj, QgsVectorLayer):
-                    lines_in = out_obj
-                else:
-                    lines_in = QgsProcessingUtils.mapLayerFromString(out_obj, context)
-                    if lines_in is None or not isinstance(lines_in, QgsVectorLayer):
-                        lines_in = QgsVectorLayer(out_obj, 'lines_reprojected', 'ogr')
-                if not lines_in or not lines_in.isValid():
-                    raise QgsProcessingException(self.tr('Reproject LINES thất bại.'))
-                lines = lines_in
-            except Exception as e:
-                raise QgsProcessingException(self.tr(f'Không thể reproject LINES: {e!r}'))
-
-        # 1) Xác định tập feature mục tiêu
-        target_ids = set()
-        if selected_only:
-            target_ids = set(lyr.selectedFeatureIds())
-        else:
-            lines_extent = lines.extent()
-            for f in lyr.getFeatures():
-                if not f.geometry():
-                    continue
-                if not f.geometry().boundingBox().intersects(lines_extent):
-                    continue
-                hit = False
-                for lf in lines.getFeatures():
-                    if lf.geometry() and f.geometry().intersects(lf.geometry()):
-                        hit = True
-                        break
-                if hit:
-                    target_ids.add(f.id())
-
-        if not target_ids:
-            feedback.pushInfo(self.tr('Không có đối tượng nào bị đường cắt tác động.'))
-            return {}
-
-        # 2) Subset memory + __orig_id
-        is_multi = QgsWkbTypes.isMultiType(lyr.wkbType())
-        geom_str = 'MultiPolygon' if is_multi else 'Polygon'
-        crs_authid = lyr.crs().authid()
-        mem = QgsVectorLayer(f'{geom_str}?crs={crs_authid}', 'tmp_subset', 'memory')
-        prov = mem.dataProvider()
-        fields = lyr.fields()
-        new_fields = QgsFields(fields)
-        new_fields.append(QgsField('__orig_id', QVariant.LongLong))
-        prov.addAttributes(new_fields)
-        mem.updateFields()
-
-        id_to_attrs = {}
-        feats = []
-        idx_orig = new_fields.indexFromName('__orig_id')
-        for f in lyr.getFeatures():
-            if f.id() in target_ids:
-                nf = QgsFeature(new_fields)
-                nf.setGeometry(f.geometry())
-                attrs = f.attributes()
-                for i in range(len(fields)):
-                    nf[i] = attrs[i]
-                nf[idx_orig] = f.id()
-                feats.append(nf)
-                id_to_attrs[f.id()] = attrs
-        prov.addFeatures(feats)
-        mem.updateExtents()
-
-        # 3) Split (dùng LINES đã reproject)
-        try:
-            res = processing.run(
-                'native:splitwithlines',
-                {'INPUT': mem, 'LINES': lines, 'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT},
-                is_child_algorithm=True, context=context, feedback=feedback
-            )
-        except Exception as e:
-            raise QgsProcessingException(self.tr(f'Lỗi khi chạy native:splitwithlines: {e!r}'))
-
-        out_obj = res.get('OUTPUT')
-        if isinstance(out_obj, QgsVectorLayer):
-            out_lyr = out_obj
-        else:
-            out_lyr = QgsProcessingUtils.mapLayerFromString(out_obj, context)
-            if out_lyr is None or not isinstance(out_lyr, QgsVectorLayer):
-                out_lyr = QgsVectorLayer(out_obj, 'split_tmp', 'ogr')
-                if not out_lyr.isValid():
-                    raise QgsProcessingException(self.tr(f"Không nạp được OUTPUT từ splitwithlines: {out_obj!r}"))
-
-        # 4) Gom nhóm theo __orig_id
-        parts_by_orig = {}
-        for pf in out_lyr.getFeatures():
-            oid = pf['__orig_id']
-            parts_by_orig.setdefault(oid, []).append(pf)
-
-        if not any(len(v) >= 2 for v in parts_by_orig.values()):
-            feedback.pushInfo(self.tr('Đường cắt không tạo ra phần tách (≥2) nào.'))
-            return {}
-
-        # 5) Thiết lập đo diện tích + đơn vị ghi ra
-        d = QgsDistanceArea()
-        d.setSourceCrs(out_lyr.crs(), QgsProject.instance().transformContext())
-        # dùng ellipsoid của project nếu có
-        try:
-            ell = QgsProject.instance().ellipsoid()
-            if ell:
-                d.setEllipsoid(ell)
-        except Exception:
-            pass
-
-        if area_units_mode == 0:
-            # Theo Project
-            if hasattr(QgsProject.instance(), 'areaUnits'):
-                target_unit = QgsProject.instance().areaUnits()
-            else:
-                target_unit = QgsUnitTypes.AreaSquareMeters
-        elif area_units_mode == 1:
-            target_unit = QgsUnitTypes.AreaSquareMeters
-        else:
-            target_unit = QgsUnitTypes.AreaHectares
-
-        try:
-            factor_m2_to_target = QgsUnitTypes.fromUnitToUnitFactor(QgsUnitTypes.AreaSquareMeters, target_unit)
-        except Exception:
-            factor_m2_to_target = 1.0 if target_unit == QgsUnitTypes.AreaSquareMeters else 1.0 / 10000.0
-
-        # 6) Chỉ số trường trên lớp gốc
-        idx_area = lyr.fields().indexFromName(area_field) if (recalc_area and area_field) else -1
-        idx_value = lyr.fields().indexFromName(value_field) if (preserve and value_field) else -1
-        if preserve and idx_value < 0:
-            feedback.reportError(self.tr("Không tìm thấy trường bảo toàn dữ liệu trên lớp đầu vào — bỏ qua Preserve."))
-            preserve = False
-
-        # 7) Sửa in-place
-        started_edit = False
-        if not lyr.isEditable():
-            if not lyr.startEditing():
-                raise QgsProcessingException(self.tr('Không thể mở chế độ chỉnh sửa cho lớp INPUT.'))
-            started_edit = True
-
-        del_ids = [oid for oid, plist in parts_by_orig.items() if len(plist) >= 2]
-        if del_ids:
-            lyr.deleteFeatures(del_ids)
-
-        new_feats = []
-        for oid, plist in parts_by_orig.items():
-            if len(plist) < 2:
+            xform = QgsCoordinateTransform(lines.crs(), lyr.crs(), context.transformContext())
+        cut_lines = []
+        for lf in lines.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            if not lf.hasGeometry():
                 continue
-            base_attrs = id_to_attrs.get(oid)
-            if base_attrs is None:
-                continue
-
-            # Tổng diện tích m² để chia tỉ lệ
-            total_area_m2 = sum(d.measureArea(pf.geometry()) for pf in plist)
-
-            v0 = None
-            if preserve and idx_value >= 0:
+            g = QgsGeometry(lf.geometry())
+            if xform is not None:
                 try:
-                    v0 = float(base_attrs[idx_value])
-                except Exception:
-                    v0 = None
-
-            acc_value = 0.0
-            for i, pf in enumerate(plist):
-                nf = QgsFeature(lyr.fields())
-                nf.setGeometry(pf.geometry())
-                nf.setAttributes(list(base_attrs))
-
-                # Ghi diện tích theo đơn vị đã chọn
-                if idx_area >= 0:
-                    a_m2 = d.measureArea(pf.geometry())
-                    a_val = a_m2 * factor_m2_to_target
-                    nf.setAttribute(idx_area, a_val)
-
-                # Phân phối giá trị theo tỉ lệ diện tích (đảm bảo tổng = v0)
-                if preserve and idx_value >= 0 and v0 is not None:
-                    part_area_m2 = d.measureArea(pf.geometry())
-                    if i < len(plist) - 1 and total_area_m2 > 0:
-                        v_part = v0 * (part_area_m2 / total_area_m2)
-                        acc_value += v_part
-                    else:
-                        v_part = (v0 - acc_value) if v0 is not None else 0.0
-                    nf.setAttribute(idx_value, v_part)
-
-                new_feats.append(nf)
-
-        if new_feats:
-            lyr.addFeatures(new_feats)
-        lyr.updateExtents()
-
-        if started_edit:
-            if not lyr.commitChanges():
-                lyr.rollBack()
-                raise QgsProcessingException(self.tr('Commit thay đổi thất bại cho lớp INPUT.'))
-        else:
-            lyr.triggerRepaint()
-
-        feedback.pushInfo(self.tr(f'Đã tách {len(del_ids)} đối tượng; thêm {len(new_feats)} phần.'))
+                    g.transform(xform)
+                except Exception as e:
+                    raise QgsProcessingException(self.tr(f'Không thể reproject LINES: {e!r}'))
+            cut_lines.append(g)
+
+        split_polygons_inplace(
+            lyr, cut_lines, selected_only=selected_only, preserve=preserve, value_field=value_field,
+            recalc_area=recalc_area, area_field=area_field, area_units_mode=area_units_mode,
+            feedback=feedback)
         return {}
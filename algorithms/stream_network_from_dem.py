@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm, QgsProcessingException,
     QgsProcessingParameterRasterLayer, QgsProcessingParameterBoolean,
     QgsProcessingParameterNumber, QgsProcessingParameterEnum,
     QgsProcessingParameterFeatureSink, QgsProcessingParameterRasterDestination,
     QgsProcessingParameterString, QgsApplication, QgsVectorLayer,
-    QgsWkbTypes
+    QgsWkbTypes, QgsProcessingUtils, QgsFields, QgsField, QgsFeature,
+    QgsGeometry, QgsPointXY, QgsMemoryProviderUtils
 )
 from qgis import processing
+import numpy as np
+from osgeo import gdal
+
+from ..hydro_utils import (
+    FDIR_NODATA, read_band, read_array, write_band, fill_depressions, d8_flow_direction, receivers,
+    topological_levels, flow_accumulation, stream_order, label_basins,
+    fill_depressions_tiled, d8_flow_direction_tiled, flow_accumulation_tiled, stream_order_tiled,
+    write_sparse_tiled, sample_sparse, trace_links
+)
+from ..hydro_cache import HydroCache
 
 
 def _tr(s): return QCoreApplication.translate("StreamFromDEM", s)
@@ -23,6 +34,10 @@ class StreamFromDEM(QgsProcessingAlgorithm):
     MAKE_BASINS = "MAKE_BASINS"
     ENGINE = "ENGINE"
     EXTRA_OPTS = "EXTRA_OPTS"
+    TILED = "TILED"
+    TILE_SIZE = "TILE_SIZE"
+    USE_CACHE = "USE_CACHE"
+    CACHE_MAX_MB = "CACHE_MAX_MB"
 
     # smooth + filter
     SMOOTH_ENABLE = "SMOOTH_ENABLE"
@@ -41,7 +56,7 @@ class StreamFromDEM(QgsProcessingAlgorithm):
     OUT_STREAM_R = "OUT_STREAM_R"  # raster (0/1)
     OUT_ORDER_R = "OUT_ORDER_R"    # raster (Strahler)
 
-    ENGINES = ["Auto (SAGA→GRASS→WBT)", "SAGA", "GRASS", "WhiteboxTools"]
+    ENGINES = ["Auto (SAGA→GRASS→WBT→NumPy)", "SAGA", "GRASS", "WhiteboxTools", "Built-in (NumPy)"]
     ORDERS = ["Strahler", "Shreve"]
     SMOOTH_METHODS = ["Douglas–Peucker (simplify)", "Chaikin (smooth)"]
 
@@ -53,6 +68,15 @@ class StreamFromDEM(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr(
             "Sinh mạng lưới sông suối & phân cấp từ DEM. AUTO sẽ ưu tiên SAGA rồi tới GRASS/WBT.\n"
+            "Built-in (NumPy): lấp hố, D8, tích luỹ, phân cấp Strahler/Shreve ngay trong bộ nhớ, "
+            "không cần provider ngoài (AUTO tự dùng khi thiếu SAGA/GRASS/WBT).\n"
+            "TILED: lấp hố, D8 và tích luỹ theo từng tile TILE_SIZE (DEM lớn hơn RAM), kết quả như Built-in "
+            "chạy một lượt; chưa hỗ trợ MAKE_BASINS.\n"
+            "NumPy vector hoá bằng cách lần theo lưới D8: mỗi đoạn (link) từ đầu nguồn/hợp lưu tới hợp lưu kế tiếp "
+            "là một LineString, có stream_ord, up_cells/up_area (diện tích thượng lưu) và ds_link (link hạ lưu).\n"
+            "USE_CACHE: lưu DEM đã lấp hố / hướng dòng chảy / tích luỹ vào cache trên đĩa (khoá = hash DEM + "
+            "bộ máy + lấp hố); chạy lại cùng DEM với THRESH/ORDER_MIN khác sẽ bỏ qua các bước này. "
+            "CACHE_MAX_MB giới hạn dung lượng (xoá mục dùng lâu nhất).\n"
             "THRESH = ngưỡng tích luỹ (số ô). ORDER_MIN = cấp bậc tối thiểu để xuất vector.\n"
             "Khuyến nghị CRS theo mét để MIN_LENGTH, tolerance… có ý nghĩa không gian."
         )
@@ -111,6 +135,18 @@ class StreamFromDEM(QgsProcessingAlgorithm):
                                                      options=self.ENGINES, defaultValue=0))
         self.addParameter(QgsProcessingParameterString(self.EXTRA_OPTS, self.tr("Tùy chọn nâng cao"),
                                                        defaultValue="", optional=True))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.TILED, self.tr("Tích luỹ theo tile (DEM lớn hơn RAM, dùng Built-in NumPy)"), False))
+        self.addParameter(self._num(
+            self.TILE_SIZE, self.tr("Kích thước TILE (px)"),
+            QgsProcessingParameterNumber.Integer, default=2048, minv=256
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.USE_CACHE, self.tr("Dùng cache raster trung gian (lấp hố / hướng dòng chảy / tích luỹ)"), True))
+        self.addParameter(self._num(
+            self.CACHE_MAX_MB, self.tr("Dung lượng cache tối đa (MB)"),
+            QgsProcessingParameterNumber.Integer, default=2048, minv=64
+        ))
         # smooth & filter
         self.addParameter(QgsProcessingParameterBoolean(self.SMOOTH_ENABLE, self.tr("Làm trơn/simplify"), False))
         self.addParameter(QgsProcessingParameterEnum(self.SMOOTH_METHOD, self.tr("Phương pháp làm trơn"),
@@ -175,6 +211,18 @@ class StreamFromDEM(QgsProcessingAlgorithm):
                 return matches[0]
         return None
 
+    def _cache_entry(self, dem, parameters, context, feedback, **settings):
+        """Mục cache cho DEM + thiết lập; None nếu tắt cache hoặc DEM không phải file."""
+        if not self.parameterAsBoolean(parameters, self.USE_CACHE, context):
+            return None
+        max_mb = self.parameterAsInt(parameters, self.CACHE_MAX_MB, context)
+        try:
+            cache = HydroCache(max_bytes=max_mb * 1024 * 1024)
+        except OSError as e:
+            feedback.reportError(f"Không tạo được thư mục cache ({e}) — bỏ qua cache.")
+            return None
+        return cache.entry(dem.source(), feedback, **settings)
+
     def _first_raster_from(self, res: dict, prefer_keys=None):
         if not res:
             return None
@@ -208,7 +256,7 @@ class StreamFromDEM(QgsProcessingAlgorithm):
         vlyr = self._to_vlayer(vect_in)
         if not vlyr:
             raise QgsProcessingException("Không đọc được vector stream trung gian.")
-        current = vlyr.source()
+        current = vlyr if vlyr.providerType() == "memory" else vlyr.source()
 
         if do_smooth:
             if method_idx == 0:
@@ -250,6 +298,43 @@ class StreamFromDEM(QgsProcessingAlgorithm):
         for f in v.getFeatures(): sink.addFeature(f)
         return sink_id
 
+    def _links_to_layer(self, links, gt, ncols, crs, order_min, feedback, batch=20000):
+        """
+        Link D8 (từ trace_links) → lớp line memory: mỗi link một LineString qua tâm các ô,
+        nối thêm ô hợp lưu hạ lưu để mạng liền mạch. Link cấp < order_min bị bỏ
+        (cấp không giảm theo dòng chảy nên ds_link của link giữ lại luôn tồn tại).
+        """
+        cells, bounds, l_order, l_acc, l_ds, tail = links
+        fields = QgsFields()
+        for name, ftype in (("link_id", QVariant.Int), ("ds_link", QVariant.Int), ("stream_ord", QVariant.Int),
+                            ("up_cells", QVariant.Double), ("up_area", QVariant.Double)):
+            fields.append(QgsField(name, ftype))
+        layer = QgsMemoryProviderUtils.createMemoryLayer("stream_links", fields, QgsWkbTypes.LineString, crs)
+        pr = layer.dataProvider()
+        cell_area = abs(gt[1] * gt[5])
+        keep = np.flatnonzero(l_order >= int(order_min))
+        n_out = 0
+        for s0 in range(0, keep.size, batch):
+            if feedback.isCanceled(): break
+            feats = []
+            for k in keep[s0:s0 + batch]:
+                g = cells[bounds[k]:bounds[k + 1]]
+                if tail[k] >= 0:
+                    g = np.append(g, tail[k])
+                if g.size < 2:
+                    continue   # ô stream đơn lẻ, không có hình học line
+                xs = gt[0] + (g % ncols + 0.5) * gt[1]
+                ys = gt[3] + (g // ncols + 0.5) * gt[5]
+                f = QgsFeature(fields)
+                f.setGeometry(QgsGeometry.fromPolylineXY([QgsPointXY(x, y) for x, y in zip(xs, ys)]))
+                f.setAttributes([int(k) + 1, int(l_ds[k]) or None, int(l_order[k]),
+                                 float(l_acc[k]), float(l_acc[k]) * cell_area])
+                feats.append(f)
+            pr.addFeatures(feats)
+            n_out += len(feats)
+        feedback.pushInfo(f"Đã lần theo {l_order.size} link D8, xuất {n_out} link (cấp ≥ {int(order_min)}).")
+        return layer
+
     def _raster_to_lines(self, raster_mask, context, feedback):
         """
         Chuyển raster mask (0/1) sang line vector (QGIS 3.16 an toàn).
@@ -314,6 +399,7 @@ class StreamFromDEM(QgsProcessingAlgorithm):
         make_basins = self.parameterAsBoolean(parameters, self.MAKE_BASINS, context)
         engine_idx = self.parameterAsEnum(parameters, self.ENGINE, context)
         order_min = max(0, self.parameterAsInt(parameters, self.ORDER_MIN, context))
+        tiled = self.parameterAsBoolean(parameters, self.TILED, context)
 
         do_smooth = self.parameterAsBoolean(parameters, self.SMOOTH_ENABLE, context)
         method_idx = self.parameterAsEnum(parameters, self.SMOOTH_METHOD, context)
@@ -329,6 +415,13 @@ class StreamFromDEM(QgsProcessingAlgorithm):
         if engine_idx == 1: backend = "SAGA"
         elif engine_idx == 2: backend = "GRASS"
         elif engine_idx == 3: backend = "WBT"
+        elif engine_idx == 4: backend = "NUMPY"
+
+        if tiled and make_basins:
+            raise QgsProcessingException("Chế độ tile chưa hỗ trợ sinh lưu vực (MAKE_BASINS) — tắt một trong hai.")
+        if tiled and backend != "NUMPY":
+            feedback.pushInfo("Chế độ tile: tích luỹ bằng Built-in (NumPy) theo từng tile.")
+            backend = "NUMPY"
 
         if backend == "AUTO":
             if self._has_provider("saga"):
@@ -338,13 +431,19 @@ class StreamFromDEM(QgsProcessingAlgorithm):
             elif self._has_provider("wbt"):
                 backend = "WBT"
             else:
-                raise QgsProcessingException("Không thấy SAGA/GRASS/WBT trong Processing.")
+                feedback.pushInfo("Không thấy SAGA/GRASS/WBT trong Processing → dùng Built-in (NumPy).")
+                backend = "NUMPY"
 
         if backend == "SAGA":
             return self._run_saga(dem, use_fill, thresh, make_basins, order_min,
                                   out_acc, out_stream_r, out_order_r,
                                   parameters, context, feedback,
                                   do_smooth, method_idx, tol, iters, min_len)
+        elif backend == "NUMPY":
+            return self._run_numpy(dem, use_fill, thresh, make_basins, order_min,
+                                   out_acc, out_stream_r, out_order_r,
+                                   parameters, context, feedback,
+                                   do_smooth, method_idx, tol, iters, min_len)
         elif backend == "GRASS":
             return self._run_grass(dem, use_fill, thresh, make_basins, order_min,
                                    out_acc, out_stream_r, out_order_r,
@@ -366,9 +465,15 @@ class StreamFromDEM(QgsProcessingAlgorithm):
         fill_id = self._pick_alg("saga",
                                  ["saga:fillsinkswangliu", "saga:fillsinksplanchon"],
                                  [["fill","sinks","wang"], ["fill","sinks","planchon"]])
+        cache = self._cache_entry(dem, parameters, context, feedback, engine="saga", fill=bool(use_fill))
         dem_in = dem
         filled_res = None
-        if use_fill and fill_id:
+        cached_fill = cache.get("filled") if cache and use_fill else None
+        if cached_fill:
+            dem_in = cached_fill
+            wshed = cache.get("wshed") if make_basins else None
+            filled_res = {"FILLED": cached_fill, "WSHED": wshed}
+        elif use_fill and fill_id:
             feedback.pushInfo(f"SAGA: {fill_id}…")
             try:
                 filled_res = self._try_run(fill_id, [
@@ -377,33 +482,20 @@ class StreamFromDEM(QgsProcessingAlgorithm):
                     {"ELEVATION": dem_in, "FILLED": "TEMPORARY_OUTPUT"}
                 ], context, feedback)
                 dem_in = filled_res.get("FILLED", dem_in)
+                if cache and filled_res.get("FILLED"):
+                    dem_in = cache.put("filled", dem_in)
+                    if filled_res.get("WSHED"):
+                        cache.put("wshed", filled_res["WSHED"])
             except Exception as e:
                 feedback.reportError(f"Fill sinks lỗi ({e}), dùng DEM gốc.")
 
-        # Flow accumulation
-        acc_id = self._pick_alg("saga",
-                                ["saga:flowaccumulationqmofesp","saga:flowaccumulationtopdown",
-                                 "saga:flowaccumulationparallel","saga:flowaccumulation"],
-                                [["flow","accumulation","qm"],["flow","accumulation","top"],
-                                 ["flow","accumulation","parallel"],["flow","accumulation"]])
-        if not acc_id:
-            raise QgsProcessingException("Không tìm thấy SAGA Flow Accumulation.")
-        feedback.pushInfo(f"SAGA: {acc_id}…")
-        if "qmofesp" in acc_id.lower():
-            fa = self._try_run(acc_id, [
-                {"DEM": dem_in, "FLOW": "TEMPORARY_OUTPUT"},
-                {"ELEVATION": dem_in, "FLOW": "TEMPORARY_OUTPUT"}
-            ], context, feedback)
-            acc_r = fa.get("FLOW")
-        else:
-            fa = self._try_run(acc_id, [
-                {"ELEVATION": dem_in, "ACCU": "TEMPORARY_OUTPUT"},
-                {"ELEV": dem_in, "ACCU": "TEMPORARY_OUTPUT"},
-                {"DEM": dem_in, "ACCU": "TEMPORARY_OUTPUT"}
-            ], context, feedback)
-            acc_r = fa.get("ACCU") or self._first_raster_from(fa, ["ACCU","FLOW","AREA","SCA"])
+        # Flow accumulation (chỉ cache khi DEM đúng như khoá: không lấp hố, hoặc lấp hố thành công)
+        cacheable = cache is not None and (not use_fill or dem_in is not dem)
+        acc_r = cache.get("acc") if cacheable else None
         if not acc_r:
-            raise QgsProcessingException("Không lấy được raster tích luỹ từ SAGA.")
+            acc_r = self._saga_accumulation(dem_in, context, feedback)
+            if cacheable:
+                acc_r = cache.put("acc", acc_r)
 
         # Channel Network
         chn_id = self._pick_alg("saga", ["saga:channelnetwork"], [["channel","network"]])
@@ -482,14 +574,43 @@ class StreamFromDEM(QgsProcessingAlgorithm):
             self.OUT_BASINS: basins_sink_id
         }
 
+    def _saga_accumulation(self, dem_in, context, feedback):
+        acc_id = self._pick_alg("saga",
+                                ["saga:flowaccumulationqmofesp","saga:flowaccumulationtopdown",
+                                 "saga:flowaccumulationparallel","saga:flowaccumulation"],
+                                [["flow","accumulation","qm"],["flow","accumulation","top"],
+                                 ["flow","accumulation","parallel"],["flow","accumulation"]])
+        if not acc_id:
+            raise QgsProcessingException("Không tìm thấy SAGA Flow Accumulation.")
+        feedback.pushInfo(f"SAGA: {acc_id}…")
+        if "qmofesp" in acc_id.lower():
+            fa = self._try_run(acc_id, [
+                {"DEM": dem_in, "FLOW": "TEMPORARY_OUTPUT"},
+                {"ELEVATION": dem_in, "FLOW": "TEMPORARY_OUTPUT"}
+            ], context, feedback)
+            acc_r = fa.get("FLOW")
+        else:
+            fa = self._try_run(acc_id, [
+                {"ELEVATION": dem_in, "ACCU": "TEMPORARY_OUTPUT"},
+                {"ELEV": dem_in, "ACCU": "TEMPORARY_OUTPUT"},
+                {"DEM": dem_in, "ACCU": "TEMPORARY_OUTPUT"}
+            ], context, feedback)
+            acc_r = fa.get("ACCU") or self._first_raster_from(fa, ["ACCU","FLOW","AREA","SCA"])
+        if not acc_r:
+            raise QgsProcessingException("Không lấy được raster tích luỹ từ SAGA.")
+        return acc_r
+
     # ---- GRASS (fallback) ----
     def _run_grass(self, dem, use_fill, thresh, make_basins, order_min,
                    out_acc, out_stream_r, out_order_r,
                    parameters, context, feedback,
                    do_smooth, method_idx, tol, iters, min_len):
 
+        cache = self._cache_entry(dem, parameters, context, feedback, engine="grass", fill=bool(use_fill))
         dem_in = dem
-        if use_fill and self._has("grass7:r.fill.dir"):
+        if use_fill:
+            dem_in = (cache.get("filled") if cache else None) or dem
+        if use_fill and dem_in is dem and self._has("grass7:r.fill.dir"):
             feedback.pushInfo("GRASS: r.fill.dir…")
             rfill = processing.run("grass7:r.fill.dir", {
                 "input": dem_in, "output": "TEMPORARY_OUTPUT",
@@ -497,16 +618,23 @@ class StreamFromDEM(QgsProcessingAlgorithm):
                 "GRASS_REGION_PARAMETER": None, "GRASS_REGION_CELLSIZE_PARAMETER": 0,
                 "GRASS_RASTER_FORMAT_OPT": "", "GRASS_RASTER_FORMAT_META": ""
             }, context=context, feedback=feedback)
-            dem_in = rfill["output"]
-
-        feedback.pushInfo("GRASS: r.watershed…")
-        ws = processing.run("grass7:r.watershed", {
-            "elevation": dem_in, "accumulation": "TEMPORARY_OUTPUT", "drainage": "TEMPORARY_OUTPUT",
-            "convergence": 5, "memory": 300, "threshold": 0,
-            "GRASS_REGION_PARAMETER": None, "GRASS_REGION_CELLSIZE_PARAMETER": 0,
-            "GRASS_RASTER_FORMAT_OPT": "", "GRASS_RASTER_FORMAT_META": ""
-        }, context=context, feedback=feedback)
-        acc_r = ws["accumulation"]; dir_r = ws["drainage"]
+            dem_in = cache.put("filled", rfill["output"]) if cache else rfill["output"]
+
+        cacheable = cache is not None and (not use_fill or dem_in is not dem)
+        acc_r = cache.get("acc") if cacheable else None
+        dir_r = cache.get("drainage") if acc_r else None
+        if not (acc_r and dir_r):
+            feedback.pushInfo("GRASS: r.watershed…")
+            ws = processing.run("grass7:r.watershed", {
+                "elevation": dem_in, "accumulation": "TEMPORARY_OUTPUT", "drainage": "TEMPORARY_OUTPUT",
+                "convergence": 5, "memory": 300, "threshold": 0,
+                "GRASS_REGION_PARAMETER": None, "GRASS_REGION_CELLSIZE_PARAMETER": 0,
+                "GRASS_RASTER_FORMAT_OPT": "", "GRASS_RASTER_FORMAT_META": ""
+            }, context=context, feedback=feedback)
+            acc_r = ws["accumulation"]; dir_r = ws["drainage"]
+            if cacheable:
+                acc_r = cache.put("acc", acc_r)
+                dir_r = cache.put("drainage", dir_r)
 
         feedback.pushInfo("GRASS: r.stream.extract…")
         st = processing.run("grass7:r.stream.extract", {
@@ -591,20 +719,23 @@ class StreamFromDEM(QgsProcessingAlgorithm):
         if not self._has_provider("wbt"):
             raise QgsProcessingException("WhiteboxTools không sẵn có.")
 
+        cache = self._cache_entry(dem, parameters, context, feedback, engine="wbt", fill=bool(use_fill))
+        acc_r = cache.get("acc") if cache else None
         dem_in = dem
-        if use_fill:
+        if use_fill and not acc_r:
             feedback.pushInfo("WBT: breachdepressionsleastcost…")
             br = processing.run("wbt:breachdepressionsleastcost", {
                 "dem": dem_in, "out_dem": "TEMPORARY_OUTPUT"
             }, context=context, feedback=feedback)
             dem_in = br["out_dem"]
 
-        feedback.pushInfo("WBT: d8flowaccumulation…")
-        fa = processing.run("wbt:d8flowaccumulation", {
-            "i": dem_in, "out_type": 0, "dn": None, "esri_pntr": False,
-            "log": False, "clip": False, "o": "TEMPORARY_OUTPUT"
-        }, context=context, feedback=feedback)
-        acc_r = fa["o"]
+        if not acc_r:
+            feedback.pushInfo("WBT: d8flowaccumulation…")
+            fa = processing.run("wbt:d8flowaccumulation", {
+                "i": dem_in, "out_type": 0, "dn": None, "esri_pntr": False,
+                "log": False, "clip": False, "o": "TEMPORARY_OUTPUT"
+            }, context=context, feedback=feedback)
+            acc_r = cache.put("acc", fa["o"]) if cache else fa["o"]
 
         feedback.pushInfo("WBT: extractstreams…")
         ex = processing.run("wbt:extractstreams", {
@@ -655,3 +786,179 @@ class StreamFromDEM(QgsProcessingAlgorithm):
             self.OUT_ORDER_R: order_tif,
             self.OUT_BASINS: None
         }
+
+    # ---- Built-in NumPy (không ghi raster trung gian) ----
+    def _run_numpy(self, dem, use_fill, thresh, make_basins, order_min,
+                   out_acc, out_stream_r, out_order_r,
+                   parameters, context, feedback,
+                   do_smooth, method_idx, tol, iters, min_len):
+
+        order_method = "shreve" if self.parameterAsEnum(parameters, self.METHOD_ORDER, context) == 1 else "strahler"
+        if self.parameterAsBoolean(parameters, self.TILED, context):
+            return self._run_numpy_tiled(dem, use_fill, thresh, make_basins, order_min, order_method,
+                                         out_acc, out_stream_r, out_order_r,
+                                         parameters, context, feedback,
+                                         do_smooth, method_idx, tol, iters, min_len)
+
+        cache = self._cache_entry(dem, parameters, context, feedback, engine="numpy", fill=bool(use_fill))
+        fdir_c = cache.get("fdir") if cache else None
+        if fdir_c:
+            fdir, gt, proj = read_array(fdir_c)
+            valid = fdir != FDIR_NODATA
+        else:
+            feedback.pushInfo("NumPy: đọc DEM…")
+            z, gt, proj = read_band(dem.source())
+            valid = np.isfinite(z)
+            if not valid.any():
+                raise QgsProcessingException("DEM không có ô hợp lệ.")
+            feedback.setProgress(5)
+
+            if use_fill:
+                feedback.pushInfo("NumPy: lấp hố trũng…")
+                z = fill_depressions(z)
+            if feedback.isCanceled(): return {}
+            feedback.setProgress(25)
+
+            feedback.pushInfo("NumPy: hướng dòng chảy D8…")
+            fdir = d8_flow_direction(z, abs(gt[1]), abs(gt[5]))
+            del z
+            if cache:
+                cache.put("fdir", write_band(cache.target("fdir"), fdir, gt, proj, gdal.GDT_Byte, nodata=FDIR_NODATA))
+        rec = receivers(fdir)
+        del fdir
+        if feedback.isCanceled(): return {}
+        feedback.setProgress(45)
+
+        feedback.pushInfo("NumPy: tích luỹ dòng chảy…")
+        order, bounds = topological_levels(rec, valid)
+        acc = flow_accumulation(rec, order, bounds)
+        if feedback.isCanceled(): return {}
+        feedback.setProgress(65)
+
+        feedback.pushInfo(f"NumPy: phân cấp {order_method.capitalize()}…")
+        stream = (acc >= float(thresh)) & valid.ravel()
+        so = stream_order(rec, order, bounds, stream, order_method)
+        feedback.setProgress(75)
+
+        shape = valid.shape
+        acc_out = acc.astype(np.float32).reshape(shape)
+        acc_out[~valid] = -1.0
+        acc_tif = write_band(out_acc, acc_out, gt, proj, gdal.GDT_Float32, nodata=-1.0)
+        del acc_out
+        stream_tif = write_band(out_stream_r, stream.reshape(shape).astype(np.uint8), gt, proj, gdal.GDT_Byte, nodata=0)
+        if order_method == "shreve":
+            order_tif = write_band(out_order_r, so.reshape(shape), gt, proj, gdal.GDT_Int32, nodata=0)
+        else:
+            order_tif = write_band(out_order_r, np.minimum(so, 255).astype(np.uint8).reshape(shape),
+                                   gt, proj, gdal.GDT_Byte, nodata=0)
+
+        # Vector hoá: lần theo lưới D8, mỗi link một LineString (lọc theo ORDER_MIN)
+        feedback.pushInfo("NumPy: lần theo mạng sông trên lưới D8…")
+        gidx = np.flatnonzero(stream)
+        links = trace_links(gidx, rec[gidx], so[gidx], acc[gidx])
+        del gidx
+        feedback.setProgress(80)
+
+        vec_links = self._links_to_layer(links, gt, shape[1], dem.crs(), order_min, feedback)
+        del links
+        final_tmp = self._postprocess_streams(vec_links, do_smooth, method_idx, tol, iters, min_len, context, feedback)
+        streams_sink_id = self._copy_vector_to_sink(final_tmp, self.OUT_STREAMS, parameters, context, feedback)
+
+        # Basins (tuỳ chọn): mỗi cửa xả một lưu vực
+        basins_sink_id = None
+        if make_basins:
+            feedback.pushInfo("NumPy: gán nhãn lưu vực theo cửa xả…")
+            seeds = np.zeros(rec.size, dtype=np.int32)
+            outlets = np.flatnonzero((rec < 0) & valid.ravel())
+            seeds[outlets] = np.arange(1, outlets.size + 1, dtype=np.int32)
+            bas = label_basins(rec, order, bounds, seeds)
+            bas_tif = QgsProcessingUtils.generateTempFilename("basins.tif")
+            write_band(bas_tif, bas.reshape(shape), gt, proj, gdal.GDT_Int32, nodata=0)
+            bas_vec = processing.run("gdal:polygonize", {
+                "INPUT": bas_tif, "BAND": 1, "FIELD": "id",
+                "EIGHT_CONNECTEDNESS": False, "EXTRA": "",
+                "OUTPUT": "TEMPORARY_OUTPUT"
+            }, context=context, feedback=feedback)["OUTPUT"]
+            basins_sink_id = self._copy_vector_to_sink(bas_vec, self.OUT_BASINS, parameters, context, feedback)
+
+        feedback.setProgress(100)
+        return {
+            self.OUT_STREAMS: streams_sink_id,
+            self.OUT_ACC: acc_tif,
+            self.OUT_STREAM_R: stream_tif,
+            self.OUT_ORDER_R: order_tif,
+            self.OUT_BASINS: basins_sink_id
+        }
+
+    # ---- Built-in NumPy theo tile (bộ nhớ ~ kích thước tile) ----
+    def _run_numpy_tiled(self, dem, use_fill, thresh, make_basins, order_min, order_method,
+                         out_acc, out_stream_r, out_order_r,
+                         parameters, context, feedback,
+                         do_smooth, method_idx, tol, iters, min_len):
+
+        tile = max(256, self.parameterAsInt(parameters, self.TILE_SIZE, context))
+        cache = self._cache_entry(dem, parameters, context, feedback,
+                                  engine="numpy-tiled", fill=bool(use_fill), tile=tile)
+        fdir_tif = cache.get("fdir") if cache else None
+        acc_c = cache.get("acc") if fdir_tif else None
+        if not fdir_tif:
+            dem_src = dem.source()
+            if use_fill:
+                feedback.pushInfo(f"NumPy (tile {tile}px): lấp hố trũng…")
+                dem_src = fill_depressions_tiled(dem_src, QgsProcessingUtils.generateTempFilename("filled.tif"),
+                                                 tile, feedback, (0.0, 20.0))
+            if feedback.isCanceled() or dem_src is None: return {}
+
+            feedback.pushInfo(f"NumPy (tile {tile}px): hướng dòng chảy D8…")
+            fdir_tif = cache.target("fdir") if cache else QgsProcessingUtils.generateTempFilename("fdir.tif")
+            d8_flow_direction_tiled(dem_src, fdir_tif, tile, feedback, (20.0 if use_fill else 0.0, 30.0))
+            if feedback.isCanceled(): return {}
+            if cache:
+                fdir_tif = cache.put("fdir", fdir_tif)
+
+        if acc_c:
+            acc_tif = processing.run("gdal:translate", {
+                "INPUT": acc_c, "TARGET_CRS": None, "NODATA": None,
+                "COPY_SUBDATASETS": False, "OPTIONS": "", "EXTRA": "",
+                "DATA_TYPE": 0, "OUTPUT": out_acc
+            }, context=context, feedback=feedback)["OUTPUT"]
+        else:
+            feedback.pushInfo(f"NumPy (tile {tile}px): tích luỹ dòng chảy…")
+            acc_tif = flow_accumulation_tiled(fdir_tif, out_acc, tile, feedback, (30.0, 70.0))
+            if feedback.isCanceled() or acc_tif is None: return {}
+            if cache:
+                cache.put("acc", acc_tif)
+
+        feedback.pushInfo(f"NumPy: phân cấp {order_method.capitalize()} trên các ô sông…")
+        gidx, so, rcv = stream_order_tiled(fdir_tif, acc_tif, float(thresh), order_method, tile,
+                                           with_receivers=True)
+        stream_tif = write_sparse_tiled(fdir_tif, out_stream_r, gidx, np.ones(gidx.size, dtype=np.uint8),
+                                        gdal.GDT_Byte, tile)
+        if order_method == "shreve":
+            order_tif = write_sparse_tiled(fdir_tif, out_order_r, gidx, so, gdal.GDT_Int32, tile)
+        else:
+            order_tif = write_sparse_tiled(fdir_tif, out_order_r, gidx, np.minimum(so, 255).astype(np.uint8),
+                                           gdal.GDT_Byte, tile)
+
+        # Vector hoá: lần theo lưới D8 (tích luỹ tại ô sông đọc theo khối dòng ~ TILE_SIZE² ô)
+        feedback.pushInfo("NumPy: lần theo mạng sông trên lưới D8…")
+        ds = gdal.Open(fdir_tif, gdal.GA_ReadOnly)
+        gt, ncols = ds.GetGeoTransform(), ds.RasterXSize
+        ds = None
+        links = trace_links(gidx, rcv, so, sample_sparse(acc_tif, gidx, max(1, tile * tile // ncols)))
+        del rcv
+        feedback.setProgress(80)
+
+        vec_links = self._links_to_layer(links, gt, ncols, dem.crs(), order_min, feedback)
+        del links
+        final_tmp = self._postprocess_streams(vec_links, do_smooth, method_idx, tol, iters, min_len, context, feedback)
+        streams_sink_id = self._copy_vector_to_sink(final_tmp, self.OUT_STREAMS, parameters, context, feedback)
+
+        feedback.setProgress(100)
+        return {
+            self.OUT_STREAMS: streams_sink_id,
+            self.OUT_ACC: acc_tif,
+            self.OUT_STREAM_R: stream_tif,
+            self.OUT_ORDER_R: order_tif,
+            self.OUT_BASINS: None
+        }
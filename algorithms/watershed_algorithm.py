@@ -7,13 +7,13 @@ from qgis.core import (
     QgsFeatureRequest,
     QgsFields,
     QgsField,
-    QgsGeometry,
     QgsPointXY,
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingException,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterCrs,
+    QgsProcessingParameterEnum,
     QgsProcessingParameterFeatureSource,
     QgsProcessingParameterNumber,
     QgsProcessingParameterRasterLayer,
@@ -22,10 +22,21 @@ from qgis.core import (
     QgsProject,
     QgsVectorLayer,
     QgsRasterLayer,
-    QgsWkbTypes
+    QgsWkbTypes,
+    QgsProcessingUtils,
+    QgsMemoryProviderUtils
 )
 import math
 import processing
+import numpy as np
+from osgeo import gdal
+
+from ..hydro_utils import (
+    FDIR_NODATA, fill_depressions_tiled, d8_flow_direction_tiled, flow_accumulation_tiled,
+    read_band, read_array, write_band, fill_depressions, d8_flow_direction, receivers,
+    topological_levels, flow_accumulation, label_basins, snap_cell, snap_point_raster
+)
+from ..hydro_cache import HydroCache
 
 
 class WatershedFromDEM(QgsProcessingAlgorithm):
@@ -36,10 +47,17 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
     P_POUR_X = 'POUR_X'
     P_POUR_Y = 'POUR_Y'
     P_POUR_CRS = 'POUR_CRS'
+    P_BATCH = 'BATCH'
     P_SNAP_ENABLE = 'SNAP_ENABLE'
     P_AUTO_THRESH = 'AUTO_THRESHOLD'          # << NEW
     P_SNAP_ACC_THRESH = 'SNAP_ACC_THRESH'
     P_SNAP_RADIUS = 'SNAP_RADIUS'
+    P_SNAP_MODE = 'SNAP_MODE'
+    P_SNAP_REPORT = 'SNAP_REPORT'
+    P_TILED = 'TILED'
+    P_TILE_SIZE = 'TILE_SIZE'
+    P_USE_CACHE = 'USE_CACHE'
+    P_CACHE_MAX_MB = 'CACHE_MAX_MB'
     P_AOI = 'AOI'
     P_SMOOTH_EN = 'SMOOTH_ENABLE'
     P_SMOOTH_IT = 'SMOOTH_ITERS'
@@ -47,6 +65,8 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
     P_SIMP_TOL = 'SIMPLIFY_TOL'
     P_OUTPUT = 'OUTPUT'
 
+    SNAP_MODES = ['Tích luỹ lớn nhất trong bán kính', 'Ô gần nhất đạt ngưỡng']
+
     # ---- metadata
     def name(self): return 'watershed_from_dem'
     def displayName(self): return self.tr('Khoanh vẽ ranh giới lưu vực từ DEM')
@@ -58,9 +78,20 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr(
             "Khoanh vẽ lưu vực từ DEM + pour point (layer hoặc X/Y + CRS). "
-            "Fill sinks (SAGA→GRASS→WBT), Snap theo Flow Accumulation (ngưỡng & bán kính). "
+            "Fill sinks (SAGA→GRASS→WBT), Snap theo Flow Accumulation (ngưỡng & bán kính): chỉ đọc cửa sổ "
+            "raster tích luỹ quanh điểm, dời tới ô tích luỹ lớn nhất hoặc ô gần nhất đạt ngưỡng. "
             "Tùy chọn 'Auto threshold' tự suy ra ngưỡng tích luỹ (cells) ≈ 1 km² dựa trên kích thước ô DEM. "
-            "Có AOI clip, Smooth & Simplify. Tương thích QGIS 3.16+."
+            "Có AOI clip, Smooth & Simplify. Tương thích QGIS 3.16+. "
+            "Tuỳ chọn 'Lấp hố & tích luỹ theo tile' lấp hố và tính Flow Accumulation (NumPy) theo từng khối TILE_SIZE "
+            "(kết quả như NumPy chạy một lượt) để giới hạn bộ nhớ của hai bước này; bước khoanh lưu vực "
+            "(SAGA/GRASS) vẫn đọc cả DEM nên bộ nhớ đỉnh không bị giới hạn bởi kích thước tile. "
+            "Chế độ 'Nhiều cửa xả' lấy mọi điểm của lớp pour point: lấp hố & hướng dòng chảy chỉ tính 1 lần, "
+            "mỗi cửa xả một polygon (lưu vực riêng phần, không chồng lấn) kèm thuộc tính của điểm và nhãn basin_lbl "
+            "(thêm hậu tố _1, _2… nếu lớp điểm đã có trường cùng tên); chế độ này nạp cả DEM "
+            "vào bộ nhớ nên không dùng cùng 'Lấp hố & tích luỹ theo tile', cửa xả không snap được (không ô nào đạt ngưỡng "
+            "trong bán kính) bị bỏ qua và báo lỗi. "
+            "Cache: DEM đã lấp hố / hướng dòng chảy / tích luỹ được lưu trên đĩa theo hash DEM + thiết lập, "
+            "chạy lại với cửa xả hoặc ngưỡng khác sẽ dùng lại (giới hạn dung lượng, xoá mục dùng lâu nhất)."
         )
 
     # ---- UI parameters
@@ -83,6 +114,8 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterCrs(
             self.P_POUR_CRS, self.tr('CRS của toạ độ X/Y (nếu dùng X/Y)'), defaultValue='EPSG:4326'
         ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.P_BATCH, self.tr('Nhiều cửa xả: mỗi điểm của lớp pour point một lưu vực (NumPy, 1 lượt)'), False))
 
         self.addParameter(QgsProcessingParameterBoolean(self.P_SNAP_ENABLE, self.tr('Snap pour point theo Flow Accumulation'), False))
         # NEW: auto threshold toggle (mặc định BẬT)
@@ -96,6 +129,23 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
             self.P_SNAP_RADIUS, self.tr('Bán kính snap (đơn vị CRS DEM)'),
             type=QgsProcessingParameterNumber.Double, defaultValue=200.0, minValue=0.0
         ))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.P_SNAP_MODE, self.tr('Cách snap'), options=[self.tr(m) for m in self.SNAP_MODES], defaultValue=0
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.P_SNAP_REPORT, self.tr('Báo khoảng cách dời pour point (batch: thêm trường snap_dist)'), False))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.P_TILED, self.tr('Lấp hố & tích luỹ theo tile (NumPy; khoanh lưu vực không theo tile)'), False))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.P_TILE_SIZE, self.tr('Kích thước TILE (px)'),
+            type=QgsProcessingParameterNumber.Integer, defaultValue=2048, minValue=256
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.P_USE_CACHE, self.tr('Dùng cache raster trung gian (lấp hố / hướng dòng chảy / tích luỹ)'), True))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.P_CACHE_MAX_MB, self.tr('Dung lượng cache tối đa (MB)'),
+            type=QgsProcessingParameterNumber.Integer, defaultValue=2048, minValue=64
+        ))
 
         self.addParameter(QgsProcessingParameterVectorLayer(
             self.P_AOI, self.tr('AOI (cắt lưu vực theo đa giác này) — tuỳ chọn'),
@@ -165,19 +215,6 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                         if mp: return QgsPointXY(mp[0])
         return None
 
-    def _make_point_layer(self, point_xy: QgsPointXY, crs_authid: str):
-        uri = f'Point?crs={crs_authid}&field=id:integer'
-        vl = QgsVectorLayer(uri, 'pour_point_tmp', 'memory')
-        pr = vl.dataProvider()
-        pr.addAttributes([QgsField('id', QVariant.Int)])
-        vl.updateFields()
-        feat = QgsFeature(vl.fields())
-        feat.setGeometry(QgsGeometry.fromPointXY(point_xy))
-        feat['id'] = 1
-        pr.addFeature(feat)
-        vl.updateExtents()
-        return vl
-
     def _as_raster_src(self, obj):
         if isinstance(obj, str):
             return obj
@@ -224,14 +261,55 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
         py_m = abs(py) * abs(meters_per_deg_y)
         return px_m, py_m
 
-    # -------- FILL SINKS: SAGA → GRASS → WBT --------
-    def _fill_sinks_resilient(self, dem_src, context, feedback):
-        dem_src = self._as_raster_src(dem_src)
+    def _auto_acc_threshold(self, dem_layer, acc_thresh, feedback):
+        try:
+            px_m, py_m = self._estimate_pixel_size_m(dem_layer)
+            pix_m = max(1e-6, (abs(px_m) + abs(py_m)) / 2.0)   # tránh chia 0
+            acc_auto = max(1, int(round(1_000_000.0 / (pix_m * pix_m))))  # 1 km²
+            feedback.pushInfo(self.tr(f"Auto threshold: kích thước ô ≈ {pix_m:.2f} m → ngưỡng ≈ {acc_auto} cells (~1 km²)."))
+            return acc_auto
+        except Exception as e:
+            feedback.reportError(self.tr(f'Không tính được Auto threshold, dùng giá trị nhập tay: {acc_thresh}. Lỗi: {e}'))
+            return acc_thresh
 
-        saga_fill_id = self._pick_alg("saga",
+    def _cache_entry(self, dem_layer, parameters, context, feedback, **settings):
+        if not self.parameterAsBool(parameters, self.P_USE_CACHE, context):
+            return None
+        max_mb = self.parameterAsInt(parameters, self.P_CACHE_MAX_MB, context)
+        try:
+            cache = HydroCache(max_bytes=max_mb * 1024 * 1024)
+        except OSError as e:
+            feedback.reportError(self.tr(f'Không tạo được thư mục cache ({e}) — bỏ qua cache.'))
+            return None
+        return cache.entry(dem_layer.source(), feedback, **settings)
+
+    # -------- Backend sẽ chạy (vào khoá cache: đổi provider không dùng nhầm kết quả backend khác) --------
+    def _saga_fill_id(self):
+        return self._pick_alg("saga",
             ["saga:fillsinkswangliu", "saga:fillsinksplanchon", "saga:fillsinks"],
             [["fill","sinks","wang"], ["fill","sinks","planchon"], ["fill","sinks"]]
         )
+
+    def _fill_backend(self, tile_size):
+        if tile_size:
+            return "numpy"
+        return self._saga_fill_id() or next(
+            (a for a in ("grass7:r.fill.dir", "wbt:breachdepressionsleastcost") if self._has(a)), None)
+
+    def _acc_backend(self, tile_size):
+        if tile_size:
+            return "numpy"
+        return next((a for a in ("saga:flowaccumulationtopdown", "saga:flowaccumulation(mfd)",
+                                 "saga:flowaccumulation", "wbt:d8flowaccumulation", "grass7:r.watershed")
+                     if self._has(a)), None)
+
+    # -------- FILL SINKS: SAGA → GRASS → WBT --------
+    def _fill_sinks_resilient(self, dem_src, context, feedback):
+        """DEM đã lấp hố; self._backend = id thuật toán đã chạy thành công (None nếu trả DEM gốc)."""
+        dem_src = self._as_raster_src(dem_src)
+        self._backend = None
+
+        saga_fill_id = self._saga_fill_id()
         if saga_fill_id:
             feedback.pushInfo(self.tr(f"SAGA: {saga_fill_id} …"))
             try:
@@ -242,6 +320,7 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                     {"ELEVATION": dem_src, "FILLED":"TEMPORARY_OUTPUT"},
                     {"DEM": dem_src, "FILLED":"TEMPORARY_OUTPUT"}
                 ], context, feedback)
+                self._backend = saga_fill_id
                 return self._as_raster_src(res.get("FILLED") or res.get("ELEVATION") or res.get("ELEV") or dem_src)
             except Exception as e:
                 feedback.reportError(self.tr(f"SAGA Fill sinks lỗi: {e}"))
@@ -256,6 +335,7 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                     "GRASS_REGION_PARAMETER": None, "GRASS_REGION_CELLSIZE_PARAMETER": 0,
                     "GRASS_RASTER_FORMAT_META": "", "GRASS_RASTER_FORMAT_OPT": ""
                 }, context=context, feedback=feedback)
+                self._backend = "grass7:r.fill.dir"
                 return self._as_raster_src(gres["output"])
             except Exception as e:
                 feedback.reportError(self.tr(f"GRASS r.fill.dir lỗi: {e}"))
@@ -266,6 +346,7 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                 wres = processing.run("wbt:breachdepressionsleastcost", {
                     "dem": dem_src, "out_dem": "TEMPORARY_OUTPUT"
                 }, context=context, feedback=feedback)
+                self._backend = "wbt:breachdepressionsleastcost"
                 return self._as_raster_src(wres["out_dem"])
             except Exception as e:
                 feedback.reportError(self.tr(f"WBT breachdepressionsleastcost lỗi: {e}"))
@@ -274,8 +355,21 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
         return dem_src
 
     # -------- FLOW ACCUMULATION --------
-    def _flow_accumulation_resilient(self, dem_src, context, feedback):
+    def _flow_accumulation_resilient(self, dem_src, context, feedback, tile_size=0):
+        """Raster tích luỹ; self._backend = id thuật toán đã chạy thành công ('numpy' khi theo tile)."""
         dem_src = self._as_raster_src(dem_src)
+        self._backend = "numpy" if tile_size else None
+
+        if tile_size:
+            feedback.pushInfo(self.tr(f"NumPy: Flow Accumulation theo tile {tile_size}px …"))
+            fdir_tif = QgsProcessingUtils.generateTempFilename('fdir.tif')
+            acc_tif = QgsProcessingUtils.generateTempFilename('acc.tif')
+            d8_flow_direction_tiled(dem_src, fdir_tif, tile_size, feedback, (30.0, 60.0))
+            if feedback.isCanceled():
+                raise QgsProcessingException(self.tr('Đã huỷ.'))
+            if flow_accumulation_tiled(fdir_tif, acc_tif, tile_size, feedback, (60.0, 90.0)) is None:
+                raise QgsProcessingException(self.tr('Đã huỷ.'))
+            return acc_tif
 
         candidates = [
             ("saga:flowaccumulationtopdown",
@@ -299,6 +393,7 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                     res = self._try_run(alg_id, params, context, feedback)
                     for k in outkeys:
                         if res.get(k):
+                            self._backend = alg_id
                             return self._as_raster_src(res.get(k))
                 except Exception as e:
                     feedback.reportError(self.tr(f"{alg_id} lỗi: {e}"))
@@ -309,6 +404,7 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                 wres = processing.run("wbt:d8flowaccumulation", {
                     "dem": dem_src, "out_accum": "TEMPORARY_OUTPUT", "out_type": 0
                 }, context=context, feedback=feedback)
+                self._backend = "wbt:d8flowaccumulation"
                 return self._as_raster_src(wres["out_accum"])
             except Exception as e:
                 feedback.reportError(self.tr(f"WBT d8flowaccumulation lỗi: {e}"))
@@ -326,59 +422,26 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
                     "GRASS_RASTER_FORMAT_META": "",
                     "GRASS_RASTER_FORMAT_OPT": ""
                 }, context=context, feedback=feedback)
+                self._backend = "grass7:r.watershed"
                 return self._as_raster_src(gres["accumulation"])
             except Exception as e:
                 feedback.reportError(self.tr(f"GRASS r.watershed lỗi: {e}"))
 
         raise QgsProcessingException(self.tr("Không tính được Flow Accumulation; kiểm tra SAGA/WBT/GRASS."))
 
-    # -------- SNAP pour point to stream lines --------
-    def _snap_point_to_stream(self, pt_layer_dem_crs, acc_src, acc_thresh, radius, dem_crs_authid, context, feedback):
-        acc_layer = self._to_rlayer(acc_src, 'accumulation')
-
-        # 1) mask acc >= threshold
-        feedback.pushInfo(self.tr(f"Tạo mask dòng chảy từ Flow Accumulation (threshold = {acc_thresh} cells)…"))
-        mask_res = processing.run('qgis:rastercalculator', {
-            'EXPRESSION': f'("{acc_layer.name()}@1" >= {acc_thresh})*1',
-            'LAYERS': [acc_layer],
-            'CRS': dem_crs_authid,
-            'EXTENT': acc_layer.extent(),
-            'OUTPUT': 'TEMPORARY_OUTPUT',
-            'OUTPUT_DATATYPE': 5,
-            'CELLSIZE': 0
-        }, context=context, feedback=feedback)
-        stream_mask = mask_res['OUTPUT']
-
-        # 2) mask → polys → lines
-        poly_res = processing.run('gdal:polygonize', {
-            'INPUT': stream_mask, 'BAND':1, 'FIELD':'DN',
-            'EIGHT_CONNECTEDNESS': False, 'EXTRA':'', 'OUTPUT':'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)
-        stream_polys = poly_res['OUTPUT']
-
-        lines_res = processing.run('native:polygonstolines', {
-            'INPUT': stream_polys, 'OUTPUT':'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)
-        stream_lines = lines_res['OUTPUT']
-
-        # 3) snap
-        feedback.pushInfo(self.tr("Snap pour point vào dòng chảy…"))
-        snap_res = processing.run('native:snapgeometries', {
-            'INPUT': pt_layer_dem_crs,
-            'REFERENCE_LAYER': stream_lines,
-            'TOLERANCE': radius,
-            'BEHAVIOR': 0,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }, context=context, feedback=feedback)
-        snapped = snap_res['OUTPUT']
-
-        vl = snapped if isinstance(snapped, QgsVectorLayer) else QgsVectorLayer(snapped, 'snapped_pt', 'ogr')
-        for f in vl.getFeatures(QgsFeatureRequest().setLimit(1)):
-            g = f.geometry()
-            if g and not g.isEmpty():
-                p = g.asPoint()
-                return QgsPointXY(p)
-        raise QgsProcessingException(self.tr("Không snap được pour point (kiểm tra ngưỡng tích luỹ & bán kính)."))
+    # -------- SNAP pour point theo raster tích luỹ (chỉ đọc cửa sổ quanh điểm) --------
+    def _snap_point_to_stream(self, pt_xy, acc_src, acc_thresh, radius, mode, report, feedback):
+        feedback.pushInfo(self.tr(f"Snap pour point theo Flow Accumulation (ngưỡng = {acc_thresh} cells, bán kính = {radius})…"))
+        try:
+            res = snap_point_raster(self._as_raster_src(acc_src), pt_xy.x(), pt_xy.y(), radius, acc_thresh, mode)
+        except Exception as e:
+            raise QgsProcessingException(self.tr(f"Không đọc được raster tích luỹ: {e}"))
+        if res is None:
+            raise QgsProcessingException(self.tr("Không snap được pour point (kiểm tra ngưỡng tích luỹ & bán kính)."))
+        x, y, dist = res
+        if report:
+            feedback.pushInfo(self.tr(f"Pour point đã dời {dist:.2f} (đơn vị CRS DEM) → ({x:.3f}, {y:.3f})."))
+        return QgsPointXY(x, y)
 
     # -------- SAGA Upslope Area from X/Y (ưu tiên SAGA, có METHOD) --------
     def _saga_upslope_area_from_point(self, dem_src, pt_xy, context, feedback):
@@ -472,6 +535,126 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
         except Exception as e:
             raise QgsProcessingException(self.tr(f'GRASS r.water.outlet lỗi: {e}'))
 
+    # -------- BATCH: nhiều cửa xả, 1 lượt trên lưới hướng D8 --------
+    @staticmethod
+    def _unique_field_name(fields, base):
+        if fields.indexFromName(base) < 0:
+            return base
+        i = 1
+        while fields.indexFromName(f"{base}_{i}") >= 0:
+            i += 1
+        return f"{base}_{i}"
+
+    def _batch_basins(self, dem_layer, pour_src, pcrs, fill, snap_en, acc_thresh, snap_radius, snap_mode, report,
+                      cache, context, feedback):
+        fdir_c = cache.get('fdir') if cache else None
+        if fdir_c:
+            fdir, gt, proj = read_array(fdir_c)
+            valid = fdir != FDIR_NODATA
+        else:
+            z, gt, proj = read_band(self._as_raster_src(dem_layer))
+            valid = np.isfinite(z)
+            if fill:
+                feedback.pushInfo(self.tr('NumPy: lấp hố trũng (1 lần cho mọi cửa xả) …'))
+                z = fill_depressions(z)
+            feedback.pushInfo(self.tr('NumPy: hướng dòng chảy D8 …'))
+            fdir = d8_flow_direction(z, abs(gt[1]), abs(gt[5]))
+            del z
+            if cache:
+                cache.put('fdir', write_band(cache.target('fdir'), fdir, gt, proj, gdal.GDT_Byte, nodata=FDIR_NODATA))
+        nr, nc = valid.shape
+        rec = receivers(fdir)
+        del fdir
+        order, bounds = topological_levels(rec, valid)
+        acc = flow_accumulation(rec, order, bounds).reshape(nr, nc) if snap_en else None
+        feedback.setProgress(40)
+
+        try:
+            src_crs = pour_src.sourceCrs()
+        except Exception:
+            src_crs = pcrs
+        xform = QgsCoordinateTransform(src_crs, dem_layer.crs(), QgsProject.instance().transformContext())
+
+        seeds = np.zeros(rec.size, dtype=np.int32)
+        attrs = {}
+        dists = {}
+        n_out = 0
+        for f in pour_src.getFeatures():
+            g = f.geometry()
+            if not g or g.isEmpty():
+                continue
+            try:
+                p = xform.transform(QgsPointXY(g.asPoint()))
+            except Exception:
+                mp = g.asMultiPoint()
+                if not mp:
+                    continue
+                p = xform.transform(QgsPointXY(mp[0]))
+            col = int(math.floor((p.x() - gt[0]) / gt[1]))
+            row = int(math.floor((p.y() - gt[3]) / gt[5]))
+            if not (0 <= row < nr and 0 <= col < nc) or not valid[row, col]:
+                feedback.reportError(self.tr(f'Cửa xả fid={f.id()} nằm ngoài DEM hoặc trên NoData — bỏ qua.'))
+                continue
+            if acc is not None:
+                row, col = snap_cell(acc, row, col, snap_radius, abs(gt[1]), abs(gt[5]), acc_thresh, snap_mode)
+                if acc[row, col] < acc_thresh:
+                    feedback.reportError(self.tr(f'Cửa xả fid={f.id()}: không ô nào trong bán kính snap đạt ngưỡng '
+                                                 f'tích luỹ — bỏ qua.'))
+                    continue
+            n_out += 1
+            cell = row * nc + col
+            if seeds[cell]:
+                feedback.reportError(self.tr(f'Cửa xả fid={f.id()} trùng ô với cửa xả khác — lấy cửa xả sau.'))
+            seeds[cell] = n_out
+            attrs[n_out] = f.attributes()
+            if report:
+                dists[n_out] = math.hypot(gt[0] + (col + 0.5) * gt[1] - p.x(), gt[3] + (row + 0.5) * gt[5] - p.y())
+        if not n_out:
+            raise QgsProcessingException(self.tr('Lớp điểm pour point không có đối tượng hợp lệ.'))
+
+        feedback.pushInfo(self.tr(f'Gán nhãn lưu vực cho {n_out} cửa xả (1 lượt trên lưới hướng) …'))
+        lab = label_basins(rec, order, bounds, seeds).reshape(nr, nc)
+        del rec, order, bounds, seeds
+        lab_tif = QgsProcessingUtils.generateTempFilename('basins.tif')
+        write_band(lab_tif, lab, gt, proj, gdal.GDT_Int32, nodata=0)
+        del lab
+        feedback.setProgress(60)
+
+        polys = processing.run('gdal:polygonize', {
+            'INPUT': lab_tif, 'BAND': 1, 'FIELD': 'DN',
+            'EIGHT_CONNECTEDNESS': False, 'EXTRA': '', 'OUTPUT': 'TEMPORARY_OUTPUT'
+        }, context=context, feedback=feedback)['OUTPUT']
+        dissolved = processing.run('native:dissolve', {
+            'INPUT': polys, 'FIELD': ['DN'], 'OUTPUT': 'TEMPORARY_OUTPUT'
+        }, context=context, feedback=feedback)['OUTPUT']
+        dis_layer = dissolved if isinstance(dissolved, QgsVectorLayer) else QgsVectorLayer(dissolved, 'basins', 'ogr')
+
+        # trường thêm không trùng trường sẵn có của lớp pour point (giữ nguyên giá trị của người dùng)
+        fields = QgsFields(pour_src.fields())
+        lbl_name = self._unique_field_name(fields, 'basin_lbl')
+        fields.append(QgsField(lbl_name, QVariant.Int))
+        if report:
+            dist_name = self._unique_field_name(fields, 'snap_dist')
+            fields.append(QgsField(dist_name, QVariant.Double))
+        out_layer = QgsMemoryProviderUtils.createMemoryLayer('basins', fields, QgsWkbTypes.MultiPolygon, dem_layer.crs())
+        feats = []
+        for f in dis_layer.getFeatures():
+            dn = f['DN']
+            if dn not in attrs:
+                continue
+            nf = QgsFeature(fields)
+            g = f.geometry()
+            g.convertToMultiType()
+            nf.setGeometry(g)
+            nf.setAttributes(attrs[dn] + [None] * (fields.count() - len(attrs[dn])))
+            nf[lbl_name] = int(dn)
+            if report:
+                nf[dist_name] = dists[dn]
+            feats.append(nf)
+        out_layer.dataProvider().addFeatures(feats)
+        feedback.pushInfo(self.tr(f'Đã tạo {len(feats)} lưu vực.'))
+        return out_layer
+
     # ============ MAIN ============
     def processAlgorithm(self, parameters, context, feedback):
         dem_layer = self.parameterAsRasterLayer(parameters, self.P_DEM, context)
@@ -487,13 +670,29 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
         auto_thresh = self.parameterAsBool(parameters, self.P_AUTO_THRESH, context)
         acc_thresh = self.parameterAsDouble(parameters, self.P_SNAP_ACC_THRESH, context)
         snap_radius = self.parameterAsDouble(parameters, self.P_SNAP_RADIUS, context)
+        snap_mode = ('max', 'nearest')[self.parameterAsEnum(parameters, self.P_SNAP_MODE, context)]
+        snap_report = snap_en and self.parameterAsBool(parameters, self.P_SNAP_REPORT, context)
+        tile_size = self.parameterAsInt(parameters, self.P_TILE_SIZE, context) \
+            if self.parameterAsBool(parameters, self.P_TILED, context) else 0
 
         pour_src = self.parameterAsSource(parameters, self.P_POUR_LAYER, context)
         px = parameters.get(self.P_POUR_X, None); py = parameters.get(self.P_POUR_Y, None)
         px = None if px is None else float(px); py = None if py is None else float(py)
         pcrs = self.parameterAsCrs(parameters, self.P_POUR_CRS, context)
 
-        # Lấy pour point & chuyển sang CRS DEM → tạo layer điểm tạm (CRS DEM)
+        # Nhiều cửa xả: một lần lấp hố + D8 cho toàn bộ lớp điểm
+        if pour_src and self.parameterAsBool(parameters, self.P_BATCH, context):
+            if tile_size:
+                raise QgsProcessingException(self.tr("Chế độ 'Nhiều cửa xả' nạp cả DEM vào bộ nhớ — "
+                                                     "không dùng cùng 'Lấp hố & tích luỹ theo tile'."))
+            if auto_thresh:
+                acc_thresh = self._auto_acc_threshold(dem_layer, acc_thresh, feedback)
+            cache = self._cache_entry(dem_layer, parameters, context, feedback, engine='numpy', fill=bool(fill))
+            current = self._batch_basins(dem_layer, pour_src, pcrs, fill, snap_en, acc_thresh, snap_radius,
+                                         snap_mode, snap_report, cache, context, feedback)
+            return self._finish_basins(current, parameters, context, feedback)
+
+        # Lấy pour point & chuyển sang CRS DEM
         if pour_src:
             pt = self._first_point_from_layer(pour_src)
             if pt is None:
@@ -512,31 +711,50 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
             qpt = xform.transform(QgsPointXY(px, py))
             pour_pt_dem = QgsPointXY(qpt.x(), qpt.y())
 
-        pt_layer_dem_crs = self._make_point_layer(pour_pt_dem, dem_crs_authid)
-
-        # Fill sinks
+        # Fill sinks (cache theo hash DEM + thiết lập + backend sẽ chạy; backend khác lúc chạy -> không ghi cache)
+        fill_alg = self._fill_backend(tile_size) if fill else None
+        acc_alg = self._acc_backend(tile_size)
+        cache = None
+        if (fill_alg or not fill) and acc_alg:
+            cache = self._cache_entry(dem_layer, parameters, context, feedback,
+                                      fill=bool(fill), tile=tile_size, fill_alg=fill_alg, acc_alg=acc_alg)
         dem_used_src = self._as_raster_src(dem_src)
         if fill:
-            dem_used_src = self._fill_sinks_resilient(dem_used_src, context, feedback)
+            filled = cache.get('filled') if cache else None
+            if not filled and tile_size:
+                feedback.pushInfo(self.tr(f"NumPy: lấp hố theo tile {tile_size}px …"))
+                filled = fill_depressions_tiled(dem_used_src, QgsProcessingUtils.generateTempFilename('filled.tif'),
+                                                tile_size, feedback, (0.0, 30.0))
+                if filled is None:
+                    raise QgsProcessingException(self.tr('Đã huỷ.'))
+                if cache:
+                    filled = cache.put('filled', filled)
+            elif not filled:
+                filled = self._fill_sinks_resilient(dem_used_src, context, feedback)
+                if filled == dem_used_src or self._backend != fill_alg:
+                    cache = None  # lấp hố thất bại / backend khác: kết quả không khớp khoá cache
+                elif cache:
+                    filled = cache.put('filled', filled)
+            dem_used_src = filled
 
         # --- Auto threshold (≈ 1 km²)
         if auto_thresh:
-            try:
-                px_m, py_m = self._estimate_pixel_size_m(dem_layer)
-                pix_m = max(1e-6, (abs(px_m) + abs(py_m)) / 2.0)   # tránh chia 0
-                acc_auto = max(1, int(round(1_000_000.0 / (pix_m * pix_m))))  # 1 km²
-                feedback.pushInfo(self.tr(f"Auto threshold: kích thước ô ≈ {pix_m:.2f} m → ngưỡng ≈ {acc_auto} cells (~1 km²)."))
-                acc_thresh = acc_auto
-            except Exception as e:
-                feedback.reportError(self.tr(f'Không tính được Auto threshold, dùng giá trị nhập tay: {acc_thresh}. Lỗi: {e}'))
+            acc_thresh = self._auto_acc_threshold(dem_layer, acc_thresh, feedback)
 
         # Snap pour point (nếu bật)
         snapped_xy = pour_pt_dem
         if snap_en:
-            acc_src = self._flow_accumulation_resilient(dem_used_src, context, feedback)
-            snapped_xy = self._snap_point_to_stream(pt_layer_dem_crs, acc_src, acc_thresh, snap_radius, dem_crs_authid, context, feedback)
+            acc_src = cache.get('acc') if cache else None
+            if not acc_src:
+                acc_src = self._flow_accumulation_resilient(dem_used_src, context, feedback, tile_size)
+                if cache and self._backend == acc_alg:
+                    acc_src = cache.put('acc', acc_src)
+            snapped_xy = self._snap_point_to_stream(pour_pt_dem, acc_src, acc_thresh, snap_radius, snap_mode,
+                                                    snap_report, feedback)
 
         # Tạo raster mask lưu vực từ điểm (SAGA ưu tiên; fallback GRASS r.water.outlet)
+        if tile_size:
+            feedback.pushInfo(self.tr("Khoanh lưu vực (SAGA/GRASS) không chạy theo tile: bước này đọc cả DEM."))
         mask_src = self._basin_raster_from_point(dem_used_src, snapped_xy, dem_crs_authid, context, feedback)
 
         # Polygonize & chọn DN==1
@@ -550,7 +768,9 @@ class WatershedFromDEM(QgsProcessingAlgorithm):
             'INPUT': polys, 'FIELD':'DN', 'OPERATOR':0, 'VALUE':1, 'OUTPUT':'TEMPORARY_OUTPUT'
         }, context=context, feedback=feedback)
         current = sel_res['OUTPUT']
+        return self._finish_basins(current, parameters, context, feedback)
 
+    def _finish_basins(self, current, parameters, context, feedback):
         # AOI (tuỳ chọn)
         aoi = self.parameterAsVectorLayer(parameters, self.P_AOI, context)
         if aoi:
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Đo tốc độ duyệt đối tượng trên 1 lớp GPKG / shapefile: request mặc định (đọc hình học + mọi cột)
+so với request_utils.attribute_request (NoGeometry + chỉ các cột cần + biểu thức lọc).
+
+Trong QGIS (Python console):
+    import sys; sys.path.insert(0, r"<thư mục plugin>/benchmarks")
+    import request_benchmark
+    request_benchmark.run(r"D:/data/lo_rung.gpkg|layername=lo", ["maldlr", "dtich"], "maldlr > 0")
+
+Ngoài giao diện, bằng Python đi kèm QGIS (OSGeo4W shell...):
+    python benchmarks/request_benchmark.py D:/data/lo_rung.shp --fields maldlr,dtich --filter "maldlr > 0"
+
+Mỗi request chạy REPEAT lần, lấy lần nhanh nhất; trước đó đọc 1 lượt để file đã nằm trong cache hệ điều hành
+(không request nào được lợi vì chạy sau).
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qgis.core import QgsExpression, QgsFeatureRequest, QgsVectorLayer  # noqa: E402
+
+from request_utils import attribute_request  # noqa: E402
+
+
+def _time(layer, request, repeat):
+    n, best = 0, float("inf")
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        n = sum(1 for _f in layer.getFeatures(request))
+        best = min(best, time.perf_counter() - t0)
+    return n, best
+
+
+def run(source, fields=(), filter_expr="", repeat=3):
+    """
+    source: đường dẫn lớp ('a.gpkg|layername=lo', 'a.shp') hoặc QgsVectorLayer.
+    In và trả {'default': (số đối tượng, giây), 'attribute': (số đối tượng, giây), 'speedup': x}.
+    """
+    layer = source if isinstance(source, QgsVectorLayer) else QgsVectorLayer(source, "benchmark", "ogr")
+    if not layer.isValid():
+        raise ValueError(f"Không mở được lớp: {source}")
+    requests = {
+        "default": QgsFeatureRequest(QgsExpression(filter_expr)) if filter_expr else QgsFeatureRequest(),
+        "attribute": attribute_request(layer.fields(), fields, filter_expr),
+    }
+    sum(1 for _f in layer.getFeatures(QgsFeatureRequest()))  # làm nóng cache đĩa
+
+    out = {key: _time(layer, request, repeat) for key, request in requests.items()}
+    out["speedup"] = out["default"][1] / max(out["attribute"][1], 1e-9)
+    print(f"{layer.source()} — {layer.featureCount()} đối tượng, cột {list(fields) or 'tất cả'}, "
+          f"lọc: {filter_expr or '(không)'}")
+    for key in requests:
+        n, sec = out[key]
+        print(f"  {key:<9} {n:>9} đối tượng  {sec:8.3f} s  ({n / max(sec, 1e-9):,.0f} đt/s)")
+    print(f"  nhanh hơn: ×{out['speedup']:.2f}")
+    if out["default"][0] != out["attribute"][0]:
+        print("  CẢNH BÁO: số đối tượng hai request khác nhau — kiểm tra biểu thức lọc.")
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Request mặc định vs attribute_request (NoGeometry + cột cần).")
+    parser.add_argument("source", help="đường dẫn lớp, vd lo_rung.gpkg|layername=lo hoặc lo_rung.shp")
+    parser.add_argument("--fields", default="", help="các cột cần, cách nhau bởi dấu phẩy")
+    parser.add_argument("--filter", default="", help="biểu thức lọc QGIS")
+    parser.add_argument("--repeat", type=int, default=3, help="số lần chạy mỗi request (lấy lần nhanh nhất)")
+    args = parser.parse_args(argv)
+
+    from qgis.core import QgsApplication
+    app = QgsApplication([], False)
+    app.initQgis()
+    try:
+        run(args.source, [f.strip() for f in args.fields.split(",") if f.strip()], args.filter, args.repeat)
+    finally:
+        app.exitQgis()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Cache trên đĩa cho raster thuỷ văn trung gian (DEM đã lấp hố, hướng dòng chảy, tích luỹ):
+- Khoá = hash nội dung các file của DEM + thiết lập ảnh hưởng kết quả (bộ máy, lấp hố, tile...)
+  -> chạy lại cùng DEM với THRESH / ORDER_MIN / cửa xả khác sẽ bỏ qua các bước nặng.
+- Mỗi khoá là một thư mục con; index.json ghi kích thước & lần dùng cuối,
+  vượt dung lượng tối đa thì xoá khoá dùng lâu nhất (LRU).
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from osgeo import gdal
+
+_INDEX = "index.json"
+_CHUNK = 8 * 1024 * 1024
+_MAX_DIGESTS = 256
+_GTIFF_OPTS = ["TILED=YES", "COMPRESS=LZW", "BIGTIFF=IF_SAFER"]
+
+
+def default_cache_dir():
+    """Thư mục cache mặc định: <profile QGIS>/forestry_tool/hydro_cache (ngoài QGIS: thư mục tạm)."""
+    try:
+        from qgis.core import QgsApplication
+        base = QgsApplication.qgisSettingsDirPath()
+    except Exception:
+        base = tempfile.gettempdir()
+    return os.path.join(base, "forestry_tool", "hydro_cache")
+
+
+class HydroCache:
+    def __init__(self, root=None, max_bytes=2048 * 1024 * 1024):
+        self.root = root or default_cache_dir()
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.root, exist_ok=True)
+
+    # ---- index ----
+    def _load(self):
+        try:
+            with open(os.path.join(self.root, _INDEX), "r", encoding="utf-8") as f:
+                idx = json.load(f)
+        except (OSError, ValueError):
+            idx = {}
+        idx.setdefault("entries", {})
+        idx.setdefault("digests", {})
+        return idx
+
+    def _save(self, idx):
+        if len(idx["digests"]) > _MAX_DIGESTS:
+            keep = sorted(idx["digests"].items(), key=lambda kv: kv[1][3])[-_MAX_DIGESTS:]
+            idx["digests"] = dict(keep)
+        tmp = os.path.join(self.root, f"{_INDEX}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(idx, f)
+        os.replace(tmp, os.path.join(self.root, _INDEX))
+
+    # ---- khoá ----
+    def _file_digest(self, idx, path):
+        """Hash nội dung 1 file; nhớ theo (đường dẫn, kích thước, mtime) để không đọc lại file lớn."""
+        st = os.stat(path)
+        memo = idx["digests"].get(path)
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            memo[3] = time.time()
+            return memo[2]
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK), b""):
+                h.update(chunk)
+        idx["digests"][path] = [st.st_size, st.st_mtime_ns, h.hexdigest(), time.time()]
+        return h.hexdigest()
+
+    def key(self, dem_path, **settings):
+        """Khoá cache; None nếu DEM không phải (tập) file GDAL đọc được."""
+        ds = gdal.Open(dem_path, gdal.GA_ReadOnly)
+        if ds is None:
+            return None
+        files = [os.path.abspath(p) for p in (ds.GetFileList() or [])
+                 if os.path.isfile(p) and not p.lower().endswith(".aux.xml")]
+        ds = None
+        if not files:
+            return None
+        idx = self._load()
+        h = hashlib.blake2b(digest_size=16)
+        for p in sorted(files):
+            h.update(self._file_digest(idx, p).encode())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        self._save(idx)
+        return h.hexdigest()
+
+    # ---- đọc / ghi ----
+    def target(self, key, name):
+        """Đường dẫn trong cache để ghi thẳng raster (sau đó gọi put với chính đường dẫn này)."""
+        d = os.path.join(self.root, key)
+        os.makedirs(d, exist_ok=True)
+        return os.path.join(d, f"{name}.tif")
+
+    def get(self, key, name):
+        idx = self._load()
+        ent = idx["entries"].get(key)
+        path = os.path.join(self.root, key, f"{name}.tif")
+        if not ent or name not in ent["files"] or not os.path.isfile(path):
+            return None
+        ent["used"] = time.time()
+        self._save(idx)
+        return path
+
+    def put(self, key, name, src_path, meta=None):
+        """Chép raster vào cache (GeoTIFF) rồi dọn LRU; trả đường dẫn trong cache."""
+        dst = self.target(key, name)
+        if os.path.abspath(src_path) != os.path.abspath(dst):
+            src = gdal.Open(src_path, gdal.GA_ReadOnly)
+            if src is None:
+                raise RuntimeError(f"GDAL không mở được raster: {src_path}")
+            tmp = dst + ".part.tif"
+            out = gdal.GetDriverByName("GTiff").CreateCopy(tmp, src, 0, _GTIFF_OPTS)
+            if out is None:
+                raise RuntimeError(f"Không ghi được raster cache: {dst}")
+            out.FlushCache()
+            out = src = None
+            os.replace(tmp, dst)
+        idx = self._load()
+        ent = idx["entries"].setdefault(key, {"files": [], "meta": meta or {}})
+        if name not in ent["files"]:
+            ent["files"].append(name)
+        d = os.path.join(self.root, key)
+        ent["size"] = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+        ent["used"] = time.time()
+        self._evict(idx, keep=key)
+        self._save(idx)
+        return dst
+
+    def _evict(self, idx, keep=None):
+        ents = idx["entries"]
+        total = sum(e.get("size", 0) for e in ents.values())
+        for k in sorted(ents, key=lambda k: ents[k].get("used", 0)):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            total -= ents[k].get("size", 0)
+            shutil.rmtree(os.path.join(self.root, k), ignore_errors=True)
+            del ents[k]
+
+    def entry(self, dem_path, feedback=None, **settings):
+        """CacheEntry gắn với 1 khoá (ghi log hit/miss vào feedback); None nếu không cache được DEM này."""
+        try:
+            key = self.key(dem_path, **settings)
+        except OSError as e:
+            if feedback:
+                feedback.reportError(f"Cache: không đọc được DEM để tính khoá ({e}) — bỏ qua cache.")
+            return None
+        if key is None:
+            if feedback:
+                feedback.pushInfo("Cache: DEM không phải file GDAL — bỏ qua cache.")
+            return None
+        return CacheEntry(self, key, settings, feedback)
+
+
+class CacheEntry:
+    def __init__(self, cache, key, settings, feedback=None):
+        self.cache, self.key, self.settings, self.feedback = cache, key, settings, feedback
+
+    def get(self, name):
+        path = self.cache.get(self.key, name)
+        if self.feedback:
+            if path:
+                self.feedback.pushInfo(f"Cache HIT: {name} [{self.key[:12]}] → {path}")
+            else:
+                self.feedback.pushInfo(f"Cache MISS: {name} [{self.key[:12]}] — tính mới.")
+        return path
+
+    def target(self, name):
+        return self.cache.target(self.key, name)
+
+    def put(self, name, src_path):
+        """Lưu vào cache; lỗi ghi cache không làm hỏng lượt chạy (trả lại src_path)."""
+        try:
+            return self.cache.put(self.key, name, src_path, self.settings)
+        except Exception as e:
+            if self.feedback:
+                self.feedback.reportError(f"Cache: không lưu được {name} ({e}).")
+            return src_path
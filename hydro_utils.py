@@ -0,0 +1,1080 @@
+# -*- coding: utf-8 -*-
+"""
+Tiện ích thuỷ văn dùng chung (NumPy, không cần SAGA/GRASS/WBT):
+- Đọc/ghi raster 1 band qua GDAL
+- Lấp hố trũng (tương đương priority-flood, giải trên đồ thị các lưu vực con)
+- Hướng dòng chảy D8 (có xử lý vùng phẳng)
+- Tích luỹ dòng chảy theo thứ tự topo (vector hoá theo từng "lớp")
+- Phân cấp Strahler/Shreve, gán nhãn lưu vực theo cửa xả
+"""
+import math
+import os
+from collections import deque
+
+import numpy as np
+from osgeo import gdal
+
+# Mã hướng D8 (0..7) theo chiều kim đồng hồ bắt đầu từ hướng Bắc: (drow, dcol)
+D8_OFFSETS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+FDIR_NONE = 8       # ô không chảy đi đâu (cửa xả ở biên, hoặc hố trũng còn lại)
+FDIR_NODATA = 255   # ô NoData
+FDIR_FLAT = 9       # (chỉ trong chế độ tile) ô phẳng chưa có hướng, chờ lan khoảng cách toàn cục
+_DIST_INF = np.iinfo(np.int32).max
+
+
+# ---------------- Raster I/O ----------------
+def read_band(path, band=1):
+    """Đọc 1 band thành float32 (NoData -> NaN). Trả (arr, geotransform, projection)."""
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {path}")
+    b = ds.GetRasterBand(band)
+    arr = b.ReadAsArray().astype(np.float32, copy=False)
+    nodata = b.GetNoDataValue()
+    if nodata is not None:
+        arr[arr == np.float32(nodata)] = np.nan
+    gt, proj = ds.GetGeoTransform(), ds.GetProjection()
+    ds = None
+    return arr, gt, proj
+
+
+def read_array(path, band=1):
+    """Đọc 1 band giữ nguyên kiểu dữ liệu (vd. lưới hướng D8 uint8). Trả (arr, geotransform, projection)."""
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {path}")
+    arr = ds.GetRasterBand(band).ReadAsArray()
+    gt, proj = ds.GetGeoTransform(), ds.GetProjection()
+    ds = None
+    return arr, gt, proj
+
+
+def write_band(path, arr, gt, proj, gdal_type, nodata=None, options=None):
+    """Ghi mảng 2D ra GeoTIFF (TILED, LZW) — 1 band."""
+    opts = options or ["TILED=YES", "COMPRESS=LZW", "BIGTIFF=IF_SAFER"]
+    drv = gdal.GetDriverByName("GTiff")
+    ds = drv.Create(path, arr.shape[1], arr.shape[0], 1, gdal_type, options=opts)
+    if ds is None:
+        raise RuntimeError(f"Không tạo được raster: {path}")
+    ds.SetGeoTransform(gt)
+    ds.SetProjection(proj)
+    b = ds.GetRasterBand(1)
+    if nodata is not None:
+        b.SetNoDataValue(nodata)
+    b.WriteArray(arr)
+    b.FlushCache()
+    ds = None
+    return path
+
+
+# ---------------- Lân cận ----------------
+def _shift(a, dr, dc, fill):
+    """b[r, c] = a[r + dr, c + dc]; ô rơi ra ngoài biên nhận giá trị fill."""
+    nr, nc = a.shape
+    out = np.full(a.shape, fill, dtype=a.dtype)
+    out[max(0, -dr):nr - max(0, dr), max(0, -dc):nc - max(0, dc)] = \
+        a[max(0, dr):nr - max(0, -dr), max(0, dc):nc - max(0, -dc)]
+    return out
+
+
+def _edge_mask(valid):
+    """Ô hợp lệ nằm ở biên raster hoặc kề ô NoData (nơi nước có thể thoát ra ngoài)."""
+    nr, nc = valid.shape
+    pad = np.pad(valid, 1, constant_values=False)
+    edge = np.zeros(valid.shape, dtype=bool)
+    for dr, dc in D8_OFFSETS:
+        edge |= ~pad[1 + dr:1 + dr + nr, 1 + dc:1 + dc + nc]
+    return edge & valid
+
+
+def _flat_offsets(ncols, dtype=np.int64):
+    return np.array([dr * ncols + dc for dr, dc in D8_OFFSETS], dtype=dtype)
+
+
+# ---------------- D8 ----------------
+def d8_flow_direction(z, dx=1.0, dy=1.0, resolve_flats=True):
+    """
+    Hướng D8 theo độ dốc xuống lớn nhất (uint8: 0..7, FDIR_NONE, FDIR_NODATA).
+    - Ô biên không có ô thấp hơn -> FDIR_NONE (cửa xả).
+    - resolve_flats: ô phẳng được hướng về ô "thoát" cùng độ cao gần nhất (BFS).
+    """
+    valid = np.isfinite(z)
+    best = np.zeros(z.shape, dtype=np.float32)
+    fdir = np.full(z.shape, FDIR_NONE, dtype=np.uint8)
+    for k, (dr, dc) in enumerate(D8_OFFSETS):
+        nb = _shift(z, dr, dc, np.nan)
+        with np.errstate(invalid="ignore"):
+            slope = (z - nb) / np.float32(math.hypot(dr * dy, dc * dx))
+            better = slope > best
+        best[better] = slope[better]
+        fdir[better] = k
+        del nb, slope, better
+    fdir[~valid] = FDIR_NODATA
+    if resolve_flats:
+        _resolve_flats(z, fdir, _edge_mask(valid))
+    return fdir
+
+
+def _first_flat_layer(zf, drains, idx, offs):
+    """Lớp BFS 1: hướng (k nhỏ nhất) tới ô thoát cùng độ cao kề ô phẳng idx; FDIR_NONE nếu không có."""
+    zi = zf[idx]
+    new_dir = np.full(idx.size, FDIR_NONE, dtype=np.uint8)
+    for k in range(8):
+        n = idx + offs[k]
+        hit = (new_dir == FDIR_NONE) & drains[n] & (zf[n] == zi)
+        new_dir[hit] = k
+    return new_dir
+
+
+def _resolve_flats(z, fdir, edge):
+    """Gán hướng cho ô phẳng theo từng lớp BFS từ các ô thoát cùng độ cao (sửa fdir tại chỗ)."""
+    nr, nc = z.shape
+    zf = z.ravel()
+    fd = fdir.ravel()
+    unres = (fd == FDIR_NONE) & ~edge.ravel()
+    idx = np.flatnonzero(unres)
+    if idx.size == 0:
+        return
+    # Ô không thuộc biên luôn có đủ 8 lân cận hợp lệ -> không cần kiểm tra chỉ số
+    offs = _flat_offsets(nc)
+
+    # Lớp 1: ô phẳng kề trực tiếp một ô thoát cùng độ cao
+    new_dir = _first_flat_layer(zf, ~unres & (fd != FDIR_NODATA), idx, offs)
+    got = new_dir != FDIR_NONE
+    frontier = idx[got]
+    fd[frontier] = new_dir[got]
+    unres[frontier] = False
+    del idx, new_dir, got
+
+    # Các lớp sau: chỉ lan từ frontier vừa gán (mỗi ô được xét tối đa 8 lần)
+    while frontier.size:
+        zfr = zf[frontier]
+        nxt = []
+        for k in range(8):
+            u = frontier + offs[k]
+            hit = unres[u] & (zf[u] == zfr)
+            u = u[hit]
+            if u.size == 0:
+                continue
+            u = np.unique(u)
+            fd[u] = (k + 4) % 8   # u chảy ngược về ô frontier (ưu tiên hướng 4,5,6,7,0,1,2,3)
+            unres[u] = False
+            nxt.append(u)
+        frontier = np.concatenate(nxt) if nxt else frontier[:0]
+
+
+def receivers(fdir):
+    """Chỉ số phẳng (ravel) của ô nhận nước; -1 nếu không chảy."""
+    nc = fdir.shape[1]
+    fd = fdir.ravel()
+    dt = np.int64 if fd.size >= 2 ** 31 else np.int32
+    rec = np.full(fd.size, -1, dtype=dt)
+    idx = np.flatnonzero(fd < FDIR_NONE).astype(dt)
+    rec[idx] = idx + _flat_offsets(nc, dt)[fd[idx]]
+    return rec
+
+
+def topological_levels(rec, valid=None):
+    """
+    Bóc lớp đồ thị dòng chảy từ đầu nguồn xuống hạ lưu.
+    Trả (order, bounds): order[bounds[i]:bounds[i+1]] là các ô của lớp i; mọi ô thượng lưu
+    của một ô đều nằm ở lớp trước nó.
+    """
+    n = rec.size
+    has = rec >= 0
+    indeg = np.bincount(rec[has], minlength=n).astype(np.int32)
+    start = indeg == 0
+    if valid is not None:
+        start &= valid.ravel()
+    frontier = np.flatnonzero(start).astype(rec.dtype)
+    chunks, bounds = [], [0]
+    while frontier.size:
+        chunks.append(frontier)
+        bounds.append(bounds[-1] + frontier.size)
+        r = rec[frontier]
+        r = r[r >= 0]
+        if r.size == 0:
+            break
+        u, cnt = np.unique(r, return_counts=True)
+        indeg[u] -= cnt.astype(np.int32)
+        frontier = u[indeg[u] == 0]
+    order = np.concatenate(chunks) if chunks else np.zeros(0, dtype=rec.dtype)
+    return order, np.asarray(bounds, dtype=np.int64)
+
+
+def flow_accumulation(rec, order, bounds, weights=None):
+    """Tích luỹ (số ô, tính cả ô đang xét) theo thứ tự topo; float64, 0 ngoài order."""
+    acc = np.zeros(rec.size, dtype=np.float64)
+    acc[order] = 1.0 if weights is None else weights.ravel()[order]
+    for i in range(len(bounds) - 1):
+        idx = order[bounds[i]:bounds[i + 1]]
+        r = rec[idx]
+        m = r >= 0
+        if m.any():
+            np.add.at(acc, r[m], acc[idx[m]])
+    return acc
+
+
+def stream_order(rec, order, bounds, stream, method="strahler"):
+    """
+    Phân cấp dòng chảy trên các ô stream (bool, ravel).
+    method: "strahler" hoặc "shreve". Trả int32 (0 ngoài stream).
+    """
+    n = rec.size
+    out = np.zeros(n, dtype=np.int32)
+    inc_max = np.zeros(n, dtype=np.int32)   # Strahler: cấp lớn nhất đổ vào / Shreve: tổng đổ vào
+    inc_cnt = np.zeros(n, dtype=np.int32)   # Strahler: số nhánh có cấp bằng inc_max
+    shreve = method == "shreve"
+    for i in range(len(bounds) - 1):
+        idx = order[bounds[i]:bounds[i + 1]]
+        idx = idx[stream[idx]]
+        if idx.size == 0:
+            continue
+        mx = inc_max[idx]
+        if shreve:
+            o = np.where(mx == 0, 1, mx)
+        else:
+            o = np.where(mx == 0, 1, np.where(inc_cnt[idx] >= 2, mx + 1, mx))
+        out[idx] = o
+        r = rec[idx]
+        m = r >= 0
+        r, o = r[m], o[m]
+        if r.size == 0:
+            continue
+        if shreve:
+            np.add.at(inc_max, r, o)
+            continue
+        before = inc_max[r]
+        np.maximum.at(inc_max, r, o)
+        after = inc_max[r]
+        inc_cnt[r[after > before]] = 0
+        eq = o == after
+        np.add.at(inc_cnt, r[eq], 1)
+    return out
+
+
+def label_basins(rec, order, bounds, seeds):
+    """
+    Lan truyền nhãn từ hạ lưu lên thượng lưu: ô chưa có nhãn nhận nhãn của ô nhận nước.
+    seeds: int (ravel), 0 = chưa gán. Trả mảng nhãn mới.
+    """
+    lab = np.array(seeds, dtype=np.int32).ravel()
+    for i in range(len(bounds) - 2, -1, -1):
+        idx = order[bounds[i]:bounds[i + 1]]
+        r = rec[idx]
+        m = (r >= 0) & (lab[idx] == 0)
+        if m.any():
+            lab[idx[m]] = lab[r[m]]
+    return lab
+
+
+def snap_cell(acc, row, col, radius, px=1.0, py=1.0, thresh=None, mode="max"):
+    """
+    Dời ô (row, col) trong bán kính radius (đơn vị bản đồ):
+    - mode="max": tới ô có tích luỹ lớn nhất (bằng nhau -> ô gần hơn);
+    - mode="nearest": tới ô gần nhất đạt ngưỡng thresh (bằng nhau -> tích luỹ lớn hơn).
+    Nếu có thresh mà không ô nào đạt ngưỡng -> giữ nguyên. Trả (row, col).
+    """
+    nr, nc = acc.shape
+    rr_ = int(math.ceil(radius / py)) if py > 0 else 0
+    rc_ = int(math.ceil(radius / px)) if px > 0 else 0
+    r0, r1 = max(0, row - rr_), min(nr, row + rr_ + 1)
+    c0, c1 = max(0, col - rc_), min(nc, col + rc_ + 1)
+    win = acc[r0:r1, c0:c1]
+    rr, cc = np.mgrid[r0:r1, c0:c1]
+    d2 = ((rr - row) * py) ** 2 + ((cc - col) * px) ** 2
+    ok = (d2 <= radius * radius) & np.isfinite(win)
+    if thresh is not None:
+        ok &= win >= thresh
+    if not ok.any():
+        return row, col
+    if mode == "nearest":
+        dist = np.where(ok, d2, np.inf)
+        cand = dist == dist.min()
+        i = np.argmax(np.where(cand, win, -np.inf))
+    else:
+        score = np.where(ok, win, -np.inf)
+        cand = score == score.max()
+        i = np.argmin(np.where(cand, d2, np.inf))
+    return int(rr.flat[i]), int(cc.flat[i])
+
+
+def snap_point_raster(acc_path, x, y, radius, thresh=None, mode="max"):
+    """
+    Snap điểm (x, y) (CRS của raster) theo raster tích luỹ, chỉ đọc cửa sổ bán kính radius
+    quanh điểm (không đọc cả raster). Trả (x, y, khoảng cách dời) — toạ độ là tâm ô được chọn;
+    None nếu điểm nằm ngoài raster hoặc trong bán kính không có ô nào đạt ngưỡng.
+    """
+    ds = gdal.Open(acc_path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {acc_path}")
+    gt = ds.GetGeoTransform()
+    px, py = abs(gt[1]), abs(gt[5])
+    col = int(math.floor((x - gt[0]) / gt[1]))
+    row = int(math.floor((y - gt[3]) / gt[5]))
+    if not (0 <= row < ds.RasterYSize and 0 <= col < ds.RasterXSize):
+        return None
+    rr_ = int(math.ceil(radius / py)) if py > 0 else 0
+    rc_ = int(math.ceil(radius / px)) if px > 0 else 0
+    r0, r1 = max(0, row - rr_), min(ds.RasterYSize, row + rr_ + 1)
+    c0, c1 = max(0, col - rc_), min(ds.RasterXSize, col + rc_ + 1)
+    b = ds.GetRasterBand(1)
+    win = b.ReadAsArray(c0, r0, c1 - c0, r1 - r0).astype(np.float64)
+    nodata = b.GetNoDataValue()
+    ds = None
+    if nodata is not None:
+        win[win == nodata] = np.nan
+    r, c = snap_cell(win, row - r0, col - c0, radius, px, py, thresh, mode)
+    v = win[r, c]
+    if not np.isfinite(v) or (thresh is not None and v < thresh):
+        return None
+    sx = gt[0] + (c0 + c + 0.5) * gt[1]
+    sy = gt[3] + (r0 + r + 0.5) * gt[5]
+    return sx, sy, math.hypot(sx - x, sy - y)
+
+
+# ---------------- Lấp hố trũng ----------------
+def fill_depressions(z):
+    """
+    Lấp hố trũng (kết quả như priority-flood) nhưng làm việc trên đồ thị lưu vực con:
+    1) D8 thô -> mỗi hố (nhóm ô không có ô thấp hơn) là một lưu vực con.
+    2) Độ cao "yên ngựa" giữa 2 lưu vực kề = min(max(z_a, z_b)); "ngoài raster" là nút 0.
+    3) Mực tràn của mỗi lưu vực = cạnh cao nhất trên đường đi từ nút 0 trong cây khung
+       nhỏ nhất của đồ thị nhỏ này (tương đương priority-flood, nhưng chạy bằng SciPy).
+    """
+    from scipy import ndimage
+
+    nr, nc = z.shape
+    valid = np.isfinite(z)
+    edge = _edge_mask(valid)
+    z = _raise_single_pits(z, valid, edge)
+
+    fdir = d8_flow_direction(z, resolve_flats=False)
+    pits = fdir == FDIR_NONE
+    lab, nlab = ndimage.label(pits, structure=np.ones((3, 3), dtype=bool))
+    del pits
+    if nlab == 0:
+        return z.copy()
+    rec = receivers(fdir)
+    del fdir
+    order, bounds = topological_levels(rec, valid)
+    basin = label_basins(rec, order, bounds, lab).reshape(z.shape)
+    del rec, order, bounds, lab
+
+    # Cạnh (lo, hi, h) giữa các lưu vực kề nhau theo 8 hướng (chỉ xét nửa số hướng)
+    base = np.int64(nlab + 1)
+    keys, heights = _spill_edges(basin, z, base, (0, nr, 0, nc))
+    # Ô biên nối với nút 0 ("ngoài raster")
+    keys = np.concatenate([keys, basin[edge].astype(np.int64)])
+    heights = np.concatenate([heights, z[edge].astype(np.float64)])
+    lv_arr = _spill_levels(keys, heights, base)
+
+    filled = np.maximum(z, lv_arr[basin].astype(np.float32))
+    filled[~valid] = np.nan
+    return filled
+
+
+def _raise_single_pits(z, valid, edge):
+    """
+    Hố 1 ô được nâng ngay lên bằng lân cận thấp nhất (không đổi kết quả cuối của lấp hố,
+    nhưng giảm mạnh số lưu vực con trên DEM nhiễu).
+    """
+    nb_min = np.full(z.shape, np.inf, dtype=np.float32)
+    for dr, dc in D8_OFFSETS:
+        np.fmin(nb_min, _shift(z, dr, dc, np.nan), out=nb_min)
+    single = valid & ~edge & (z < nb_min)
+    return np.where(single, nb_min, z)
+
+
+def _spill_edges(basin, z, base, box):
+    """
+    Cạnh giữa các lưu vực kề nhau (khoá lo * base + hi, độ cao yên ngựa nhỏ nhất) cho các ô a trong
+    box = (r0, r1, c0, c1) và lân cận b theo nửa số hướng (mỗi cặp ô kề chỉ xét một lần);
+    b nằm ngoài mảng -> bỏ qua (cửa sổ tile đã đệm viền nên cặp qua mép tile vẫn đủ).
+    """
+    r0, r1, c0, c1 = box
+    nr, nc = basin.shape
+    keys, heights = [], []
+    for dr, dc in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        ra, rb = r0, min(r1, nr - dr)
+        ca, cb = max(c0, -dc), min(c1, nc - dc)
+        if ra >= rb or ca >= cb:
+            continue
+        a = basin[ra:rb, ca:cb]
+        b = basin[ra + dr:rb + dr, ca + dc:cb + dc]
+        m = (a != b) & (a > 0) & (b > 0)
+        if not m.any():
+            continue
+        aa, bb = a[m].astype(np.int64), b[m].astype(np.int64)
+        keys.append(np.minimum(aa, bb) * base + np.maximum(aa, bb))
+        heights.append(np.maximum(z[ra:rb, ca:cb][m], z[ra + dr:rb + dr, ca + dc:cb + dc][m]))
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    return _min_per_key(np.concatenate(keys), np.concatenate(heights).astype(np.float64))
+
+
+def _min_per_key(keys, heights):
+    srt = np.lexsort((heights, keys))
+    keys, heights = keys[srt], heights[srt]
+    first = np.ones(keys.size, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return keys[first], heights[first]
+
+
+def _spill_levels(keys, heights, base):
+    """Mực tràn của từng lưu vực (float64, chỉ số = nhãn; nút 0 = ngoài raster) từ các cạnh (khoá, độ cao)."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import minimum_spanning_tree, breadth_first_order
+
+    n = int(base)
+    if keys.size == 0:
+        return np.full(n, -np.inf)
+    keys, heights = _min_per_key(keys, heights)
+    lo, hi = keys // base, keys % base
+
+    # Mực tràn = cạnh lớn nhất trên đường từ nút 0 trong cây khung nhỏ nhất (minimax path)
+    hmin = heights.min()
+    w = heights - hmin + 1.0   # trọng số > 0 (0 bị csgraph coi là không có cạnh)
+    graph = coo_matrix((w, (lo, hi)), shape=(n, n)).tocsr()
+    mst = minimum_spanning_tree(graph)
+    mst = (mst + mst.T).tocsr()
+    bfs, pred = breadth_first_order(mst, 0, directed=False, return_predecessors=True)
+    child = bfs[1:]
+    edge_h = (np.asarray(mst[pred[child], child]).ravel() - 1.0 + hmin).tolist()
+    level = [-math.inf] * n
+    pred = pred.tolist()
+    for c, h in zip(child.tolist(), edge_h):
+        lp = level[pred[c]]
+        level[c] = lp if lp > h else h
+
+    lv_arr = np.asarray(level, dtype=np.float64)
+    lv_arr[~np.isfinite(lv_arr)] = -np.inf
+    return lv_arr
+
+
+# ---------------- Chế độ theo tile (DEM lớn hơn RAM) ----------------
+def iter_tiles(width, height, tile):
+    """Lưới tile (x, y, w, h) theo hàng, giống RasterOutlierFilterFast."""
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            yield x, y, min(tile, width - x), min(tile, height - y)
+
+
+def _create_like(ds, path, gdal_type, nodata):
+    drv = gdal.GetDriverByName("GTiff")
+    out = drv.Create(path, ds.RasterXSize, ds.RasterYSize, 1, gdal_type,
+                     options=["TILED=YES", "COMPRESS=LZW", "BIGTIFF=IF_SAFER"])
+    if out is None:
+        raise RuntimeError(f"Không tạo được raster: {path}")
+    out.SetGeoTransform(ds.GetGeoTransform())
+    out.SetProjection(ds.GetProjection())
+    if nodata is not None:
+        out.GetRasterBand(1).SetNoDataValue(nodata)
+    return out
+
+
+def _report(feedback, done, total, lo=0.0, hi=100.0):
+    if feedback is not None:
+        feedback.setProgress(int(lo + (hi - lo) * done / max(1, total)))
+
+
+def d8_flow_direction_tiled(dem_path, fdir_path, tile, feedback=None, progress=(0.0, 100.0)):
+    """
+    Ghi raster hướng D8 (Byte, NoData=FDIR_NODATA) theo từng tile; trùng khớp d8_flow_direction
+    chạy một lượt (kể cả vùng phẳng trải qua nhiều tile):
+    1) Mỗi tile + viền 2 ô: hướng theo độ dốc; ô phẳng kề ô thoát cùng độ cao nhận hướng ngay
+       (lớp BFS 1), ô phẳng còn lại ghi FDIR_FLAT, khoảng cách tới lối thoát ghi vào raster tạm Int32.
+    2) Lan khoảng cách qua mép tile theo hàng đợi (chỉ tile có ô phẳng; tile được xét lại khi ô viền
+       của tile kề giảm) tới khi ổn định -> khoảng cách BFS toàn cục.
+    3) Ô phẳng chảy về lân cận có khoảng cách nhỏ hơn 1, cùng thứ tự ưu tiên hướng như _resolve_flats;
+       ô không tới được lối thoát -> FDIR_NONE.
+    """
+    ds = gdal.Open(dem_path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {dem_path}")
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    gt = ds.GetGeoTransform()
+    W, H = ds.RasterXSize, ds.RasterYSize
+    out = _create_like(ds, fdir_path, gdal.GDT_Byte, FDIR_NODATA)
+    ob = out.GetRasterBand(1)
+    lo, hi = progress
+    mid1 = lo + (hi - lo) * 0.6
+    mid2 = lo + (hi - lo) * 0.8
+
+    tiles = list(iter_tiles(W, H, tile))
+    dist_path = fdir_path + ".flatdist.tif"
+    dist_ds = None
+    flat_tiles = []
+
+    # Lượt 1
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            break
+        x0, y0 = max(0, x - 2), max(0, y - 2)
+        x1, y1 = min(W, x + w + 2), min(H, y + h + 2)
+        z = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.float32, copy=False)
+        if nodata is not None:
+            z[z == np.float32(nodata)] = np.nan
+        fd = d8_flow_direction(z, abs(gt[1]), abs(gt[5]), resolve_flats=False)
+        # Ô biên / hướng độ dốc đúng cho tile + vòng 1 ô (đủ lân cận trong cửa sổ viền 2)
+        unres = (fd == FDIR_NONE) & ~_edge_mask(np.isfinite(z))
+        r0, c0 = y - y0, x - x0
+        inner = np.zeros(z.shape, dtype=bool)
+        inner[r0:r0 + h, c0:c0 + w] = True
+        idx = np.flatnonzero((unres & inner).ravel())
+        if idx.size:
+            fdf = fd.ravel()
+            new_dir = _first_flat_layer(z.ravel(), ~unres.ravel() & (fdf != FDIR_NODATA), idx,
+                                        _flat_offsets(z.shape[1]))
+            got = new_dir != FDIR_NONE
+            fdf[idx[got]] = new_dir[got]
+            fdf[idx[~got]] = FDIR_FLAT
+            # ghi cả khi mọi ô đã có hướng: ô lớp 1 là nguồn cho ô phẳng ở tile kề
+            dist = np.zeros(z.shape, dtype=np.int32)
+            df = dist.ravel()
+            df[idx[got]] = 1
+            df[idx[~got]] = _DIST_INF
+            if dist_ds is None:
+                dist_ds = _create_like(ds, dist_path, gdal.GDT_Int32, None)
+            dist_ds.GetRasterBand(1).WriteArray(dist[r0:r0 + h, c0:c0 + w], x, y)
+            if not got.all():
+                flat_tiles.append(i)
+        ob.WriteArray(fd[r0:r0 + h, c0:c0 + w], x, y)
+        _report(feedback, i + 1, len(tiles), lo, mid1)
+    ds = None
+
+    if flat_tiles and not (feedback is not None and feedback.isCanceled()):
+        db = dist_ds.GetRasterBand(1)
+        pos = {(x // tile, y // tile): i for i, (x, y, w, h) in enumerate(tiles)}
+        flat_set = set(flat_tiles)
+
+        # Lượt 2: hàng đợi tile
+        queue, queued = deque(flat_tiles), set(flat_tiles)
+        while queue:
+            if feedback is not None and feedback.isCanceled():
+                break
+            i = queue.popleft()
+            queued.discard(i)
+            x, y, w, h = tiles[i]
+            x0, y0 = max(0, x - 1), max(0, y - 1)
+            x1, y1 = min(W, x + w + 1), min(H, y + h + 1)
+            dp = np.pad(db.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.int64), 1)
+            r0, c0 = y - y0 + 1, x - x0 + 1
+            changed, edge_changed = _relax_flat_distance(dp, r0, c0, h, w)
+            if not changed:
+                continue
+            db.WriteArray(dp[r0:r0 + h, c0:c0 + w].astype(np.int32), x, y)
+            if edge_changed:
+                tx, ty = x // tile, y // tile
+                for dy in (-1, 0, 1):
+                    for dx in (-1, 0, 1):
+                        j = pos.get((tx + dx, ty + dy))
+                        if j is not None and j != i and j in flat_set and j not in queued:
+                            queue.append(j)
+                            queued.add(j)
+        _report(feedback, 1, 1, lo, mid2)
+
+        # Lượt 3
+        for n, i in enumerate(flat_tiles):
+            if feedback is not None and feedback.isCanceled():
+                break
+            x, y, w, h = tiles[i]
+            x0, y0 = max(0, x - 1), max(0, y - 1)
+            x1, y1 = min(W, x + w + 1), min(H, y + h + 1)
+            dp = np.pad(db.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.int64), 1)
+            r0, c0 = y - y0 + 1, x - x0 + 1
+            fd = ob.ReadAsArray(x, y, w, h)
+            rr, cc = np.nonzero(fd == FDIR_FLAT)
+            nc = dp.shape[1]
+            g = (rr + r0) * nc + (cc + c0)
+            df = dp.ravel()
+            d = df[g]
+            new_dir = np.full(g.size, FDIR_NONE, dtype=np.uint8)
+            ok = d < _DIST_INF
+            offs = _flat_offsets(nc)
+            for k in (4, 5, 6, 7, 0, 1, 2, 3):
+                hit = ok & (new_dir == FDIR_NONE) & (df[g + offs[k]] == d - 1)
+                new_dir[hit] = k
+            fd[rr, cc] = new_dir
+            ob.WriteArray(fd, x, y)
+            _report(feedback, n + 1, len(flat_tiles), mid2, hi)
+    ob.FlushCache()
+    out = None
+    if dist_ds is not None:
+        dist_ds = None
+        try:
+            gdal.GetDriverByName("GTiff").Delete(dist_path)
+        except Exception:
+            if os.path.exists(dist_path):
+                os.remove(dist_path)
+    return fdir_path
+
+
+def _relax_flat_distance(dp, r0, c0, h, w):
+    """
+    BFS nhiều nguồn trên cửa sổ khoảng cách dp (đã đệm 1 ô 0, sửa tại chỗ): nguồn = ô lớp 1 và ô viền
+    (từ tile kề) có khoảng cách hữu hạn, chỉ ô phẳng trong tile [r0:r0+h, c0:c0+w] (giá trị ≥ 2) được giảm.
+    Hai ô phẳng kề nhau luôn cùng độ cao (không ô nào thấp hơn lân cận của nó) -> không cần DEM.
+    Trả (có ô thay đổi, có ô viền tile thay đổi).
+    """
+    nc = dp.shape[1]
+    df = dp.ravel()
+    inner = np.zeros(dp.shape, dtype=bool)
+    inner[r0:r0 + h, c0:c0 + w] = True
+    relax = inner.ravel() & (df >= 2)
+    if not relax.any():
+        return False, False
+    before = df.copy()
+    # Giá trị trong tile đã là điểm bất động của lần xét trước -> chỉ lan lại từ viền (tile kề) và lớp 1
+    src = np.flatnonzero(((df == 1) | ~inner.ravel()) & (df >= 1) & (df < _DIST_INF))
+    lv = df[src]
+    srt = np.argsort(lv, kind="stable")
+    src, lv = src[srt], lv[srt]
+    offs = _flat_offsets(nc)
+    p = 0
+    frontier = src[:0]
+    level = lv[0] if src.size else 0
+    while p < src.size or frontier.size:
+        if not frontier.size:
+            level = lv[p]
+        q = np.searchsorted(lv, level, side="right")
+        seeds = src[p:q]
+        p = q
+        seeds = seeds[df[seeds] == level]
+        if seeds.size:
+            frontier = np.unique(np.concatenate([frontier, seeds]))
+        nxt = []
+        for k in range(8):
+            u = frontier + offs[k]
+            u = u[relax[u] & (df[u] > level + 1)]
+            if u.size:
+                df[u] = level + 1
+                nxt.append(u)
+        frontier = np.unique(np.concatenate(nxt)) if nxt else frontier[:0]
+        level += 1
+    diff = (df != before).reshape(dp.shape)
+    if not diff.any():
+        return False, False
+    ring = diff[r0:r0 + h, c0:c0 + w].copy()
+    ring[1:-1, 1:-1] = False
+    return True, bool(ring.any())
+
+
+def _tile_receivers(fd, x, y, width):
+    """
+    Ô nhận nước trong tile: rec (chỉ số cục bộ, -1 nếu không chảy hoặc chảy ra khỏi tile)
+    và tgt (chỉ số toàn cục của ô ngoài tile mà dòng chảy đi vào, -1 nếu không).
+    """
+    h, w = fd.shape
+    f = fd.ravel()
+    n = f.size
+    rec = np.full(n, -1, dtype=np.int64)
+    tgt = np.full(n, -1, dtype=np.int64)
+    fi = np.flatnonzero(f < FDIR_NONE)
+    if fi.size == 0:
+        return rec, tgt
+    k = f[fi]
+    drs = np.array([o[0] for o in D8_OFFSETS], dtype=np.int64)
+    dcs = np.array([o[1] for o in D8_OFFSETS], dtype=np.int64)
+    rr = fi // w + drs[k]
+    cc = fi % w + dcs[k]
+    inside = (rr >= 0) & (rr < h) & (cc >= 0) & (cc < w)
+    rec[fi[inside]] = rr[inside] * w + cc[inside]
+    out = ~inside
+    tgt[fi[out]] = (y + rr[out]) * width + (x + cc[out])
+    return rec, tgt
+
+
+def _perimeter(h, w):
+    """Chỉ số cục bộ (duy nhất) của các ô viền tile."""
+    if h == 1 or w == 1:
+        return np.arange(h * w, dtype=np.int64)
+    top = np.arange(w, dtype=np.int64)
+    bottom = (h - 1) * w + top
+    rows = np.arange(1, h - 1, dtype=np.int64) * w
+    return np.concatenate([top, bottom, rows, rows + (w - 1)])
+
+
+def flow_accumulation_tiled(fdir_path, acc_path, tile, feedback=None, progress=(0.0, 100.0)):
+    """
+    Tích luỹ dòng chảy out-of-core trên raster hướng D8 (mã như d8_flow_direction):
+    1) Mỗi tile: tích luỹ cục bộ; ghi nhận dòng ra khỏi tile và "liên kết" ô viền -> ô đích.
+    2) Giải đồ thị chỉ gồm các ô viền (nhỏ) -> lượng nước từ ngoài đổ vào từng ô viền.
+    3) Mỗi tile: tích luỹ lại với trọng số 1 + lượng đổ vào, ghi Float32 (NoData=-1).
+    Kết quả trùng khớp với flow_accumulation chạy một lượt trên toàn raster.
+    Bộ nhớ đỉnh ~ kích thước tile + số ô viền.
+    """
+    ds = gdal.Open(fdir_path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {fdir_path}")
+    band = ds.GetRasterBand(1)
+    W, H = ds.RasterXSize, ds.RasterYSize
+    tiles = list(iter_tiles(W, H, tile))
+    lo, hi = progress
+    mid1 = lo + (hi - lo) * 0.45
+    mid2 = lo + (hi - lo) * 0.55
+
+    # Lượt 1
+    link_src, link_dst, exit_t, exit_acc = [], [], [], []
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            return None
+        fd = band.ReadAsArray(x, y, w, h)
+        valid = fd.ravel() != FDIR_NODATA
+        rec, tgt = _tile_receivers(fd, x, y, W)
+        order, bounds = topological_levels(rec, valid)
+        acc = flow_accumulation(rec, order, bounds)
+        ex = np.flatnonzero(tgt >= 0)
+        if ex.size:
+            exit_t.append(tgt[ex])
+            exit_acc.append(acc[ex])
+            seeds = np.zeros(rec.size, dtype=np.int32)
+            seeds[ex] = np.arange(1, ex.size + 1, dtype=np.int32)
+            lab = label_basins(rec, order, bounds, seeds)
+            per = _perimeter(h, w)
+            per = per[valid[per] & (lab[per] > 0)]
+            link_src.append((y + per // w) * W + (x + per % w))
+            link_dst.append(tgt[ex][lab[per] - 1])
+        _report(feedback, i + 1, len(tiles), lo, mid1)
+
+    # Lượt 2: đồ thị ô viền
+    if exit_t:
+        link_src = np.concatenate(link_src)
+        link_dst = np.concatenate(link_dst)
+        exit_t = np.concatenate(exit_t)
+        exit_acc = np.concatenate(exit_acc)
+        nodes = np.unique(np.concatenate([link_src, link_dst, exit_t]))
+        rec_c = np.full(nodes.size, -1, dtype=np.int64)
+        rec_c[np.searchsorted(nodes, link_src)] = np.searchsorted(nodes, link_dst)
+        inflow = np.bincount(np.searchsorted(nodes, exit_t), weights=exit_acc, minlength=nodes.size)
+        order, bounds = topological_levels(rec_c)
+        inflow = flow_accumulation(rec_c, order, bounds, inflow)
+        del link_src, link_dst, exit_t, exit_acc, rec_c, order, bounds
+    else:
+        nodes = np.zeros(0, dtype=np.int64)
+        inflow = np.zeros(0, dtype=np.float64)
+    _report(feedback, 1, 1, lo, mid2)
+
+    # Lượt 3
+    out = _create_like(ds, acc_path, gdal.GDT_Float32, -1.0)
+    ob = out.GetRasterBand(1)
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            break
+        fd = band.ReadAsArray(x, y, w, h)
+        valid = fd.ravel() != FDIR_NODATA
+        rec, _ = _tile_receivers(fd, x, y, W)
+        order, bounds = topological_levels(rec, valid)
+        weights = np.ones(rec.size, dtype=np.float64)
+        if nodes.size:
+            per = _perimeter(h, w)
+            g = (y + per // w) * W + (x + per % w)
+            pos = np.minimum(np.searchsorted(nodes, g), nodes.size - 1)
+            hit = nodes[pos] == g
+            weights[per[hit]] += inflow[pos[hit]]
+        acc = flow_accumulation(rec, order, bounds, weights).astype(np.float32)
+        acc[~valid] = -1.0
+        ob.WriteArray(acc.reshape(h, w), x, y)
+        _report(feedback, i + 1, len(tiles), mid2, hi)
+    ob.FlushCache()
+    out = None
+    ds = None
+    return acc_path
+
+
+def _fill_tile_basins(band, nodata, W, H, x, y, w, h):
+    """
+    Một tile của fill_depressions_tiled (cửa sổ viền 2 ô): DEM đã nâng hố 1 ô cho tile + vòng 1 ô,
+    nhãn lưu vực cục bộ của ô trong tile (1..npit = vùng hố trong tile, npit+1.. = ô chảy ra khỏi tile
+    theo thứ tự ex), ex (chỉ số cục bộ ô chảy ra) và tgt (chỉ số toàn cục ô đích của chúng).
+    """
+    from scipy import ndimage
+
+    x0, y0 = max(0, x - 2), max(0, y - 2)
+    x1, y1 = min(W, x + w + 2), min(H, y + h + 2)
+    z = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(np.float32, copy=False)
+    if nodata is not None:
+        z[z == np.float32(nodata)] = np.nan
+    valid = np.isfinite(z)
+    z = _raise_single_pits(z, valid, _edge_mask(valid))
+    r0, c0 = y - y0, x - x0
+    fd = d8_flow_direction(z, resolve_flats=False)[r0:r0 + h, c0:c0 + w]
+    vt = valid[r0:r0 + h, c0:c0 + w].ravel()
+    pits, npit = ndimage.label(fd == FDIR_NONE, structure=np.ones((3, 3), dtype=bool))
+    rec, tgt = _tile_receivers(fd, x, y, W)
+    ex = np.flatnonzero(tgt >= 0)
+    seeds = pits.ravel().astype(np.int32)
+    seeds[ex] = np.arange(npit + 1, npit + 1 + ex.size, dtype=np.int32)
+    order, bounds = topological_levels(rec, vt)
+    lab = label_basins(rec, order, bounds, seeds)
+    lab[~vt] = 0
+    zr = z[max(0, r0 - 1):r0 + h + 1, max(0, c0 - 1):c0 + w + 1]
+    return zr, lab.reshape(h, w), npit, ex, tgt[ex]
+
+
+def fill_depressions_tiled(dem_path, out_path, tile, feedback=None, progress=(0.0, 100.0)):
+    """
+    Lấp hố out-of-core, trùng khớp fill_depressions chạy một lượt (cùng cây khung nhỏ nhất trên
+    đồ thị lưu vực hố). Ghi Float32 (NoData như DEM gốc, NaN nếu DEM không khai báo):
+    1) Mỗi tile + viền 2 ô: nâng hố 1 ô, D8 không xử lý vùng phẳng, gán nhãn lưu vực cục bộ
+       (vùng hố trong tile; ô chảy ra khỏi tile nhận nhãn tạm). Ô viền ghi nhận nhãn hố hoặc ô đích.
+    2) Đồ thị ô viền -> nhãn hố toàn cục cho mọi ô chảy qua mép tile (vùng hố trải nhiều tile
+       được nối bằng cạnh có độ cao bằng đáy hố -> cùng mực tràn như khi gộp thành 1 lưu vực).
+       Ghi raster nhãn tạm Int32 và DEM đã nâng hố vào out_path.
+    3) Mỗi tile + viền 1 ô: cạnh yên ngựa giữa các lưu vực kề (kể cả qua mép tile) và ô biên -> nút 0;
+       gộp cạnh toàn cục -> mực tràn từng lưu vực.
+    4) Mỗi tile: max(DEM đã nâng, mực tràn của lưu vực).
+    Bộ nhớ đỉnh ~ kích thước tile + số ô viền + số cạnh giữa các lưu vực.
+    """
+    ds = gdal.Open(dem_path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {dem_path}")
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    W, H = ds.RasterXSize, ds.RasterYSize
+    tiles = list(iter_tiles(W, H, tile))
+    lo, hi = progress
+    mids = [lo + (hi - lo) * f for f in (0.3, 0.35, 0.6, 0.8)]
+
+    # Lượt 1
+    offset = []
+    cells, pit_of, dst = [], [], []
+    npits = 0
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            return None
+        _zr, lab, npit, ex, ext = _fill_tile_basins(band, nodata, W, H, x, y, w, h)
+        offset.append(npits)
+        per = _perimeter(h, w)
+        lp = lab.ravel()[per]
+        per, lp = per[lp > 0], lp[lp > 0]
+        cells.append((y + per // w) * W + (x + per % w))
+        pit = lp <= npit
+        pit_of.append(np.where(pit, npits + lp, 0))
+        d = np.full(lp.size, -1, dtype=np.int64)
+        d[~pit] = ext[lp[~pit] - npit - 1]
+        dst.append(d)
+        npits += npit
+        _report(feedback, i + 1, len(tiles), lo, mids[0])
+
+    # Lượt 2a: ô viền -> hố toàn cục (nhảy con trỏ; dòng chảy không có chu trình)
+    cells = np.concatenate(cells)
+    pit_of = np.concatenate(pit_of)
+    dst = np.concatenate(dst)
+    srt = np.argsort(cells)
+    cells, pit_of, dst = cells[srt], pit_of[srt], dst[srt]
+    nxt = np.arange(cells.size, dtype=np.int64)
+    m = dst >= 0
+    nxt[m] = np.searchsorted(cells, dst[m])
+    while True:
+        nn = nxt[nxt]
+        if np.array_equal(nn, nxt):
+            break
+        nxt = nn
+    pit_of = pit_of[nxt]
+    del dst, nxt, nn
+    _report(feedback, 1, 1, lo, mids[1])
+
+    # Lượt 2b
+    lab_path = out_path + ".basins.tif"
+    lab_ds = _create_like(ds, lab_path, gdal.GDT_Int32, None)
+    lb = lab_ds.GetRasterBand(1)
+    out = _create_like(ds, out_path, gdal.GDT_Float32, nodata)
+    ob = out.GetRasterBand(1)
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            break
+        zr, lab, npit, ex, ext = _fill_tile_basins(band, nodata, W, H, x, y, w, h)
+        lut = np.zeros(npit + ex.size + 1, dtype=np.int64)
+        lut[1:npit + 1] = np.arange(offset[i] + 1, offset[i] + npit + 1)
+        if ex.size:
+            lut[npit + 1:] = pit_of[np.searchsorted(cells, ext)]
+        lb.WriteArray(lut[lab].astype(np.int32), x, y)
+        r0, c0 = (1 if y > 0 else 0), (1 if x > 0 else 0)
+        ob.WriteArray(zr[r0:r0 + h, c0:c0 + w], x, y)
+        _report(feedback, i + 1, len(tiles), mids[1], mids[2])
+    del cells, pit_of
+
+    # Lượt 3
+    base = np.int64(npits + 1)
+    keys, heights = [], []
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            break
+        x0, y0 = max(0, x - 1), max(0, y - 1)
+        x1, y1 = min(W, x + w + 1), min(H, y + h + 1)
+        lw = lb.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        zw = ob.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        r0, c0 = y - y0, x - x0
+        k, hh = _spill_edges(lw, zw, base, (r0, r0 + h, c0, c0 + w))
+        edge = _edge_mask(np.isfinite(zw))[r0:r0 + h, c0:c0 + w]
+        lt = lw[r0:r0 + h, c0:c0 + w]
+        edge &= lt > 0
+        keys.append(np.concatenate([k, lt[edge].astype(np.int64)]))
+        heights.append(np.concatenate([hh, zw[r0:r0 + h, c0:c0 + w][edge].astype(np.float64)]))
+        if keys[-1].size > 4 * tile:
+            keys[-1], heights[-1] = _min_per_key(keys[-1], heights[-1])
+        _report(feedback, i + 1, len(tiles), mids[2], mids[3])
+    level = _spill_levels(np.concatenate(keys), np.concatenate(heights), base) if keys else None
+    del keys, heights
+
+    # Lượt 4
+    for i, (x, y, w, h) in enumerate(tiles):
+        if feedback is not None and feedback.isCanceled():
+            break
+        zt = ob.ReadAsArray(x, y, w, h)
+        filled = np.maximum(zt, level[lb.ReadAsArray(x, y, w, h)].astype(np.float32))
+        if nodata is not None:
+            filled[~np.isfinite(zt)] = np.float32(nodata)
+        ob.WriteArray(filled, x, y)
+        _report(feedback, i + 1, len(tiles), mids[3], hi)
+    ob.FlushCache()
+    out = None
+    lab_ds = None
+    try:
+        gdal.GetDriverByName("GTiff").Delete(lab_path)
+    except Exception:
+        if os.path.exists(lab_path):
+            os.remove(lab_path)
+    ds = None
+    return out_path
+
+
+def stream_order_tiled(fdir_path, acc_path, thresh, method="strahler", tile=2048, with_receivers=False):
+    """
+    Phân cấp dòng chảy khi không nạp được toàn raster: chỉ gom các ô stream
+    (acc >= thresh) vào bộ nhớ. Trả (gidx, order): chỉ số toàn cục (đã sắp xếp) và cấp;
+    with_receivers=True trả thêm chỉ số toàn cục của ô nhận nước (-1 nếu không chảy).
+    """
+    dds = gdal.Open(fdir_path, gdal.GA_ReadOnly)
+    ads = gdal.Open(acc_path, gdal.GA_ReadOnly)
+    if dds is None or ads is None:
+        raise RuntimeError("GDAL không mở được raster hướng/tích luỹ.")
+    db, ab = dds.GetRasterBand(1), ads.GetRasterBand(1)
+    W, H = dds.RasterXSize, dds.RasterYSize
+    gs, rs = [], []
+    for x, y, w, h in iter_tiles(W, H, tile):
+        fd = db.ReadAsArray(x, y, w, h)
+        acc = ab.ReadAsArray(x, y, w, h)
+        li = np.flatnonzero(((acc >= thresh) & (fd != FDIR_NODATA)).ravel())
+        if li.size == 0:
+            continue
+        rec, tgt = _tile_receivers(fd, x, y, W)
+        g = (y + li // w) * W + (x + li % w)
+        r = rec[li]
+        inside = r >= 0
+        rg = tgt[li]
+        rg[inside] = (y + r[inside] // w) * W + (x + r[inside] % w)
+        gs.append(g)
+        rs.append(rg)
+    dds = ads = None
+    if not gs:
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        return empty + (np.zeros(0, dtype=np.int64),) if with_receivers else empty
+    g = np.concatenate(gs)
+    r = np.concatenate(rs)
+    srt = np.argsort(g)
+    g, r = g[srt], r[srt]
+    pos = np.minimum(np.searchsorted(g, r), g.size - 1)
+    rec_c = np.where((r >= 0) & (g[pos] == r), pos, -1).astype(np.int64)
+    order, bounds = topological_levels(rec_c)
+    so = stream_order(rec_c, order, bounds, np.ones(g.size, dtype=bool), method)
+    return (g, so, r) if with_receivers else (g, so)
+
+
+def write_sparse_tiled(ref_path, path, gidx, values, gdal_type, tile=2048, nodata=0):
+    """Ghi raster từ các cặp (chỉ số toàn cục đã sắp xếp, giá trị); ô còn lại = nodata."""
+    ds = gdal.Open(ref_path, gdal.GA_ReadOnly)
+    out = _create_like(ds, path, gdal_type, nodata)
+    ob = out.GetRasterBand(1)
+    W, H = ds.RasterXSize, ds.RasterYSize
+    dtype = gdal_array_dtype(gdal_type)
+    for x, y, w, h in iter_tiles(W, H, tile):
+        a = np.full((h, w), nodata, dtype=dtype)
+        s0, s1 = np.searchsorted(gidx, [y * W, (y + h) * W])
+        g = gidx[s0:s1]
+        col = g % W
+        m = (col >= x) & (col < x + w)
+        a[g[m] // W - y, col[m] - x] = values[s0:s1][m]
+        ob.WriteArray(a, x, y)
+    ob.FlushCache()
+    out = None
+    ds = None
+    return path
+
+
+def gdal_array_dtype(gdal_type):
+    return {
+        gdal.GDT_Byte: np.uint8, gdal.GDT_UInt16: np.uint16, gdal.GDT_Int16: np.int16,
+        gdal.GDT_UInt32: np.uint32, gdal.GDT_Int32: np.int32,
+        gdal.GDT_Float32: np.float32, gdal.GDT_Float64: np.float64,
+    }.get(gdal_type, np.float32)
+
+
+# ---------------- Vector hoá mạng sông theo lưới D8 ----------------
+def sample_sparse(path, gidx, chunk_rows=1024, band=1):
+    """Đọc giá trị raster tại các chỉ số toàn cục (đã sắp xếp), theo từng khối chunk_rows dòng."""
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"GDAL không mở được raster: {path}")
+    b = ds.GetRasterBand(band)
+    W, H = ds.RasterXSize, ds.RasterYSize
+    out = np.zeros(gidx.size, dtype=np.float64)
+    for y in range(0, H, chunk_rows):
+        h = min(chunk_rows, H - y)
+        s0, s1 = np.searchsorted(gidx, [y * W, (y + h) * W])
+        if s0 == s1:
+            continue
+        out[s0:s1] = b.ReadAsArray(0, y, W, h).ravel()[gidx[s0:s1] - y * W]
+    ds = None
+    return out
+
+
+def trace_links(gidx, rcv, order, acc):
+    """
+    Chia các ô stream thành đoạn (link): từ đầu nguồn / hợp lưu tới ô ngay trước hợp lưu kế tiếp
+    hoặc cửa xả. gidx: chỉ số toàn cục ô stream (đã sắp xếp); rcv: chỉ số toàn cục ô nhận nước
+    (-1 nếu không chảy); order, acc: cấp & tích luỹ tại từng ô.
+    Trả (cells, bounds, link_order, link_acc, link_ds, tail):
+    - cells[bounds[k]:bounds[k+1]]: các ô của link k+1 theo chiều dòng chảy;
+    - link_acc: tích luỹ tại ô cuối link; link_ds: id link hạ lưu (0 nếu không có);
+    - tail: ô hợp lưu hạ lưu (để nối hình học liền mạch), -1 nếu không có.
+    """
+    n = gidx.size
+    if n == 0:
+        z = np.zeros(0, dtype=np.int64)
+        return z, np.zeros(1, dtype=np.int64), z.astype(np.int32), z.astype(np.float64), z, z
+    pos = np.minimum(np.searchsorted(gidx, rcv), n - 1)
+    down = np.where((rcv >= 0) & (gidx[pos] == rcv), pos, -1)
+    inflow = np.bincount(down[down >= 0], minlength=n)
+    start = inflow != 1
+
+    # ô giữa link có đúng 1 ô thượng lưu -> nhảy con trỏ (pointer jumping) về ô đầu link
+    root = np.arange(n)
+    src = np.flatnonzero(down >= 0)
+    tgt = down[src]
+    m = ~start[tgt]
+    root[tgt[m]] = src[m]
+    dist = (~start).astype(np.int64)
+    while True:
+        nxt = root[root]
+        if np.array_equal(nxt, root):
+            break
+        dist += dist[root]
+        root = nxt
+
+    heads = np.flatnonzero(start)
+    lid = np.zeros(n, dtype=np.int64)
+    lid[heads] = np.arange(1, heads.size + 1)
+    link = lid[root]
+    srt = np.lexsort((dist, link))
+    bounds = np.zeros(heads.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(link, minlength=heads.size + 1)[1:], out=bounds[1:])
+    last = srt[bounds[1:] - 1]
+    ds_cell = down[last]
+    has_ds = ds_cell >= 0
+    link_ds = np.where(has_ds, link[np.maximum(ds_cell, 0)], 0)
+    tail = np.where(has_ds, gidx[np.maximum(ds_cell, 0)], -1)
+    return gidx[srt], bounds, np.asarray(order)[heads].astype(np.int32), np.asarray(acc, dtype=np.float64)[last], \
+        link_ds, tail
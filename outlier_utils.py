@@ -0,0 +1,908 @@
+# -*- coding: utf-8 -*-
+"""
+Lõi lọc điểm ảnh bất thường (outlier) dùng chung cho RasterOutlierFilterFast / RasterOutlierFilterSingle.
+Toàn bộ là hàm cấp module, không import QGIS -> chạy được cả trong luồng (threads)
+lẫn tiến trình con (processes, mỗi tiến trình tự mở dataset GDAL).
+"""
+import os
+import sys
+import threading
+
+import numpy as np
+from osgeo import gdal
+
+EXEC_AUTO, EXEC_THREADS, EXEC_PROCESSES = 0, 1, 2
+TILE_AUTO, TILE_FIXED = 0, 1
+OUT_GTIFF, OUT_COG, OUT_VRT = 0, 1, 2
+ZHIST_STEP, ZHIST_BINS = 0.25, 40  # histogram |z|: 0–10 bước 0.25, ô cuối = |z| ≥ 10
+_CACHE_CAP = 2048 * 1024 * 1024
+
+
+# ---------------- Kiểu dữ liệu đầu ra ----------------
+def dtype_range(gdal_type):
+    """(min, max, là số nguyên) của kiểu GDAL đầu ra."""
+    if gdal_type == gdal.GDT_Byte:   return (0, 255, True)
+    if gdal_type == gdal.GDT_UInt16: return (0, 65535, True)
+    if gdal_type == gdal.GDT_Int16:  return (-32768, 32767, True)
+    if gdal_type == gdal.GDT_UInt32: return (0, 4294967295, True)
+    if gdal_type == gdal.GDT_Int32:  return (-2147483648, 2147483647, True)
+    if gdal_type == gdal.GDT_Float32:return (np.finfo(np.float32).min, np.finfo(np.float32).max, False)
+    if gdal_type == gdal.GDT_Float64:return (np.finfo(np.float64).min, np.finfo(np.float64).max, False)
+    return (np.finfo(np.float32).min, np.finfo(np.float32).max, False)
+
+
+_NP_INT = {gdal.GDT_Byte: np.uint8, gdal.GDT_UInt16: np.uint16, gdal.GDT_Int16: np.int16,
+           gdal.GDT_UInt32: np.uint32}
+
+
+# ---------------- Lưới tile theo block nguồn ----------------
+# tile cao ít nhất chừng này lần viền đọc thêm (2*pad) -> phần đọc thừa không lấn át phần lọc
+_PAD_RATIO = 4
+
+
+def block_aligned_tile_size(width, height, block_x, block_y, target, pad=0):
+    """
+    (tile_w, tile_h) là bội số block nguồn, diện tích ~ target².
+    Raster dạng strip (block = cả hàng) -> tile = nguyên dải hàng, chiều cao là bội số số hàng/strip.
+    pad > 0 (viền lọc nhiều vòng): tile_h ≥ _PAD_RATIO * 2 * pad (làm tròn lên bội số block_y), vì dải
+    hàng của raster rộng chỉ cao vài chục hàng, thấp hơn cả viền.
+    """
+    if block_x >= width:
+        tw = width
+    else:
+        tw = min(width, block_x * max(1, int(round(target / float(block_x)))))
+    th = block_y * max(1, int(round(target * target / float(tw) / block_y)))
+    if pad:
+        th = max(th, -(-_PAD_RATIO * 2 * pad // block_y) * block_y)
+    return tw, min(height, th)
+
+
+def tile_grid(width, height, tile_w, tile_h):
+    """Tile theo hàng, đảo chiều ở hàng lẻ (serpentine): tile liên tiếp luôn kề nhau -> block viền vừa đọc còn trong cache."""
+    tiles = []
+    for r, y in enumerate(range(0, height, tile_h)):
+        xs = list(range(0, width, tile_w))
+        if r % 2:
+            xs.reverse()
+        tiles.extend((x, y, min(tile_w, width - x), min(tile_h, height - y)) for x in xs)
+    return tiles
+
+
+def gdal_cache_bytes(handles, tile_w, tile_h, block_x, block_y, pad, itemsize, bands_per_block=1):
+    """
+    GDAL_CACHEMAX đủ giữ, cho mỗi dataset handle, các block phủ tile + viền pad của tile hiện tại
+    và tile kề trước (tối đa _CACHE_CAP; không bao giờ nhỏ hơn giá trị đang đặt).
+    """
+    bw = (-(-(tile_w + 2 * pad) // block_x) + 1) * block_x
+    bh = (-(-(tile_h + 2 * pad) // block_y) + 1) * block_y
+    need = 2 * handles * bw * bh * itemsize * bands_per_block
+    return max(gdal.GetCacheMax(), min(need, _CACHE_CAP))
+
+
+# ---------------- Bộ lọc cục bộ ----------------
+_STATS_ROWS = 256  # số hàng mỗi lượt tính phương sai float64
+_WS = threading.local()
+
+
+def _workspace(name, shape, dtype):
+    """Bộ đệm dùng lại giữa các tile trong cùng luồng/tiến trình (chỉ cấp phát lại khi tile lớn hơn)."""
+    bufs = getattr(_WS, "bufs", None)
+    if bufs is None:
+        bufs = _WS.bufs = {}
+    n = int(np.prod(shape))
+    flat = bufs.get(name)
+    if flat is None or flat.size < n or flat.dtype != dtype:
+        flat = bufs[name] = np.empty(n, dtype=dtype)
+    return flat[:n].reshape(shape)
+
+
+def neighbourhood_stats(arr_f32, win, with_median=False):
+    """
+    Mean/Std lân cận (loại tâm) và tuỳ chọn median, trong 1 lượt lọc hộp:
+    - Xếp [valid, safe, safe²] thành 1 mảng (3, h, w) và lọc hộp win×win một lần cho cả ba
+      (uniform_filter tách trục = tổng chạy theo hàng rồi theo cột, tương đương bảng tổng tích luỹ).
+    - Giữ đúng thứ tự phép tính float32/float64 như bản tách rời -> kết quả trùng từng bit.
+    - Mọi mảng tạm nằm trong bộ đệm của luồng, dùng lại giữa các tile.
+    Trả (mean_nb, std_nb, med|None) là view vào bộ đệm: chỉ hợp lệ tới lần gọi kế tiếp trong cùng luồng.
+    """
+    from scipy.ndimage import uniform_filter
+    h, w = arr_f32.shape
+    stack = _workspace("stack", (3, h, w), np.float32)
+    sums = _workspace("sums", (3, h, w), np.float32)
+    valid, safe, safe2 = stack
+
+    fin = _workspace("finite", (h, w), np.bool_)
+    np.isfinite(arr_f32, out=fin)
+    np.copyto(valid, fin)
+    np.copyto(safe, 0.0)
+    np.copyto(safe, arr_f32, where=fin)
+    np.multiply(safe, safe, out=safe2)
+
+    uniform_filter(stack, size=(1, win, win), mode="nearest", output=sums)
+    sums *= (win * win)
+    cnt_nb, sum_nb, sum2_nb = sums
+    cnt_nb -= valid
+    np.maximum(cnt_nb, 0.0, out=cnt_nb)
+    sum_nb -= safe
+    sum2_nb -= safe2
+
+    med = None
+    if with_median:
+        from scipy.ndimage import median_filter
+        med = _workspace("median", (h, w), np.float32)
+        median_filter(safe, size=win, mode="nearest", output=med)
+
+    # stack không còn cần -> dùng lại làm đầu ra mean/std
+    mean_nb, std_nb = stack[0], stack[1]
+    ok = fin  # tái dùng mảng bool
+    np.greater(cnt_nb, 0, out=ok)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(sum_nb, cnt_nb, out=mean_nb)
+        np.divide(sum2_nb, cnt_nb, out=sum2_nb)  # E[x²]
+    mean_nb[~ok] = np.nan
+
+    var = _workspace("var", (min(h, _STATS_ROWS), w), np.float64)
+    for r0 in range(0, h, _STATS_ROWS):
+        r1 = min(h, r0 + _STATS_ROWS)
+        v = var[:r1 - r0]
+        np.square(mean_nb[r0:r1], out=v, dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            np.subtract(sum2_nb[r0:r1], v, out=v)
+        np.maximum(v, 0.0, out=v)
+        v[~ok[r0:r1]] = np.nan
+        np.sqrt(v, out=v)
+        np.copyto(std_nb[r0:r1], v, casting="same_kind")
+    return mean_nb, std_nb, med
+
+
+def nearest_replace(arr_f32, mask_out):
+    from scipy.ndimage import distance_transform_edt
+    invalid = np.isnan(arr_f32)
+    temp_invalid = invalid | mask_out
+    _, inds = distance_transform_edt(temp_invalid, return_indices=True)
+    repl = arr_f32[tuple(inds)]
+    out = arr_f32.copy()
+    out[mask_out] = repl[mask_out]
+    return out
+
+
+def filter_array(arr, method, thr, win, mark_only, iterations=1, core=None):
+    """
+    Phát hiện & thay thế outlier trên 1 mảng float32 (NoData = NaN). MARK_ONLY -> mặt nạ uint8.
+    iterations > 1: lặp phát hiện/thay thế trên chính bộ đệm tới khi không còn pixel nào đổi
+    (cụm spike có hàng xóm cũng là outlier); MARK_ONLY khi đó đánh dấu mọi pixel bị thay ở bất kỳ vòng nào.
+    Trả (kết quả, info) với info tính ngay trong vòng đầu, chỉ trên vùng core (tuple slice, None = cả mảng):
+    {"replaced": [số pixel thay mỗi vòng], "valid", "nodata", "zhist": histogram |x - mean|/std}.
+    """
+    core = core or (slice(None), slice(None))
+    cur, marked, counts = arr, None, []
+    info = {"replaced": counts}
+    for it in range(max(1, iterations)):
+        last = it == max(1, iterations) - 1
+        need_med = method == 1 and not (mark_only and last)
+        mean_nb, std_nb, med = neighbourhood_stats(cur, win, with_median=need_med)
+        std_ok = np.isfinite(std_nb) & (std_nb > 0)
+        mask_out = np.isfinite(cur) & std_ok & (np.abs(cur - mean_nb) > thr * std_nb)
+        counts.append(int(np.count_nonzero(mask_out[core])))
+        if it == 0:
+            c_arr = cur[core]
+            fin_c = np.isfinite(c_arr)
+            info["valid"] = int(np.count_nonzero(fin_c))
+            info["nodata"] = int(c_arr.size) - info["valid"]
+            c_ok = std_ok[core] & fin_c
+            z = np.abs(c_arr[c_ok] - mean_nb[core][c_ok]) / std_nb[core][c_ok]
+            zi = np.minimum((z / ZHIST_STEP).astype(np.int64), ZHIST_BINS)
+            info["zhist"] = np.bincount(zi, minlength=ZHIST_BINS + 1).tolist()
+        if mark_only:
+            marked = mask_out if marked is None else (marked | mask_out)
+            if last:
+                break
+        if not mask_out.any():
+            break
+        if method == 0:  # mean
+            nxt = cur if cur is not arr else arr.copy()
+            nxt[mask_out] = mean_nb[mask_out]
+        elif method == 1:
+            nxt = cur if cur is not arr else arr.copy()
+            nxt[mask_out] = med[mask_out]
+        else:  # nearest
+            nxt = nearest_replace(cur, mask_out)
+        cur = nxt
+    if mark_only:
+        return marked.astype(np.uint8), info
+    return (cur if cur is not arr else arr.copy()), info
+
+
+def merge_counts(total, counts):
+    """Cộng dồn số pixel thay thế theo vòng của 1 tile vào tổng (danh sách dài ra khi cần)."""
+    if len(total) < len(counts):
+        total.extend([0] * (len(counts) - len(total)))
+    for k, n in enumerate(counts):
+        total[k] += n
+    return total
+
+
+class RunStats:
+    """
+    Thống kê cả lượt chạy, cộng dồn từ stats của từng tile (luồng ghi gọi add -> không cần khoá):
+    theo band và theo tile: số pixel hợp lệ / NoData / outlier (vòng 1) / đã thay (mọi vòng),
+    histogram |z| để chọn THRESHOLD; xuất ra dict (output thuật toán) và file JSON/CSV.
+    """
+
+    def __init__(self, thr, win, method, max_iter):
+        self.params = {"threshold": thr, "window": win, "method": method, "max_iterations": max_iter}
+        self.bands = {}
+        self.tiles = []
+        self.replaced = []
+
+    def add(self, job, stats):
+        xoff, yoff, w, h = job[2:6]
+        for st in stats:
+            b = self.bands.setdefault(st["band"], {"valid": 0, "nodata": 0, "outliers": 0, "replaced": 0,
+                                                   "zhist": [0] * (ZHIST_BINS + 1)})
+            outliers = st["replaced"][0] if st["replaced"] else 0
+            replaced = sum(st["replaced"])
+            b["valid"] += st["valid"]
+            b["nodata"] += st["nodata"]
+            b["outliers"] += outliers
+            b["replaced"] += replaced
+            merge_counts(b["zhist"], st["zhist"])
+            merge_counts(self.replaced, st["replaced"])
+            self.tiles.append({"band": st["band"], "xoff": xoff, "yoff": yoff, "width": w, "height": h,
+                               "valid": st["valid"], "nodata": st["nodata"], "outliers": outliers,
+                               "replaced": replaced, "iterations": len(st["replaced"])})
+
+    def totals(self):
+        t = {k: sum(b[k] for b in self.bands.values()) for k in ("valid", "nodata", "outliers", "replaced")}
+        t["outlier_pct"] = 100.0 * t["outliers"] / t["valid"] if t["valid"] else 0.0
+        return t
+
+    @staticmethod
+    def exceedance(zhist):
+        """Số pixel có |z| ≥ từng mốc (mốc = cạnh dưới mỗi ô histogram) -> xem ngay THRESHOLD k loại bao nhiêu."""
+        out, acc = [], 0
+        for k in range(len(zhist) - 1, -1, -1):
+            acc += zhist[k]
+            out.append((k * ZHIST_STEP, acc))
+        return out[::-1]
+
+    def report(self, feedback, tr=str):
+        """Log số pixel thay mỗi vòng, tóm tắt theo band; báo nếu chạm MAX_ITERATIONS mà chưa hội tụ."""
+        max_iter = self.params["max_iterations"]
+        for k, n in enumerate(self.replaced, start=1):
+            feedback.pushInfo(tr(f"Vòng {k}: {n} pixel bị thay thế."))
+        if max_iter > 1 and len(self.replaced) >= max_iter and self.replaced[-1] > 0:
+            feedback.pushInfo(tr(f"Đạt MAX_ITERATIONS={max_iter} nhưng vẫn còn pixel thay đổi ở vòng cuối."))
+        for band, b in sorted(self.bands.items()):
+            pct = 100.0 * b["outliers"] / b["valid"] if b["valid"] else 0.0
+            feedback.pushInfo(tr(f"Band {band}: hợp lệ {b['valid']}, NoData {b['nodata']}, "
+                                 f"outlier {b['outliers']} ({pct:.3f}%)."))
+
+    def as_dict(self):
+        return {
+            "params": self.params,
+            "totals": self.totals(),
+            "iterations": self.replaced,
+            "zhist_step": ZHIST_STEP,
+            "bands": [dict(band=band, **b, exceedance=self.exceedance(b["zhist"]))
+                      for band, b in sorted(self.bands.items())],
+            "tiles": sorted(self.tiles, key=lambda t: (t["band"], t["yoff"], t["xoff"])),
+        }
+
+    def write(self, path):
+        """.csv -> bảng theo tile (path) + histogram |z| theo band (<tên>_zhist.csv); còn lại -> JSON."""
+        import csv
+        import json
+        data = self.as_dict()
+        if not path.lower().endswith(".csv"):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            return [path]
+        cols = ["band", "xoff", "yoff", "width", "height", "valid", "nodata", "outliers", "replaced", "iterations"]
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            wr = csv.DictWriter(f, fieldnames=cols)
+            wr.writeheader()
+            wr.writerows(data["tiles"])
+        hist_path = os.path.splitext(path)[0] + "_zhist.csv"
+        with open(hist_path, "w", newline="", encoding="utf-8") as f:
+            wr = csv.writer(f)
+            wr.writerow(["band", "z_from", "z_to", "count", "count_z_ge_from"])
+            for b in data["bands"]:
+                for k, (n, (z0, ge)) in enumerate(zip(b["zhist"], b["exceedance"])):
+                    z1 = (k + 1) * ZHIST_STEP if k < ZHIST_BINS else ""
+                    wr.writerow([b["band"], z0, z1, n, ge])
+        return [path, hist_path]
+
+
+# ---------------- Worker theo tile ----------------
+def process_tile(src_path, band_index, xoff, yoff, xsize, ysize, pad, method, thr, win, nodata, mark_only,
+                 iterations=1, ds=None):
+    """
+    Đọc tile + viền pad, lọc, cắt viền. Không truyền ds -> tự mở dataset (an toàn GDAL theo luồng).
+    band_index là tuple -> đọc mọi band đó trong 1 lần ds.ReadAsArray(band_list=...), nodata là tuple
+    tương ứng, kết quả có dạng (số band, h, w).
+    Trả (xoff, yoff, out_tile, stats); stats = [{"band": b, **info của filter_array}, ...] (mỗi band 1 dict).
+    """
+    multi = isinstance(band_index, (tuple, list))
+    rxoff = max(0, xoff - pad)
+    ryoff = max(0, yoff - pad)
+
+    ds_local = ds if ds is not None else gdal.Open(src_path, gdal.GA_ReadOnly)
+    if ds_local is None:
+        raise RuntimeError("GDAL Open failed in worker")
+    try:
+        src = ds_local if multi else ds_local.GetRasterBand(band_index)
+        rxend = min(ds_local.RasterXSize, xoff + xsize + pad)
+        ryend = min(ds_local.RasterYSize, yoff + ysize + pad)
+        rxs = rxend - rxoff
+        rys = ryend - ryoff
+
+        # đọc mảng (1 lần retry nếu lỗi IO)
+        for attempt in range(2):
+            try:
+                if multi:
+                    arr = src.ReadAsArray(rxoff, ryoff, rxs, rys, band_list=list(band_index))
+                else:
+                    arr = src.ReadAsArray(rxoff, ryoff, rxs, rys)
+                if arr is None:
+                    raise RuntimeError("ReadAsArray returned None")
+                arr = arr.astype(np.float32, copy=False)
+                break
+            except Exception:
+                if attempt == 0:
+                    continue
+                raise
+
+        # vùng tile gốc trong bộ đệm (bỏ viền pad)
+        # (tính theo viền thực đọc được: ở mép raster viền có thể hẹp hơn pad)
+        top, left = yoff - ryoff, xoff - rxoff
+        core = (slice(top, top + ysize), slice(left, left + xsize))
+
+        if multi:
+            arr = arr.reshape((len(band_index), rys, rxs))
+            outs, stats = [], []
+            for k, (b, nd) in enumerate(zip(band_index, nodata)):
+                if nd is not None:
+                    arr[k][arr[k] == nd] = np.nan
+                f, info = filter_array(arr[k], method, thr, win, mark_only, iterations, core)
+                outs.append(f)
+                stats.append(dict(band=b, **info))
+            filt = np.stack(outs)
+        else:
+            if nodata is not None:
+                arr[arr == nodata] = np.nan
+            filt, info = filter_array(arr, method, thr, win, mark_only, iterations, core)
+            stats = [dict(band=band_index, **info)]
+
+        # cắt pad về kích thước tile gốc
+        out_tile = filt[(Ellipsis,) + core]
+        return (xoff, yoff, out_tile, stats)
+
+    finally:
+        ds_local = None  # đóng dataset (nếu tự mở)
+
+
+# ---------------- Đích ghi: GTiff / COG / VRT ghép tile ----------------
+def overview_levels(width, height, min_size=256):
+    """2, 4, 8… tới khi cạnh lớn nhất của overview < min_size."""
+    levels, f = [], 2
+    while max(width, height) / f >= min_size:
+        levels.append(f)
+        f *= 2
+    return levels or [2]
+
+
+class _GdalConfig:
+    """Đặt tạm config option GDAL trong khối with, trả lại giá trị cũ khi ra."""
+
+    def __init__(self, **opts):
+        self.opts = opts
+
+    def __enter__(self):
+        self.old = {k: gdal.GetConfigOption(k) for k in self.opts}
+        for k, v in self.opts.items():
+            gdal.SetConfigOption(k, v)
+        return self
+
+    def __exit__(self, *exc):
+        for k, v in self.old.items():
+            gdal.SetConfigOption(k, v)
+
+
+def _opt(opts, key, default=None):
+    for o in opts:
+        if o.upper().startswith(key + "="):
+            return o.split("=", 1)[1]
+    return default
+
+
+class TileSink:
+    """
+    Đích ghi tile cho luồng ghi (chỉ 1 luồng gọi write):
+    - OUT_GTIFF: GeoTIFF tiled, nén đa luồng (NUM_THREADS=ALL_CPUS).
+    - OUT_COG: ghi GeoTIFF tạm rồi CreateCopy sang COG (nén + overview đa luồng trong driver COG).
+    - OUT_VRT: mỗi tile 1 GeoTIFF trong thư mục <tên>_tiles, đóng ngay khi đủ band; cuối cùng BuildVRT.
+    close() dựng overview sau khi ghi (GDAL_NUM_THREADS=ALL_CPUS) và trả đường dẫn kết quả.
+    """
+
+    def __init__(self, fmt, path, width, height, n_bands, gdt, geotransform, projection, creation_opts):
+        self.fmt, self.path = fmt, path
+        self.width, self.height, self.n_bands, self.gdt = width, height, n_bands, gdt
+        self.gt, self.proj = geotransform, projection
+        self.opts = list(creation_opts) + ["NUM_THREADS=ALL_CPUS"]
+        self.nodata = {}
+        self.ds = None
+        self.tmp_path = None
+        if fmt == OUT_VRT:
+            self.tile_dir = os.path.splitext(path)[0] + "_tiles"
+            os.makedirs(self.tile_dir, exist_ok=True)
+            self.tile_files, self.open_tiles = [], {}
+        else:
+            target = path
+            if fmt == OUT_COG:
+                target = self.tmp_path = os.path.splitext(path)[0] + ".part.tif"
+            self.ds = self._create(target, width, height, geotransform)
+
+    def _create(self, path, w, h, gt):
+        ds = gdal.GetDriverByName("GTiff").Create(path, w, h, self.n_bands, self.gdt, options=self.opts)
+        if ds is None:
+            raise RuntimeError(f"Không tạo được file đầu ra: {path}")
+        ds.SetGeoTransform(gt)
+        ds.SetProjection(self.proj)
+        for bi, nd in self.nodata.items():
+            ds.GetRasterBand(bi).SetNoDataValue(nd)
+        return ds
+
+    def set_nodata(self, bi, value):
+        self.nodata[bi] = value
+        if self.ds is not None:
+            self.ds.GetRasterBand(bi).SetNoDataValue(value)
+
+    def write(self, bi, arr, xoff, yoff):
+        if self.fmt != OUT_VRT:
+            self.ds.GetRasterBand(bi).WriteArray(arr, xoff, yoff)
+            return
+        ent = self.open_tiles.get((xoff, yoff))
+        if ent is None:
+            g = self.gt
+            gt = (g[0] + xoff * g[1] + yoff * g[2], g[1], g[2], g[3] + xoff * g[4] + yoff * g[5], g[4], g[5])
+            f = os.path.join(self.tile_dir, f"tile_{yoff:07d}_{xoff:07d}.tif")
+            ent = self.open_tiles[(xoff, yoff)] = [self._create(f, arr.shape[1], arr.shape[0], gt), self.n_bands]
+            self.tile_files.append(f)
+        ent[0].GetRasterBand(bi).WriteArray(arr, 0, 0)
+        ent[1] -= 1
+        if ent[1] == 0:  # đủ band -> đóng file tile, giải phóng cache
+            ent[0].FlushCache()
+            del self.open_tiles[(xoff, yoff)]
+
+    def close(self, overviews=True, resampling="AVERAGE", feedback=None, tr=str):
+        def _progress(pct, msg, data):
+            if feedback is not None:
+                feedback.setProgress(int(100 * pct))
+                return 0 if feedback.isCanceled() else 1
+            return 1
+
+        comp = _opt(self.opts, "COMPRESS", "NONE")
+        cfg = dict(GDAL_NUM_THREADS="ALL_CPUS", COMPRESS_OVERVIEW=comp, BIGTIFF_OVERVIEW="IF_SAFER")
+        levels = overview_levels(self.width, self.height)
+
+        if self.fmt == OUT_VRT:
+            for ds, _ in self.open_tiles.values():
+                ds.FlushCache()
+            self.open_tiles = {}
+            vrt = gdal.BuildVRT(self.path, sorted(self.tile_files))
+            if vrt is None:
+                raise RuntimeError(f"Không tạo được VRT: {self.path}")
+            vrt.FlushCache()
+            vrt = None
+            if overviews:
+                if feedback is not None:
+                    feedback.pushInfo(tr(f"Dựng overview ngoài (.ovr) cho VRT, mức {levels}…"))
+                ds = gdal.Open(self.path, gdal.GA_ReadOnly)
+                with _GdalConfig(**cfg):
+                    ds.BuildOverviews(resampling, levels, _progress)
+                ds = None
+            return self.path
+
+        if self.fmt == OUT_GTIFF:
+            if overviews:
+                if feedback is not None:
+                    feedback.pushInfo(tr(f"Dựng overview trong file, mức {levels}…"))
+                with _GdalConfig(**cfg):
+                    self.ds.BuildOverviews(resampling, levels, _progress)
+            self.ds.FlushCache()
+            self.ds = None
+            return self.path
+
+        # COG: driver tự dựng overview từ dữ liệu vừa ghi, nén song song
+        self.ds.FlushCache()
+        self.ds = None
+        if feedback is not None:
+            feedback.pushInfo(tr("Chuyển sang COG (nén + overview đa luồng)…"))
+        src = gdal.Open(self.tmp_path, gdal.GA_ReadOnly)
+        bigtiff = _opt(self.opts, "BIGTIFF", "IF_SAFER")
+        cog_opts = [f"COMPRESS={'LZW' if comp == 'PACKBITS' else comp}", "NUM_THREADS=ALL_CPUS",  # COG không có PACKBITS
+                    f"BIGTIFF={'IF_SAFER' if bigtiff == 'AUTO' else bigtiff}",
+                    f"OVERVIEWS={'AUTO' if overviews else 'NONE'}", f"RESAMPLING={resampling}"]
+        out = gdal.GetDriverByName("COG").CreateCopy(self.path, src, 0, cog_opts, callback=_progress)
+        if out is None:
+            raise RuntimeError(f"Không tạo được COG: {self.path}")
+        out = src = None
+        self.discard()
+        return self.path
+
+    def discard(self):
+        """Xoá file tạm (COG) — gọi cả khi lượt chạy lỗi."""
+        self.ds = None
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            gdal.GetDriverByName("GTiff").Delete(self.tmp_path)
+
+
+# ---------------- Chạy bằng tiến trình con + shared memory ----------------
+_WORKER_DS = {}
+
+
+def _worker_init(cache_bytes=None):
+    gdal.UseExceptions()
+    if cache_bytes:
+        gdal.SetCacheMax(int(cache_bytes))
+
+
+def _worker_dataset(src_path):
+    """Mỗi tiến trình con mở dataset 1 lần và dùng lại cho mọi tile."""
+    ds = _WORKER_DS.get(src_path)
+    if ds is None:
+        ds = gdal.Open(src_path, gdal.GA_ReadOnly)
+        _WORKER_DS[src_path] = ds
+    return ds
+
+
+_THREAD_DS = threading.local()
+
+
+def process_tile_local(src_path, *args):
+    """Như process_tile nhưng mỗi luồng worker giữ 1 dataset mở sẵn -> block cache của handle dùng lại giữa các tile."""
+    cache = getattr(_THREAD_DS, "ds", None)
+    if cache is None:
+        cache = _THREAD_DS.ds = {}
+    ds = cache.get(src_path)
+    if ds is None:
+        ds = cache[src_path] = gdal.Open(src_path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise RuntimeError("GDAL Open failed in worker")
+    return process_tile(src_path, *args, ds=ds)
+
+
+def process_tile_shm(shm_name, src_path, band_index, xoff, yoff, xsize, ysize, *args):
+    """Như process_tile nhưng ghi kết quả vào block shared memory shm_name; chỉ trả metadata + stats."""
+    from multiprocessing import shared_memory
+    _, _, tile, stats = process_tile(src_path, band_index, xoff, yoff, xsize, ysize, *args,
+                              ds=_worker_dataset(src_path))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        np.ndarray(tile.shape, dtype=tile.dtype, buffer=shm.buf)[...] = tile
+    finally:
+        shm.close()
+    return xoff, yoff, tile.shape, tile.dtype.str, stats
+
+
+def python_executable():
+    """Trình thông dịch Python cho tiến trình con (trong QGIS sys.executable thường là qgis.exe)."""
+    exe = sys.executable or ""
+    if os.path.basename(exe).lower().startswith("python"):
+        return exe
+    ver = f"{sys.version_info[0]}.{sys.version_info[1]}"
+    for cand in (os.path.join(sys.exec_prefix, "pythonw.exe"),
+                 os.path.join(sys.exec_prefix, "python.exe"),
+                 os.path.join(sys.exec_prefix, "bin", f"python{ver}"),
+                 os.path.join(sys.exec_prefix, "bin", "python3")):
+        if os.path.isfile(cand):
+            return cand
+    return None
+
+
+def process_pool_available():
+    """(True, "") nếu chạy được ProcessPool + shared memory; ngược lại (False, lý do)."""
+    try:
+        from multiprocessing import shared_memory  # noqa: F401  (Python >= 3.8)
+    except ImportError:
+        return False, "Python < 3.8 (không có multiprocessing.shared_memory)"
+    if python_executable() is None:
+        return False, "không tìm thấy trình thông dịch Python cho tiến trình con"
+    return True, ""
+
+
+def resolve_executor(mode, n_jobs, workers, method):
+    """Auto: dùng processes khi có đủ việc (median giữ GIL nặng hơn) và môi trường cho phép."""
+    if mode == EXEC_THREADS or workers < 2:
+        return EXEC_THREADS
+    ok, _ = process_pool_available()
+    if mode == EXEC_PROCESSES:
+        return EXEC_PROCESSES if ok else EXEC_THREADS
+    if ok and n_jobs >= 2 * workers and (method == 1 or n_jobs >= 4 * workers):
+        return EXEC_PROCESSES
+    return EXEC_THREADS
+
+
+def stream_tiles(jobs, executor, workers, slot_bytes, write_fn, max_tiles=0, feedback=None, progress=None,
+                 cache_bytes=None):
+    """
+    Chạy process_tile cho danh sách jobs (tuple tham số) và ghi ngay từng tile xong (write-behind):
+    - Kết quả vào hàng đợi, 1 luồng ghi duy nhất gọi write_fn(job, out_tile, stats) (GDAL dataset đích chỉ
+      bị 1 luồng chạm tới).
+    - Backpressure: max_tiles "vé" (0 -> 2×workers); lấy vé trước khi submit, trả vé sau khi ghi xong
+      -> tổng số tile đang tính + chờ ghi + đang ghi không bao giờ vượt max_tiles.
+    - EXEC_PROCESSES: mỗi vé là 1 block shared memory (slot_bytes); tiến trình con ghi kết quả vào đó,
+      luồng ghi đọc thẳng từ block (không pickle, không copy) rồi mới trả block.
+    - Mỗi worker (luồng hoặc tiến trình) giữ dataset nguồn mở suốt lượt chạy; jobs nên xếp sẵn theo thứ tự
+      không gian (tile_grid) để tile kề nhau dùng chung block cache. cache_bytes: GDAL_CACHEMAX cho lượt chạy.
+    progress(n_done) được gọi ở luồng gọi hàm. Trả số tile đã ghi; lỗi worker/ghi được raise lại.
+    """
+    import queue
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    n_tickets = max(1, int(max_tiles) or 2 * workers)
+    free = queue.Queue()
+    for t in range(n_tickets):
+        free.put(t)
+    todo = queue.Queue()
+    errors = []
+    state = {"done": 0}
+
+    slots = []
+    if executor == EXEC_PROCESSES:
+        import multiprocessing
+        from multiprocessing import shared_memory
+        ctx = multiprocessing.get_context("spawn")
+        ctx.set_executable(python_executable())
+        slots = [shared_memory.SharedMemory(create=True, size=max(1, slot_bytes)) for _ in range(n_tickets)]
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                   initializer=_worker_init, initargs=(cache_bytes,))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    old_cache = gdal.GetCacheMax()
+    if cache_bytes and executor != EXEC_PROCESSES:
+        gdal.SetCacheMax(int(cache_bytes))
+
+    def _writer():
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            ticket, job, tile, stats = item
+            try:
+                if not errors:
+                    write_fn(job, tile, stats)
+                    state["done"] += 1
+            except BaseException as e:  # noqa: B036 - chuyển lỗi về luồng gọi
+                errors.append(e)
+            finally:
+                item = tile = None  # bỏ view vào shared memory trước khi trả vé
+                free.put(ticket)
+
+    def _on_done(ticket, job, fut):
+        if fut.cancelled():
+            free.put(ticket)
+            return
+        exc = fut.exception()
+        if exc is not None:
+            errors.append(exc)
+            free.put(ticket)
+            return
+        res = fut.result()
+        if slots:
+            _, _, shape, dt, stats = res
+            tile = np.ndarray(shape, dtype=np.dtype(dt), buffer=slots[ticket].buf)
+        else:
+            _, _, tile, stats = res
+        todo.put((ticket, job, tile, stats))
+
+    def _stopped():
+        return bool(errors) or (feedback is not None and feedback.isCanceled())
+
+    def _report():
+        if progress is not None:
+            progress(state["done"])
+
+    writer = threading.Thread(target=_writer, name="outlier-tile-writer", daemon=True)
+    writer.start()
+    futs = []
+    try:
+        for job in jobs:
+            ticket = None
+            while ticket is None and not _stopped():
+                try:
+                    ticket = free.get(timeout=0.2)
+                except queue.Empty:
+                    _report()
+            if ticket is None:
+                break
+            if slots:
+                fut = pool.submit(process_tile_shm, slots[ticket].name, *job)
+            else:
+                fut = pool.submit(process_tile_local, *job)
+            fut.add_done_callback(lambda f, t=ticket, j=job: _on_done(t, j, f))
+            futs.append(fut)
+            futs = [f for f in futs if not f.done()]
+            _report()
+        if _stopped():
+            for f in futs:
+                f.cancel()
+    finally:
+        pool.shutdown(wait=True)
+        gdal.SetCacheMax(old_cache)
+        todo.put(None)
+        while writer.is_alive():
+            writer.join(timeout=0.2)
+            _report()
+        _report()
+        for shm in slots:
+            shm.close()
+            shm.unlink()
+    if errors:
+        raise errors[0]
+    return state["done"]
+
+
+# ---------------- Cả lượt lọc (dùng chung cho thuật toán đa band / đơn band) ----------------
+def run_filter(ds, src_path, band_indices, out_path, method, method_name, thr, win, max_iter, mark_only,
+               use_nodata, out_gdt, tile_size, tile_mode, comp, bigtiff, out_fmt, format_name, build_ovr,
+               exec_mode, max_tiles, read_mode=0, report_path=None, feedback=None, tr=str):
+    """
+    Lọc các band band_indices của ds (mở từ src_path) và ghi ra out_path: tạo TileSink, chọn executor,
+    chia tile theo block nguồn, stream_tiles, ép kiểu / NoData khi ghi, dựng overview, log và ghi báo cáo.
+    out_gdt = None -> giữ kiểu của band đầu tiên (MARK_ONLY luôn Byte); read_mode như READ_MODE của thuật toán.
+    Lỗi tạo file đầu ra -> RuntimeError. Trả (out_path thực tế, totals của RunStats, đã ghi báo cáo hay chưa).
+    """
+    # mỗi vòng lan ảnh hưởng thêm win//2 px -> viền đọc thêm đủ cho mọi vòng
+    pad = (win // 2) * max_iter
+
+    # Auto workers = CPU - 1
+    import multiprocessing
+    workers = max(1, multiprocessing.cpu_count() - 1)
+
+    # Chọn kiểu dữ liệu đầu ra
+    if mark_only:
+        out_gdt = gdal.GDT_Byte
+    elif out_gdt is None:  # giữ kiểu band vào (theo band đầu tiên được xử lý)
+        out_gdt = ds.GetRasterBand(band_indices[0]).DataType
+    out_min, out_max, out_is_int = dtype_range(out_gdt)
+
+    # lưới tile: Auto -> bội số block nội bộ của file nguồn (tránh giải nén 1 block nhiều lần)
+    width, height = ds.RasterXSize, ds.RasterYSize
+    src_band = ds.GetRasterBand(band_indices[0])
+    block_x, block_y = src_band.GetBlockSize()
+    if tile_mode == TILE_AUTO:
+        tile_w, tile_h = block_aligned_tile_size(width, height, block_x, block_y, tile_size,
+                                                 pad if max_iter > 1 else 0)
+    else:
+        tile_w = tile_h = tile_size
+    tiles = tile_grid(width, height, tile_w, tile_h)
+    feedback.pushInfo(tr(f"Block nguồn {block_x}×{block_y} → tile {tile_w}×{tile_h} ({len(tiles)} tile)."))
+
+    creation_opts = ["TILED=YES", f"BIGTIFF={bigtiff}"]
+    if comp != "NONE":
+        creation_opts.append("COMPRESS=" + comp)
+    if tile_mode == TILE_AUTO and block_x < width and block_x % 16 == 0 and block_y % 16 == 0:
+        # block đầu ra trùng block nguồn -> tile ghi ra cũng phủ trọn block
+        creation_opts += [f"BLOCKXSIZE={block_x}", f"BLOCKYSIZE={block_y}"]
+
+    if out_fmt == OUT_VRT and not out_path.lower().endswith(".vrt"):
+        out_path = os.path.splitext(out_path)[0] + ".vrt"
+    try:
+        sink = TileSink(out_fmt, out_path, width, height, len(band_indices), out_gdt,
+                        ds.GetGeoTransform(), ds.GetProjection(), creation_opts)
+    except RuntimeError:
+        raise RuntimeError("Không tạo được file đầu ra")
+    feedback.pushInfo(tr(f"Đầu ra: {format_name} → {out_path}"))
+
+    # INTERLEAVE=PIXEL: 1 block chứa mọi band -> đọc mọi band của tile trong 1 lần
+    nb = ds.RasterCount
+    pixel_il = (ds.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE") or "").upper() == "PIXEL" and nb > 1
+    multi = len(band_indices) > 1 and (read_mode == 2 or (read_mode == 0 and pixel_il))
+    job_bands = len(band_indices) if multi else 1
+    if len(band_indices) > 1:
+        feedback.pushInfo(tr(f"Đọc band: {'mọi band của tile trong 1 lần' if multi else 'từng band'}"
+                             f"{' (INTERLEAVE=PIXEL)' if pixel_il else ''}."))
+
+    total_jobs = len(tiles) * (len(band_indices) // job_bands)
+
+    executor = resolve_executor(exec_mode, total_jobs, workers, method)
+    if exec_mode == EXEC_PROCESSES and executor != EXEC_PROCESSES:
+        feedback.pushInfo(tr(f"Không chạy được đa tiến trình ({process_pool_available()[1]}) → dùng đa luồng."))
+    feedback.pushInfo(tr(f"Chế độ song song: {'processes' if executor == EXEC_PROCESSES else 'threads'}, "
+                         f"{workers} worker."))
+    slot_bytes = job_bands * tile_w * tile_h * 4  # tile float32 lớn nhất (sau khi cắt pad)
+    max_tiles = max_tiles or 2 * workers
+    work_mb = max_tiles * (tile_w + 2 * pad) * (tile_h + 2 * pad) * job_bands * 4 * 8 / 1048576.0  # ~8 mảng tạm float32/tile
+    feedback.pushInfo(tr(f"Ghi nối tiếp (write-behind): tối đa {max_tiles} tile trong bộ nhớ (~{work_mb:.0f} MB)."))
+
+    band_cfg = {}  # bidx -> (band đầu ra, nodata_write)
+    band_nodata = {}
+    for bi, bidx in enumerate(band_indices, start=1):
+        nodata = ds.GetRasterBand(bidx).GetNoDataValue() if use_nodata else None
+        if nodata is not None and not mark_only:
+            # nếu nodata vượt range integer đích, ép về min
+            if out_is_int and (nodata < out_min or nodata > out_max):
+                nodata_write = out_min
+            else:
+                nodata_write = nodata
+            sink.set_nodata(bi, nodata_write)
+        else:
+            nodata_write = None
+        band_cfg[bidx] = (bi, nodata_write)
+        band_nodata[bidx] = nodata
+
+    if multi:
+        all_nodata = tuple(band_nodata[b] for b in band_indices)
+        jobs = [(src_path, tuple(band_indices), x, y, w, h, pad, method, thr, win, all_nodata, mark_only,
+                 max_iter)
+                for (x, y, w, h) in tiles]
+    else:
+        # band của cùng tile liền nhau: dùng chung block vừa giải nén / VRT đóng file tile sớm
+        if pixel_il or out_fmt == OUT_VRT:
+            order = [(t, b) for t in tiles for b in band_indices]
+        else:
+            order = [(t, b) for b in band_indices for t in tiles]
+        jobs = [(src_path, b, x, y, w, h, pad, method, thr, win, band_nodata[b], mark_only, max_iter)
+                for (x, y, w, h), b in order]
+
+    itemsize = gdal.GetDataTypeSize(src_band.DataType) // 8
+    cache_bytes = gdal_cache_bytes(1 if executor == EXEC_PROCESSES else workers,
+                                   tile_w, tile_h, block_x, block_y, pad, itemsize,
+                                   nb if pixel_il else job_bands)
+    feedback.pushInfo(tr(f"GDAL_CACHEMAX cho lượt chạy: {cache_bytes / 1048576.0:.0f} MB/tiến trình."))
+
+    def write_band(bidx, out_tile, xoff, yoff):
+        # chạy trên luồng ghi duy nhất; ép kiểu theo lựa chọn
+        out_bi, nodata_write = band_cfg[bidx]
+        if mark_only:
+            # 0/1
+            out_arr = np.where(np.isfinite(out_tile), out_tile, 0).astype(np.uint8, copy=False)
+        else:
+            out_arr = out_tile
+            if nodata_write is not None:
+                out_arr = np.where(np.isfinite(out_arr), out_arr, nodata_write)
+            if out_is_int:
+                out_arr = np.rint(out_arr)  # làm tròn
+                out_arr = np.clip(out_arr, out_min, out_max)
+                out_arr = out_arr.astype(_NP_INT.get(out_gdt, np.int32), copy=False)
+            elif out_gdt == gdal.GDT_Float32:
+                out_arr = out_arr.astype(np.float32, copy=False)
+            else:
+                out_arr = out_arr.astype(np.float64, copy=False)
+        sink.write(out_bi, out_arr, xoff, yoff)
+
+    run_stats = RunStats(thr, win, method_name, max_iter)  # chỉ luồng ghi cập nhật
+
+    def write_tile(job, out_tile, stats):
+        run_stats.add(job, stats)
+        if multi:
+            for k, bidx in enumerate(job[1]):
+                write_band(bidx, out_tile[k], job[2], job[3])
+        else:
+            write_band(job[1], out_tile, job[2], job[3])
+
+    try:
+        done_jobs = stream_tiles(
+            jobs, executor, workers, slot_bytes, write_tile, max_tiles, feedback,
+            progress=lambda n: feedback.setProgress(int(100.0 * n / max(1, total_jobs))),
+            cache_bytes=cache_bytes
+        )
+    except Exception:
+        sink.discard()
+        raise
+    if feedback.isCanceled():
+        feedback.pushInfo(tr(f"Đã huỷ sau {done_jobs}/{total_jobs} tile."))
+    out_path = sink.close(build_ovr and not feedback.isCanceled(),
+                          "NEAREST" if mark_only else "AVERAGE", feedback, tr)
+    run_stats.report(feedback, tr)
+    reported = False
+    if report_path:
+        try:
+            files = run_stats.write(report_path)
+            feedback.pushInfo(tr(f"Đã ghi báo cáo outlier: {', '.join(files)}"))
+            reported = True
+        except OSError as e:
+            feedback.reportError(tr(f"Không ghi được báo cáo outlier ({e})."))
+    return out_path, run_stats.totals(), reported
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+QgsFeatureRequest cho các nhánh chỉ đọc/ghi thuộc tính (thống kê, gán mã, cập nhật in-place):
+- NoGeometry: provider không phải đọc / giải mã hình học.
+- Chỉ lấy các cột cần + cột mà biểu thức lọc tham chiếu; biểu thức cần hình học ($area,
+  intersects...) thì vẫn đọc hình học.
+Đối tượng trả về vẫn giữ đủ số cột (cột không lấy = NULL) -> f[idx] / f.id() dùng như cũ.
+
+Đẩy điều kiện lọc xuống nguồn dữ liệu (provider_filtered_layer): biểu thức đơn giản trên trường gốc
+(so sánh, IN, IS NULL, AND/OR/NOT) dịch thành mệnh đề WHERE cho OGR (GPKG, shapefile...), PostGIS,
+SpatiaLite rồi đặt làm subset string trên bản sao lớp -> chỉ dòng thoả điều kiện tới Python.
+Phần không dịch được vẫn đánh giá bằng QgsExpression như trước.
+
+Đọc song song theo phân đoạn FID (parallel_scan): mỗi luồng 1 bản sao lớp riêng, trả kết quả từng phân đoạn
+để bên gọi gộp (tổng hợp song song).
+"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (
+    QgsExpression, QgsExpressionNode, QgsExpressionNodeBinaryOperator,
+    QgsExpressionNodeUnaryOperator, QgsFeatureRequest, QgsFields,
+    QgsProcessingException, QgsProcessingFeatureSourceDefinition, QgsVectorLayer
+)
+
+_SQL_PROVIDERS = ("ogr", "postgres", "spatialite")
+_INT_TYPES = (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong)
+_NUMERIC_TYPES = _INT_TYPES + (QVariant.Double,)
+_CMP_SQL = {
+    QgsExpressionNodeBinaryOperator.boEQ: "=",
+    QgsExpressionNodeBinaryOperator.boNE: "<>",
+    QgsExpressionNodeBinaryOperator.boLT: "<",
+    QgsExpressionNodeBinaryOperator.boLE: "<=",
+    QgsExpressionNodeBinaryOperator.boGT: ">",
+    QgsExpressionNodeBinaryOperator.boGE: ">=",
+}
+_CMP_FLIP = {"=": "=", "<>": "<>", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+
+def attribute_request(fields, names=(), filter_expr=""):
+    """Request NoGeometry + tập cột tối thiểu; names là tên trường, filter_expr rỗng = không lọc."""
+    request = QgsFeatureRequest()
+    need = list(dict.fromkeys(names))
+    need_geom = False
+    if filter_expr:
+        expr = QgsExpression(filter_expr)
+        if expr.hasParserError():
+            raise QgsProcessingException(f"Biểu thức lọc lỗi: {expr.parserErrorString()}")
+        request.setFilterExpression(filter_expr)
+        refs = expr.referencedColumns()
+        if QgsFeatureRequest.ALL_ATTRIBUTES in refs:
+            need = None
+        else:
+            need += [n for n in refs if n not in need]
+        need_geom = expr.needsGeometry()
+    if need is not None:
+        request.setSubsetOfAttributes(need, fields)
+    if not need_geom:
+        request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+    return request
+
+
+def clonable_layer(layer, source_param=None):
+    """
+    layer nếu đọc qua bản sao (clone) cho cùng dữ liệu như nguồn Processing: provider file/CSDL,
+    không có sửa đổi chưa lưu, không chỉ đối tượng đang chọn; không thì None.
+    """
+    if not isinstance(layer, QgsVectorLayer) or not layer.isValid():
+        return None
+    if isinstance(source_param, QgsProcessingFeatureSourceDefinition) and source_param.selectedFeaturesOnly:
+        return None
+    if layer.providerType() not in _SQL_PROVIDERS or layer.isModified():
+        return None
+    return layer
+
+
+# ---------------- Đẩy điều kiện lọc xuống provider ----------------
+def _sql_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, QVariant) and value.isNull())
+
+
+def _sql_literal(value, numeric):
+    """Hằng số SQL nếu cùng loại với trường (số với trường số, chuỗi với trường chuỗi); không thì None."""
+    if numeric:
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+            return repr(value)
+        return None
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    return None
+
+
+def _column(node, fields):
+    """(tên cột SQL, là trường số) nếu node là cột gốc của provider; không thì None."""
+    if node.nodeType() != QgsExpressionNode.ntColumnRef:
+        return None
+    idx = fields.lookupField(node.name())
+    if idx < 0 or fields.fieldOrigin(idx) != QgsFields.OriginProvider:
+        return None
+    fdef = fields.at(idx)
+    if fdef.type() in _NUMERIC_TYPES:
+        return _sql_ident(fdef.name()), True
+    if fdef.type() == QVariant.String:
+        return _sql_ident(fdef.name()), False
+    return None
+
+
+def _compile_node(node, fields):
+    """Node biểu thức -> mệnh đề SQL cùng ngữ nghĩa (NULL -> không thoả), hoặc None nếu không dịch được."""
+    ntype = node.nodeType()
+    if ntype == QgsExpressionNode.ntBinaryOperator:
+        op = node.op()
+        if op in (QgsExpressionNodeBinaryOperator.boAnd, QgsExpressionNodeBinaryOperator.boOr):
+            left = _compile_node(node.opLeft(), fields)
+            right = _compile_node(node.opRight(), fields)
+            if left is None or right is None:
+                return None
+            word = "AND" if op == QgsExpressionNodeBinaryOperator.boAnd else "OR"
+            return f"({left} {word} {right})"
+        if op in (QgsExpressionNodeBinaryOperator.boIs, QgsExpressionNodeBinaryOperator.boIsNot):
+            col = _column(node.opLeft(), fields)
+            rhs = node.opRight()
+            if col is None or rhs.nodeType() != QgsExpressionNode.ntLiteral or not _is_null(rhs.value()):
+                return None
+            return f"({col[0]} IS {'NOT ' if op == QgsExpressionNodeBinaryOperator.boIsNot else ''}NULL)"
+        sql_op = _CMP_SQL.get(op)
+        if sql_op is None:
+            return None
+        left, right = node.opLeft(), node.opRight()
+        col = _column(left, fields)
+        lit = right
+        if col is None:
+            col, lit, sql_op = _column(right, fields), left, _CMP_FLIP[sql_op]
+        if col is None or lit.nodeType() != QgsExpressionNode.ntLiteral:
+            return None
+        # chuỗi: chỉ so sánh bằng/khác (thứ tự sắp xếp chuỗi mỗi backend một kiểu)
+        if not col[1] and sql_op not in ("=", "<>"):
+            return None
+        val = _sql_literal(lit.value(), col[1])
+        return None if val is None else f"({col[0]} {sql_op} {val})"
+    if ntype == QgsExpressionNode.ntInOperator:
+        col = _column(node.node(), fields)
+        items = node.list().list()
+        if col is None or not items:
+            return None
+        vals = []
+        for item in items:
+            if item.nodeType() != QgsExpressionNode.ntLiteral:
+                return None
+            val = _sql_literal(item.value(), col[1])
+            if val is None:
+                return None
+            vals.append(val)
+        return f"({col[0]} {'NOT IN' if node.isNotIn() else 'IN'} ({', '.join(vals)}))"
+    if ntype == QgsExpressionNode.ntUnaryOperator and node.op() == QgsExpressionNodeUnaryOperator.uoNot:
+        inner = _compile_node(node.operand(), fields)
+        return None if inner is None else f"(NOT {inner})"
+    return None
+
+
+def compile_sql_filter(filter_expr, fields):
+    """
+    Tách biểu thức lọc QGIS thành (sql, residual):
+    - sql: WHERE cho provider (None nếu không phần nào dịch được).
+    - residual: phần còn phải đánh giá trong Python ("" nếu toàn bộ đã dịch).
+    AND ở gốc được tách từng vế: vế dịch được đẩy xuống, vế còn lại giữ làm residual.
+    """
+    expr = QgsExpression(filter_expr)
+    if not filter_expr or expr.hasParserError() or expr.rootNode() is None:
+        return None, filter_expr
+    conjuncts, stack = [], [expr.rootNode()]
+    while stack:
+        node = stack.pop()
+        if (node.nodeType() == QgsExpressionNode.ntBinaryOperator
+                and node.op() == QgsExpressionNodeBinaryOperator.boAnd):
+            stack += [node.opRight(), node.opLeft()]
+        else:
+            conjuncts.append(node)
+    pushed, rest = [], []
+    for node in conjuncts:
+        sql = _compile_node(node, fields)
+        if sql is None:
+            rest.append(node.dump())
+        else:
+            pushed.append(sql)
+    if not pushed:
+        return None, filter_expr
+    return " AND ".join(pushed), " AND ".join(f"({r})" for r in rest)
+
+
+def provider_filtered_layer(layer, filter_expr, source_param=None, feedback=None):
+    """
+    (lớp, residual): bản sao layer đã gắn subset string = phần điều kiện dịch được và phần biểu thức
+    còn phải lọc trong Python. Không đẩy được (provider khác, lớp đang có sửa đổi chưa lưu,
+    chỉ đối tượng chọn, subset bị từ chối) -> (None, filter_expr).
+    """
+    if not filter_expr or clonable_layer(layer, source_param) is None:
+        return None, filter_expr
+    sql, residual = compile_sql_filter(filter_expr, layer.fields())
+    if sql is None:
+        return None, filter_expr
+    old = layer.subsetString()
+    clone = layer.clone()
+    if clone is None or not clone.setSubsetString(f"({old}) AND {sql}" if old else sql):
+        if feedback:
+            feedback.pushInfo(f"Provider không nhận điều kiện '{sql}' — lọc trong Python.")
+        return None, filter_expr
+    if feedback:
+        feedback.pushInfo(f"Điều kiện lọc đẩy xuống provider: {sql}"
+                          + (f" | còn lọc trong Python: {residual}" if residual else ""))
+    return clone, residual
+
+
+# ---------------- Đọc song song theo phân đoạn FID ----------------
+def auto_workers(workers):
+    """0 = tự động (số CPU - 1)."""
+    return workers if workers > 0 else max(1, (os.cpu_count() or 2) - 1)
+
+
+def _fid_bounds(layer):
+    """
+    (FID nhỏ nhất, FID lớn nhất, tên cột khoá hoặc None); None nếu lớp rỗng.
+    Khoá chính số nguyên 1 cột (GPKG, PostGIS, SpatiaLite...) -> MIN/MAX do provider tính (dùng chỉ mục),
+    không thì lấy từ allFeatureIds() (chỉ FID, không đọc thuộc tính/hình học).
+    """
+    pk = layer.dataProvider().pkAttributeIndexes()
+    if len(pk) == 1 and layer.fields()[pk[0]].type() in _INT_TYPES:
+        lo, hi = layer.minimumValue(pk[0]), layer.maximumValue(pk[0])
+        if _is_null(lo) or _is_null(hi):
+            return None
+        return int(lo), int(hi), layer.fields()[pk[0]].name()
+    ids = layer.allFeatureIds()
+    if not ids:
+        return None
+    return min(ids), max(ids), None
+
+
+def _fid_range_clone(layer, pk_name, lo, hi):
+    """
+    Bản sao layer chỉ đọc FID trong [lo, hi): subset string trên cột khoá (OGR không có cột khoá: trường
+    đặc biệt FID) nếu provider nhận; không thì (bản sao, biểu thức $id cho request).
+    """
+    clone = layer.clone()
+    if pk_name or layer.providerType() == "ogr":
+        col = _sql_ident(pk_name) if pk_name else "FID"
+        sql = f"{col} >= {lo} AND {col} < {hi}"
+        old = layer.subsetString()
+        if clone.setSubsetString(f"({old}) AND {sql}" if old else sql):
+            return clone, ""
+    return clone, f"$id >= {lo} AND $id < {hi}"
+
+
+def parallel_scan(layer, names, filter_expr, workers, scan_fn, feedback=None):
+    """
+    Chia khoảng FID [min, max] của lớp (không duyệt đối tượng) thành `workers` đoạn liền nhau; mỗi luồng đọc
+    1 đoạn trên bản sao QgsVectorLayer riêng (điều kiện FID đẩy xuống provider) và tự đánh giá filter_expr.
+    scan_fn(features) chạy trong luồng; trả list kết quả theo thứ tự FID tăng dần của các đoạn.
+    Trong 1 đoạn, thứ tự đối tượng do provider quyết định -> bên gọi tự sắp nhóm theo FID nhỏ nhất.
+    """
+    bounds = _fid_bounds(layer)
+    if bounds is None:
+        return []
+    lo, hi, pk_name = bounds
+    span = hi - lo + 1
+    n = max(1, min(workers, span))
+    cuts = [lo + span * k // n for k in range(n + 1)]
+    parts = [_fid_range_clone(layer, pk_name, a, b) for a, b in zip(cuts[:-1], cuts[1:])]
+    if feedback:
+        feedback.pushInfo(f"Đọc song song: FID {lo}–{hi}, {n} phân đoạn"
+                          + (" (điều kiện FID lọc trong Python)" if parts[0][1] else "") + ".")
+
+    def _run(clone, fid_expr):
+        expr = " AND ".join(f"({e})" for e in (fid_expr, filter_expr) if e)
+        return scan_fn(clone.getFeatures(attribute_request(clone.fields(), names, expr)))
+
+    results = [None] * n
+    with ThreadPoolExecutor(max_workers=n) as ex:
+        futures = {ex.submit(_run, clone, fid_expr): k for k, (clone, fid_expr) in enumerate(parts)}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            results[futures[fut]] = fut.result()
+            if feedback:
+                feedback.setProgress(int(90.0 * done / n))
+    return results
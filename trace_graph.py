@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Đồ thị biên cho tracing trong công cụ vẽ chia tách (DrawLineTool):
+- Đỉnh = toạ độ các polyline (CRS của map) gộp theo làm tròn 8 chữ số thập phân (như khoá dict cũ),
+  lưu thành mảng NumPy (n, 2); cạnh = hai đỉnh liên tiếp, trọng số = độ dài Euclid.
+- Kề dạng CSR (indptr / indices / weights) -> bộ nhớ gọn, dựng bằng vector hoá thay cho dict-of-list.
+- Mỗi cạnh CSR nhớ fid đối tượng sinh ra nó (owner) -> sửa đồ thị theo đối tượng (update):
+  cạnh cũ chỉ bị đánh dấu bỏ, cạnh mới vào lớp phủ (overlay); khi phần sửa vượt COMPACT_RATIO
+  số cạnh CSR thì gộp một lần (dựng lại CSR từ các phần NumPy đã lưu).
+- Đỉnh gần nhất: KD-tree (scipy.spatial.cKDTree) trên đỉnh CSR + duyệt NumPy các đỉnh overlay.
+- Tìm đường: A* với heuristic Euclid (chấp nhận được vì trọng số chính là độ dài Euclid),
+  tuỳ chọn A* hai chiều với thế trung bình (p = (h_t - h_s) / 2) -> cùng độ dài đường như Dijkstra.
+Không import QGIS -> kiểm thử được ngoài QGIS.
+"""
+import heapq
+import math
+
+import numpy as np
+
+_ROUND = 8
+# toạ độ đã làm tròn 8 chữ số -> 2 đỉnh khác nhau cách nhau ≥ 1e-8; dưới ngưỡng này là cùng đỉnh
+_MATCH_EPS = 0.5 * 10.0 ** -_ROUND
+
+
+class TraceGraph:
+    # overlay (cạnh thêm + cạnh bị bỏ) vượt tỉ lệ này của số cạnh CSR -> gộp lại
+    COMPACT_RATIO = 0.25
+
+    def __init__(self, xy, indptr, indices, weights, owner=None, parts=None):
+        self.xy = xy
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.owner = owner if owner is not None else np.full(len(indices), -1, dtype=np.int64)
+        self.parts = parts if parts is not None else {}  # {fid: [mảng (k, 2)]}
+        self._n_base = len(xy)
+        self._alive = None        # bool theo cạnh CSR; None = còn đủ
+        self._live_deg = None     # số cạnh còn sống theo đỉnh; None = chưa sửa lần nào
+        self._extra = {}          # overlay: {đỉnh: [(đỉnh kề, trọng số)]}
+        self._extra_fids = {}     # {fid: [(u, v, w)]} cạnh overlay của từng đối tượng
+        self._new_nodes = {}      # {(x, y): đỉnh} các đỉnh thêm sau khi dựng
+        self._n_extra = 0
+        self._n_dead = 0
+        self._tree = None
+        self._lists = None
+
+    @classmethod
+    def from_polylines(cls, polylines):
+        """polylines: các mảng (k, 2) toạ độ liên tiếp (mỗi phần của đường là 1 mảng)."""
+        return cls.from_parts({i: [p] for i, p in enumerate(polylines)})
+
+    @classmethod
+    def from_parts(cls, parts):
+        """parts: {fid: [mảng (k, 2)]} — các phần của từng đối tượng line."""
+        parts = {fid: [p for p in (_as_xy(p) for p in pls) if len(p) >= 2] for fid, pls in parts.items()}
+        flat = [(fid, p) for fid, pls in parts.items() for p in pls]
+        if not flat:
+            return cls(np.empty((0, 2)), np.zeros(1, dtype=np.int64),
+                       np.empty(0, dtype=np.int64), np.empty(0), parts=parts)
+        pts = np.concatenate([p for _fid, p in flat])
+        xy, node = _unique_points(pts)
+
+        # cạnh giữa 2 điểm liên tiếp trong cùng 1 phần (bỏ điểm nối giữa các phần)
+        lens = np.fromiter((len(p) for _fid, p in flat), dtype=np.int64, count=len(flat))
+        fids = np.fromiter((fid for fid, _p in flat), dtype=np.int64, count=len(flat))
+        starts = np.cumsum(lens) - lens
+        keep = np.ones(len(pts) - 1, dtype=bool)
+        keep[(starts[1:] - 1)] = False
+        src = node[:-1][keep]
+        dst = node[1:][keep]
+        own = np.repeat(fids, lens)[:-1][keep]
+        loop = src != dst
+        src, dst, own = src[loop], dst[loop], own[loop]
+        w = np.hypot(*(xy[dst] - xy[src]).T)
+
+        # vô hướng -> mỗi cạnh 2 chiều, sắp theo đỉnh nguồn
+        a = np.concatenate([src, dst])
+        b = np.concatenate([dst, src])
+        ww = np.concatenate([w, w])
+        oo = np.concatenate([own, own])
+        order = np.argsort(a, kind="stable")
+        indptr = np.zeros(len(xy) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(a, minlength=len(xy)), out=indptr[1:])
+        return cls(xy, indptr, b[order], ww[order], oo[order], parts)
+
+    @property
+    def n_nodes(self):
+        return len(self.xy)
+
+    # ---- sửa theo đối tượng ----
+    def update(self, removed=(), added=None):
+        """
+        Bỏ các fid trong removed, thêm/thay các đối tượng trong added ({fid: [mảng (k, 2)]}).
+        Không dựng lại CSR: cạnh cũ bị đánh dấu bỏ, cạnh mới vào overlay; gộp khi overlay quá lớn.
+        """
+        added = {fid: [p for p in (_as_xy(p) for p in pls) if len(p) >= 2] for fid, pls in (added or {}).items()}
+        gone = (set(removed) | set(added)) & set(self.parts)
+        for fid in gone:
+            del self.parts[fid]
+        self.parts.update(added)
+
+        n_new = sum(len(p) - 1 for pls in added.values() for p in pls)
+        limit = self.COMPACT_RATIO * max(len(self.indices), 64)
+        if self._n_extra + self._n_dead + 2 * n_new > limit:
+            self._compact()
+            return
+
+        if self._live_deg is None:
+            self._live_deg = np.diff(self.indptr)
+        if gone:
+            self._drop_base(gone)
+            for fid in gone:
+                self._drop_extra(fid)
+        for fid, pls in added.items():
+            for p in pls:
+                self._add_extra(fid, p)
+
+    def _compact(self):
+        self.__dict__.update(TraceGraph.from_parts(self.parts).__dict__)
+
+    def _drop_base(self, fids):
+        kill = np.isin(self.owner, np.fromiter(fids, dtype=np.int64, count=len(fids)))
+        if self._alive is not None:
+            kill &= self._alive
+        hit = np.flatnonzero(kill)
+        if not len(hit):
+            return
+        if self._alive is None:
+            self._alive = np.ones(len(self.indices), dtype=bool)
+        self._alive[hit] = False
+        self._n_dead += len(hit)
+        src = np.searchsorted(self.indptr, hit, side="right") - 1
+        np.subtract.at(self._live_deg, src, 1)
+        if self._lists is not None:
+            if self._lists[3] is None:
+                self._lists = self._lists[:3] + ([True] * len(self.indices),) + self._lists[4:]
+            alive = self._lists[3]
+            for k in hit.tolist():
+                alive[k] = False
+
+    def _drop_extra(self, fid):
+        for u, v, w in self._extra_fids.pop(fid, ()):
+            self._extra[u].remove((v, w))
+            self._extra[v].remove((u, w))
+            self._live_deg[u] -= 1
+            self._live_deg[v] -= 1
+            self._n_extra -= 2
+
+    def _add_extra(self, fid, p):
+        ids = self._node_ids(p)
+        u, v = ids[:-1], ids[1:]
+        m = u != v
+        u, v = u[m], v[m]
+        w = np.hypot(*(self.xy[v] - self.xy[u]).T)
+        np.add.at(self._live_deg, u, 1)
+        np.add.at(self._live_deg, v, 1)
+        edges = self._extra_fids.setdefault(fid, [])
+        for a, b, ww in zip(u.tolist(), v.tolist(), w.tolist()):
+            self._extra.setdefault(a, []).append((b, ww))
+            self._extra.setdefault(b, []).append((a, ww))
+            edges.append((a, b, ww))
+        self._n_extra += 2 * len(u)
+
+    def _node_ids(self, p):
+        """Chỉ số đỉnh của các điểm p; điểm chưa có -> thêm đỉnh mới (cuối mảng xy)."""
+        ids = np.full(len(p), -1, dtype=np.int64)
+        if self._n_base:
+            d, i = self._base_tree().query(p, distance_upper_bound=_MATCH_EPS)
+            hit = np.flatnonzero(np.isfinite(d))
+            same = np.all(self.xy[i[hit]] == p[hit], axis=1)
+            ids[hit[same]] = i[hit[same]]
+        fresh = []
+        for j in np.flatnonzero(ids < 0).tolist():
+            key = (p[j, 0], p[j, 1])
+            n = self._new_nodes.get(key)
+            if n is None:
+                n = self._new_nodes[key] = len(self.xy) + len(fresh)
+                fresh.append(key)
+            ids[j] = n
+        if fresh:
+            self.xy = np.vstack([self.xy, np.asarray(fresh, dtype=np.float64)])
+            self._live_deg = np.concatenate([self._live_deg, np.zeros(len(fresh), dtype=self._live_deg.dtype)])
+            if self._lists is not None:
+                indptr, _indices, _weights, _alive, _extra, xs, ys = self._lists
+                indptr.extend([indptr[-1]] * len(fresh))
+                xs.extend(x for x, _y in fresh)
+                ys.extend(y for _x, y in fresh)
+        return ids
+
+    # ---- đỉnh gần nhất ----
+    def _base_tree(self):
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.xy[:self._n_base])
+        return self._tree
+
+    def nearest(self, x, y, max_dist=math.inf):
+        """Chỉ số đỉnh (còn cạnh) gần (x, y) nhất trong bán kính max_dist; None nếu không có."""
+        best_d, best = math.inf, None
+        live = self._live_deg
+        if self._n_base:
+            tree = self._base_tree()
+            k = 1
+            while True:
+                k = min(self._n_base, k * 8) if live is not None else 1
+                d, i = tree.query((x, y), k=k, distance_upper_bound=max_dist)
+                d, i = np.atleast_1d(d), np.atleast_1d(i)
+                ok = np.isfinite(d)
+                d, i = d[ok], i[ok]
+                if live is not None:
+                    on = live[i] > 0
+                    d, i = d[on], i[on]
+                if len(d):
+                    best_d, best = float(d[0]), int(i[0])
+                    break
+                if live is None or k == self._n_base or np.count_nonzero(ok) < k:
+                    break
+        if len(self.xy) > self._n_base:
+            ov = self.xy[self._n_base:]
+            d = np.hypot(ov[:, 0] - x, ov[:, 1] - y)
+            d[live[self._n_base:] <= 0] = math.inf
+            j = int(np.argmin(d))
+            if d[j] <= max_dist and d[j] < best_d:
+                best = self._n_base + j
+        return best
+
+    # ---- tìm đường ----
+    def _adjacency(self):
+        # list Python cho vòng lặp heap (truy cập phần tử nhanh hơn mảng NumPy)
+        if self._lists is None:
+            pad = [int(self.indptr[-1])] * (len(self.xy) - self._n_base)
+            alive = self._alive.tolist() if self._alive is not None else None
+            self._lists = (self.indptr.tolist() + pad, self.indices.tolist(), self.weights.tolist(),
+                           alive, self._extra, self.xy[:, 0].tolist(), self.xy[:, 1].tolist())
+        return self._lists
+
+    def _neighbours(self):
+        """Hàm u -> các (đỉnh kề, trọng số): CSR (bỏ cạnh đã xoá) + overlay."""
+        indptr, indices, weights, alive, extra, _xs, _ys = self._adjacency()
+        if alive is None and not extra:
+            return lambda u: zip(indices[indptr[u]:indptr[u + 1]], weights[indptr[u]:indptr[u + 1]])
+        empty = ()
+
+        def nb(u):
+            out = [(indices[k], weights[k]) for k in range(indptr[u], indptr[u + 1])
+                   if alive is None or alive[k]]
+            ex = extra.get(u, empty)
+            return out + ex if ex else out
+        return nb
+
+    def shortest_path(self, start, goal, bidirectional=False):
+        """Danh sách chỉ số đỉnh từ start tới goal (đường ngắn nhất); None nếu không liên thông."""
+        if start is None or goal is None:
+            return None
+        if start == goal:
+            return [start]
+        if bidirectional:
+            return self._astar_bidirectional(start, goal)
+        return self._astar(start, goal)
+
+    def _astar(self, start, goal):
+        xs, ys = self._adjacency()[5:]
+        nb = self._neighbours()
+        gx, gy = xs[goal], ys[goal]
+        hypot = math.hypot
+        dist = {start: 0.0}
+        prev = {}
+        done = set()
+        pq = [(hypot(xs[start] - gx, ys[start] - gy), start)]
+        while pq:
+            _f, u = heapq.heappop(pq)
+            if u == goal:
+                return _unwind(prev, start, goal)
+            if u in done:
+                continue
+            done.add(u)
+            du = dist[u]
+            for v, w in nb(u):
+                nd = du + w
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    prev[v] = u
+                    heapq.heappush(pq, (nd + hypot(xs[v] - gx, ys[v] - gy), v))
+        return None
+
+    def _astar_bidirectional(self, start, goal):
+        xs, ys = self._adjacency()[5:]
+        nb = self._neighbours()
+        sx, sy, tx, ty = xs[start], ys[start], xs[goal], ys[goal]
+        hypot = math.hypot
+
+        def pot(v):
+            # thế trung bình: thuận dùng +pot, ngược dùng -pot (cả hai nhất quán)
+            return 0.5 * (hypot(xs[v] - tx, ys[v] - ty) - hypot(xs[v] - sx, ys[v] - sy))
+
+        dist = ({start: 0.0}, {goal: 0.0})
+        prev = ({}, {})
+        done = (set(), set())
+        pq = ([(pot(start), start)], [(-pot(goal), goal)])
+        sign = (1.0, -1.0)
+        best, meet = math.inf, None
+        while pq[0] and pq[1]:
+            # dừng khi tổng khoá nhỏ nhất 2 phía ≥ đường tốt nhất đã gặp
+            if pq[0][0][0] + pq[1][0][0] >= best:
+                break
+            side = 0 if len(pq[0]) <= len(pq[1]) else 1
+            _k, u = heapq.heappop(pq[side])
+            if u in done[side]:
+                continue
+            done[side].add(u)
+            d_me, d_other = dist[side], dist[1 - side]
+            du = d_me[u]
+            for v, w in nb(u):
+                nd = du + w
+                if nd < d_me.get(v, math.inf):
+                    d_me[v] = nd
+                    prev[side][v] = u
+                    heapq.heappush(pq[side], (nd + sign[side] * pot(v), v))
+                dv = d_other.get(v)
+                if dv is not None and nd + dv < best:
+                    best, meet = nd + dv, v
+        if meet is None:
+            return None
+        path = _unwind(prev[0], start, meet)
+        tail = _unwind(prev[1], goal, meet)
+        return path + tail[::-1][1:]
+
+
+def _as_xy(p):
+    """Mảng (k, 2) float64 đã làm tròn _ROUND chữ số."""
+    return np.round(np.asarray(p, dtype=np.float64).reshape(-1, 2), _ROUND)
+
+
+def _unique_points(pts):
+    """Gộp điểm trùng: (toạ độ duy nhất theo thứ tự x rồi y, chỉ số đỉnh của từng điểm) — lexsort nhanh hơn unique(axis=0)."""
+    order = np.lexsort((pts[:, 1], pts[:, 0]))
+    srt = pts[order]
+    new = np.ones(len(srt), dtype=bool)
+    new[1:] = np.any(srt[1:] != srt[:-1], axis=1)
+    node = np.empty(len(pts), dtype=np.int64)
+    node[order] = np.cumsum(new) - 1
+    return srt[new], node
+
+
+def _unwind(prev, start, node):
+    path = [node]
+    while node != start:
+        node = prev[node]
+        path.append(node)
+    path.reverse()
+    return path